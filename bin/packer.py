@@ -34,6 +34,7 @@ from boto3.session import Session
 
 import alter_path
 from lib.constants import repo_path
+from lib import aws
 
 os.environ["PATH"] += ":" + repo_path("bin") # allow executing Packer from the bin/ directory
 
@@ -58,32 +59,21 @@ def execute(cmd, output_file):
     return subprocess.Popen(shlex.split(cmd), stderr=subprocess.STDOUT, stdout=open(output_file, "w"))
 
 def locate_ami(aws_config):
-    def contains(x, ys):
-        for y in ys:
-            if y not in x:
-                return False
-        return True
-
     with open(aws_config) as fh:
         cred = json.load(fh)
         session = Session(aws_access_key_id = cred["aws_access_key"],
                           aws_secret_access_key = cred["aws_secret_key"],
                           region_name = 'us-east-1')
 
-        client = session.client('ec2')
-        response = client.describe_images(Filters=[
-                        {"Name": "owner-id", "Values": ["099720109477"]},
+        # Canonical's Ubuntu 14.04 server images, kept in a local catalog so
+        # only newly published images are read from AWS
+        catalog = aws.AmiCatalog(session, 'ubuntu', ['099720109477'], [
                         {"Name": "virtualization-type", "Values": ["hvm"]},
                         {"Name": "root-device-type", "Values": ["ebs"]},
                         {"Name": "architecture", "Values": ["x86_64"]},
-                        #{"Name": "platform", "Values": ["Ubuntu"]},
-                        #{"Name": "name", "Values": ["hvm-ssd"]},
-                        #{"Name": "name", "Values": ["14.04"]},
-                   ])
-
-        images = response['Images']
-        images = [i for i in images if contains(i['Name'], ('hvm-ssd', '14.04', 'server'))]
-        images.sort(key=lambda x: x["CreationDate"], reverse=True)
+                        {"Name": "name", "Values": ["*hvm-ssd*14.04*server*"]},
+                  ])
+        images = catalog.find(lambda x: True)
 
         if len(images) == 0:
             print("Error: could not locate base AMI, exiting ....")
@@ -31,11 +31,22 @@ def create_config(session, domain):
     global keypair
     keypair = aws.keypair_lookup(session)
 
+    # Lookup the AWS resources used in the config
+    resources = aws.lookup_all(session, {
+        'topic': (aws.sns_topic_lookup, "ProductionMicronsMailingList"),
+        'events_role': (aws.role_arn_lookup, "events_for_delete_lambda"),
+        'multi_lambda': (aws.lambda_arn_lookup, names.multi_lambda),
+        'activities_ami': (aws.ami_lookup, 'activities.boss'),
+        'activities_profile': (aws.instance_profile_arn_lookup, "activities"),
+        'ingest_role': (aws.role_arn_lookup, 'IngestQueueUpload'),
+        'lambda_bucket': (aws.get_lambda_s3_bucket,),
+    })
+
     vpc_id = config.find_vpc(session)
     sgs = aws.sg_lookup_all(session, vpc_id)
     internal_subnets, _ = config.find_all_availability_zones(session)
     internal_subnets_lambda, _ = config.find_all_availability_zones(session, lambda_compatible_only=True)
-    topic_arn = aws.sns_topic_lookup(session, "ProductionMicronsMailingList")
+    topic_arn = resources['topic']
     event_data = {
         "lambda-name": "delete_lambda",
         "db": names.endpoint_db,
@@ -53,9 +64,9 @@ def create_config(session, domain):
         "delete-coll-sfn-name": names.delete_collection
     }
 
-    role_arn = aws.role_arn_lookup(session, "events_for_delete_lambda")
+    role_arn = resources['events_role']
     multi_lambda = names.multi_lambda
-    lambda_arn = aws.lambda_arn_lookup(session, multi_lambda)
+    lambda_arn = resources['multi_lambda']
     target_list = [{
         "Arn": lambda_arn,
         "Id": multi_lambda,
@@ -88,21 +99,23 @@ def create_config(session, domain):
 
     config.add_autoscale_group("Activities",
                                names.activities,
-                               aws.ami_lookup(session, 'activities.boss'),
+                               resources['activities_ami'],
                                keypair,
                                subnets=internal_subnets_lambda,
                                type_=const.ACTIVITIES_TYPE,
                                security_groups=[sgs[names.internal]],
                                user_data=str(user_data),
-                               role=aws.instance_profile_arn_lookup(session, "activities"),
+                               role=resources['activities_profile'],
                                min=1,
                                max=1)
 
+    # The ingest Lambda is too large to include in the template directly
     config.add_lambda("IngestLambda",
                       names.ingest_lambda,
-                      aws.role_arn_lookup(session, 'IngestQueueUpload'),
-                      const.INGEST_LAMBDA,
-                      handler="index.handler",
+                      resources['ingest_role'],
+                      s3=(resources['lambda_bucket'],
+                          ingest_lambda_key(domain),
+                          "index.handler"),
                       timeout=60 * 5)
 
     config.add_lambda_permission("IngestLambdaExecute", Ref("IngestLambda"))
@@ -110,6 +123,11 @@ def create_config(session, domain):
     return config
 
 
+def ingest_lambda_key(domain):
+    """S3 key of the zip file containing the ingest Lambda's code"""
+    return aws.lambda_file_key("ingest_populate.{}".format(domain), const.INGEST_LAMBDA)
+
+
 def generate(session, domain):
     """Create the configuration and save it to disk"""
     config = create_config(session, domain)
@@ -118,6 +136,11 @@ def generate(session, domain):
 
 def create(session, domain):
     """Create the configuration, launch it, and initialize Vault"""
+    aws.upload_lambda_file(session,
+                           const.INGEST_LAMBDA,
+                           aws.get_lambda_s3_bucket(session),
+                           ingest_lambda_key(domain))
+
     config = create_config(session, domain)
 
     success = config.create(session)
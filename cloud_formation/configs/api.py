@@ -55,14 +55,24 @@ def create_config(session, domain, keypair=None, db_config={}):
 
     names = AWSNames(domain)
 
-    # Lookup IAM Role and SNS Topic ARNs for used later in the config
-    endpoint_role_arn = aws.role_arn_lookup(session, "endpoint")
-    cachemanager_role_arn = aws.role_arn_lookup(session, 'cachemanager')
-    dns_arn = aws.sns_topic_lookup(session, names.dns.replace(".", "-"))
+    # Lookup IAM Role and SNS Topic ARNs, and other AWS resources, used later in the config
+    resources = aws.lookup_all(session, {
+        'endpoint_role': (aws.role_arn_lookup, 'endpoint'),
+        'cachemanager_role': (aws.role_arn_lookup, 'cachemanager'),
+        'dns_topic': (aws.sns_topic_lookup, names.dns.replace(".", "-")),
+        'mailing_list_topic': (aws.sns_topic_lookup, const.PRODUCTION_MAILING_LIST),
+        'endpoint_ami': (aws.ami_lookup, "endpoint.boss"),
+        'endpoint_profile': (aws.instance_profile_arn_lookup, 'endpoint'),
+        'cert': (aws.cert_arn_lookup, names.public_dns("api")),
+    })
+
+    endpoint_role_arn = resources['endpoint_role']
+    cachemanager_role_arn = resources['cachemanager_role']
+    dns_arn = resources['dns_topic']
     if dns_arn is None:
         raise Exception("SNS topic named dns." + domain + " does not exist.")
 
-    mailing_list_arn = aws.sns_topic_lookup(session, const.PRODUCTION_MAILING_LIST)
+    mailing_list_arn = resources['mailing_list_topic']
     if mailing_list_arn is None:
         msg = "MailingList {} needs to be created before running config".format(const.PRODUCTION_MAILING_LIST)
         raise Exception(msg)
@@ -139,7 +149,7 @@ def create_config(session, domain, keypair=None, db_config={}):
     # Create the endpoint ASG, ELB, and RDS instance
     config.add_autoscale_group("Endpoint",
                                names.endpoint,
-                               aws.ami_lookup(session, "endpoint.boss"),
+                               resources['endpoint_ami'],
                                keypair,
                                subnets=az_subnets_lambda,
                                type_=const.ENDPOINT_TYPE,
@@ -149,12 +159,12 @@ def create_config(session, domain, keypair=None, db_config={}):
                                max=const.ENDPOINT_CLUSTER_MAX,
                                elb=Ref("EndpointLoadBalancer"),
                                notifications=dns_arn,
-                               role=aws.instance_profile_arn_lookup(session, 'endpoint'),
+                               role=resources['endpoint_profile'],
                                health_check_grace_period=90,
                                detailed_monitoring=True,
                                depends_on=["EndpointLoadBalancer", "EndpointDB"])
 
-    cert = aws.cert_arn_lookup(session, names.public_dns("api"))
+    cert = resources['cert']
     config.add_loadbalancer("EndpointLoadBalancer",
                             names.endpoint_elb,
                             [("443", "80", "HTTPS", cert)],
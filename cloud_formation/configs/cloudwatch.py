@@ -18,7 +18,7 @@ Create the cloudwatch alarms for the load balancer on top of a loadbalancer stac
 
 """
 
-from lib.cloudformation import CloudFormationConfiguration, Arg, Ref, Arn
+from lib.cloudformation import CloudFormationConfiguration, Arg, Ref, Arn, get_scenario
 from lib.userdata import UserData
 from lib.names import AWSNames
 from lib.keycloak import KeyCloakClient
@@ -69,8 +69,9 @@ def create_config(session, domain):
                       role=Ref('VaultConsulHealthChecker'),
                       security_groups=[internal_sg],
                       subnets=lambda_subnets,
-                      handler='index.lambda_handler',
-                      file=const.VAULT_LAMBDA)
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          monitor_lambda_key('vault_monitor', domain, const.VAULT_LAMBDA),
+                          'index.lambda_handler'))
 
     config.add_lambda('ConsulLambda',
                       names.consul_monitor,
@@ -79,15 +80,23 @@ def create_config(session, domain):
                       role=Ref('VaultConsulHealthChecker'),
                       security_groups=[internal_sg],
                       subnets=lambda_subnets,
-                      handler='index.lambda_handler',
-                      file=const.CONSUL_LAMBDA)
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          monitor_lambda_key('consul_monitor', domain, const.CONSUL_LAMBDA),
+                          'index.lambda_handler'))
 
     # Lambda input data
-    json_str = json.dumps({
+    # The monitors keep their per node health state in the Lambda bucket
+    lambda_input = {
         'vpc_id': vpc_id,
         'vpc_name': domain,
         'topic_arn': mailing_list_arn,
-    })
+        'state_bucket': aws.get_lambda_s3_bucket(session),
+        'metric_namespace': const.MONITOR_METRIC_NAMESPACE,
+    }
+    vault_json_str = json.dumps(dict(lambda_input,
+                                     state_key=monitor_state_key('vault_monitor', domain)))
+    consul_json_str = json.dumps(dict(lambda_input,
+                                      state_key=monitor_state_key('consul_monitor', domain)))
 
     config.add_cloudwatch_rule('VaultConsulCheck',
                                name=names.vault_consul_check,
@@ -96,17 +105,45 @@ def create_config(session, domain):
                                    {
                                        'Arn': Arn('VaultLambda'),
                                        'Id': names.vault_monitor,
-                                       'Input': json_str
+                                       'Input': vault_json_str
                                    },
                                    {
                                        'Arn': Arn('ConsulLambda'),
                                        'Id': names.consul_monitor,
-                                       'Input': json_str
+                                       'Input': consul_json_str
                                    },
                                ],
                                schedule='rate(1 minute)',
                                depends_on=['VaultLambda', 'ConsulLambda'])
 
+    # Alarm when the monitors see Vault or Consul slowing down, before the
+    # health checks start failing
+    vault_latency = get_scenario(const.VAULT_LATENCY_ALARM)
+    if vault_latency is not None:
+        config.add_cloudwatch_alarm('VaultLatencyAlarm',
+                                    'Vault health check latency in {}'.format(domain),
+                                    'ProbeLatency',
+                                    'Maximum',
+                                    'GreaterThanThreshold',
+                                    str(vault_latency),
+                                    [mailing_list_arn],
+                                    dimensions={'VPC': domain, 'Service': 'vault'},
+                                    period=3,
+                                    namespace=const.MONITOR_METRIC_NAMESPACE)
+
+    consul_latency = get_scenario(const.CONSUL_LATENCY_ALARM)
+    if consul_latency is not None:
+        config.add_cloudwatch_alarm('ConsulLatencyAlarm',
+                                    'Consul health check latency in {}'.format(domain),
+                                    'ProbeLatency',
+                                    'Maximum',
+                                    'GreaterThanThreshold',
+                                    str(consul_latency),
+                                    [mailing_list_arn],
+                                    dimensions={'VPC': domain, 'Service': 'consul'},
+                                    period=3,
+                                    namespace=const.MONITOR_METRIC_NAMESPACE)
+
     config.add_lambda_permission('VaultPerms',
                                  names.vault_monitor,
                                  principal='events.amazonaws.com',
@@ -120,6 +157,36 @@ def create_config(session, domain):
     return config
 
 
+def monitor_lambda_key(name, domain, file):
+    """S3 key of the zip file containing a monitor Lambda's code
+    :arg name monitor name
+    :arg domain internal DNS name
+    :arg file monitor Lambda's source file"""
+    return aws.lambda_file_key("{}.{}".format(name, domain), file)
+
+
+def monitor_state_key(name, domain):
+    """S3 key of the object containing a monitor Lambda's health check state
+    :arg name monitor name
+    :arg domain internal DNS name"""
+    return "{}.{}.state.json".format(name, domain)
+
+
+def upload_monitor_lambdas(session, domain):
+    """Upload the monitor Lambdas' code to the Lambda S3 bucket
+    :arg session information for performing lookups
+    :arg domain internal DNS name"""
+    bucket = aws.get_lambda_s3_bucket(session)
+    aws.upload_lambda_file(session,
+                           const.VAULT_LAMBDA,
+                           bucket,
+                           monitor_lambda_key('vault_monitor', domain, const.VAULT_LAMBDA))
+    aws.upload_lambda_file(session,
+                           const.CONSUL_LAMBDA,
+                           bucket,
+                           monitor_lambda_key('consul_monitor', domain, const.CONSUL_LAMBDA))
+
+
 def generate(session, domain):
     """Create the configuration and save it to disk
     :arg folder location to generate the cloudformation template stack
@@ -131,6 +198,7 @@ def create(session, domain):
     """Create the configuration, launch it, and initialize Vault
     :arg session information for performing lookups
     :arg domain internal DNS name """
+    upload_monitor_lambdas(session, domain)
     config = create_config(session, domain)
 
     success = config.create(session)
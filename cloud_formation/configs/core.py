@@ -32,11 +32,11 @@ from lib import aws
 from lib import utils
 from lib import scalyr
 from lib import constants as const
+from lib import exceptions
 
 import os
 import json
 import time
-from concurrent.futures import ThreadPoolExecutor
 
 keypair = None
 
@@ -177,13 +177,34 @@ def create_config(session, domain):
     config.add_lambda("DNSLambda",
                       names.dns,
                       aws.role_arn_lookup(session, 'UpdateRoute53'),
-                      const.DNS_LAMBDA,
-                      handler="index.handler",
-                      timeout=10,
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          dns_lambda_key(domain),
+                          "index.handler"),
+                      timeout=60,
                       depends_on="DNSZone")
 
     config.add_lambda_permission("DNSLambdaExecute", Ref("DNSLambda"))
 
+    # Periodically sweep the hosted zone for records of instances that were
+    # not terminated through the AutoScale Group
+    config.add_cloudwatch_rule("DNSReconcile",
+                               name=names.dns_reconcile,
+                               description="Reconcile DNS records with running instances.",
+                               targets=[
+                                   {
+                                       'Arn': Arn('DNSLambda'),
+                                       'Id': names.dns_reconcile,
+                                       'Input': json.dumps({'vpc_name': domain})
+                                   }
+                               ],
+                               schedule='rate(1 hour)',
+                               depends_on=['DNSLambda'])
+
+    config.add_lambda_permission("DNSReconcilePerms",
+                                 Ref("DNSLambda"),
+                                 principal='events.amazonaws.com',
+                                 source=Arn('DNSReconcile'))
+
     config.add_sns_topic("DNSSNS",
                          names.dns,
                          names.dns,
@@ -234,6 +255,16 @@ def create_config(session, domain):
 
     return config
 
+def dns_lambda_key(domain):
+    """S3 key of the zip file containing the DNS Lambda's code"""
+    return aws.lambda_file_key("updateRoute53.{}".format(domain), const.DNS_LAMBDA)
+
+def upload_dns_lambda(session, domain):
+    aws.upload_lambda_file(session,
+                           const.DNS_LAMBDA,
+                           aws.get_lambda_s3_bucket(session),
+                           dns_lambda_key(domain))
+
 def generate(session, domain):
     """Create the configuration and save it to disk"""
     config = create_config(session, domain)
@@ -241,6 +272,7 @@ def generate(session, domain):
 
 def create(session, domain):
     """Create the configuration, launch it, and initialize Vault"""
+    upload_dns_lambda(session, domain)
     config = create_config(session, domain)
 
     success = config.create(session)
@@ -366,18 +398,18 @@ def update(session, domain):
         print("Can only update the production and ha-development scenario")
         return None
 
-    consul_update_timeout = 5 # minutes
+    consul_update_timeout = 10 # minutes, maximum wait for each node to be replaced
     consul_size = int(get_scenario(const.CONSUL_CLUSTER_SIZE))
-    min_time = consul_update_timeout * consul_size
-    max_time = min_time + 5 # add some time to allow the CF update to happen
+    max_time = consul_update_timeout * consul_size + 5 # add some time to allow the CF update to happen
 
-    print("Update command will take {} - {} minutes to finish".format(min_time, max_time))
+    print("Update command will take up to {} minutes to finish".format(max_time))
     print("Stack will be available during that time")
     resp = input("Update? [N/y] ")
     if len(resp) == 0 or resp[0] not in ('y', 'Y'):
         print("Canceled")
         return
 
+    upload_dns_lambda(session, domain)
     config = create_config(session, domain)
     success = config.update(session)
 
@@ -402,13 +434,22 @@ def update(session, domain):
         # DP NOTE: Cycling the instances is done manually (outside of CF)
         #          so that Vault can be unsealed first, else the whole stacks
         #          would not be usable until all consul instance were restarted
-        with ThreadPoolExecutor(max_workers=3) as tpe:
-            # Need time for the ASG to detect the terminated instance,
-            # launch the new instance, and have the instance cluster
-            tpe.submit(aws.asg_restart,
-                            session,
+        def healthy():
+            # Only move to the next node once the new node has joined the
+            # cluster, so that quorum is never lost
+            return call.consul_quorum(consul_size) and call.vault_unsealed()
+
+        try:
+            aws.asg_restart(session,
                             names.consul,
-                            consul_update_timeout * 60)
+                            consul_update_timeout * 60,
+                            batch_size = const.CONSUL_RESTART_BATCH_SIZE,
+                            healthy = healthy,
+                            max_failures = const.CONSUL_RESTART_MAX_FAILURES)
+        except exceptions.StatusCheckError as ex:
+            print("Problem cycling the consul cluster: {}".format(ex))
+            print("Check the cluster's health before continuing")
+            return False
 
     return success
 
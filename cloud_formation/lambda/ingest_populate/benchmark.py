@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the ingest upload queue populator.
+
+The keys benchmark measures how many tile messages per second create_messages()
+can generate, without sending anything to SQS.
+
+The handler benchmark runs handler() against an in-process stand-in for SQS,
+with configurable latency and failure injection, for a set of job shapes and
+reports messages/sec, API calls, retries, and peak memory.
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+import ingest_queue_upload as upload
+
+# name: (x_tiles, y_tiles, z_tiles, t_tiles)
+JOB_SHAPES = {
+    'thin-z-stack': (2, 2, 2000, 1),
+    'wide-xy': (100, 100, 2, 1),
+    'many-t': (8, 8, 16, 100),
+}
+
+def job_args(x_tiles, y_tiles, z_tiles, t_tiles):
+    """Create the populate arguments for a job of the given size, in tiles"""
+    return {
+        'job_id': 1234,
+        'upload_queue': 'https://queue.amazonaws.com/123456789012/upload-queue',
+        'ingest_queue': 'https://queue.amazonaws.com/123456789012/ingest-queue',
+
+        'resolution': 0,
+        'project_info': ['1', '2', '3'],
+
+        't_start': 0,
+        't_stop': t_tiles,
+        't_tile_size': 1,
+
+        'x_start': 0,
+        'x_stop': x_tiles * 512,
+        'x_tile_size': 512,
+
+        'y_start': 0,
+        'y_stop': y_tiles * 512,
+        'y_tile_size': 512,
+
+        'z_start': 0,
+        'z_stop': z_tiles,
+        'z_tile_size': 16,
+        'final_z_stop': z_tiles,
+    }
+
+def benchmark_create_messages(args, repeat):
+    """Time generating all of the messages for a job
+
+    Args:
+        args (dict): Populate arguments
+        repeat (int): Number of times to generate the messages, the best
+                      time is reported
+
+    Returns:
+        (int, float): Tuple of the number of messages and the best time, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = 0
+        for _ in upload.create_messages(args):
+            count += 1
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return count, best
+
+class FakeSQS(object):
+    """In-process stand-in for the boto3 SQS client used by handler()
+
+    Args:
+        latency (float): Seconds each API call takes
+        failure_rate (float): Probability that each entry of a batch fails
+    """
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.api_calls = 0
+        self.failures = 0
+
+    def send_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+
+        successful, failed = [], []
+        for entry in Entries:
+            if random.random() < self.failure_rate:
+                failed.append({'Id': entry['Id'],
+                               'SenderFault': False,
+                               'Code': 'InternalError'})
+            else:
+                successful.append({'Id': entry['Id']})
+
+        with self.lock:
+            self.api_calls += 1
+            self.messages += len(successful)
+            self.failures += len(failed)
+
+        resp = {'Successful': successful}
+        if len(failed) > 0:
+            resp['Failed'] = failed
+        return resp
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        time.sleep(self.latency)
+
+        with self.lock:
+            self.api_calls += 1
+            return {'Attributes': {'ApproximateNumberOfMessages': str(self.messages)}}
+
+def benchmark_handler(args, latency, failure_rate):
+    """Run handler() to completion against a FakeSQS queue
+
+    Args:
+        args (dict): Populate arguments
+        latency (float): Seconds each SQS API call takes
+        failure_rate (float): Probability that each message fails to send
+
+    Returns:
+        dict: Results with the keys messages, seconds, api_calls, retries, and
+              peak_memory (in bytes)
+    """
+    sqs = FakeSQS(latency, failure_rate)
+    client = upload.boto3.client
+    upload.boto3.client = lambda *args, **kwargs: sqs
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        # The handler's progress and retry messages would bury the results table
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = {'finished': False}
+            while not result['finished']:
+                try:
+                    result = upload.handler(args, None)
+                except upload.FailedToSendMessages as ex:
+                    # Keep going from the cursor, so the benchmark always finishes
+                    result = dict(args, failures=0, finished=False, **upload.json.loads(str(ex)))
+
+                # Continue from the returned cursor, like the step function does
+                args = result
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        upload.boto3.client = client
+
+    return {
+        'messages': sqs.messages,
+        'seconds': elapsed,
+        'api_calls': sqs.api_calls,
+        'retries': sqs.failures,
+        'peak_memory': peak,
+    }
+
+def keys_main(args):
+    job = job_args(args.tiles, args.tiles, args.depth, 1)
+    count, elapsed = benchmark_create_messages(job, args.repeat)
+    print("create_messages: {} messages in {:.3f}s, {:.0f} messages/sec".format(count, elapsed, count / elapsed))
+
+def handler_main(args):
+    print("{:<14} {:>9} {:>8} {:>12} {:>9} {:>8} {:>10}".format(
+          "shape", "messages", "seconds", "messages/sec", "api calls", "retries", "peak KiB"))
+
+    for shape in args.shapes:
+        job = job_args(*JOB_SHAPES[shape])
+        job['packed'] = args.packed
+
+        result = benchmark_handler(job, args.latency / 1000, args.failure_rate)
+        print("{:<14} {:>9} {:>8.2f} {:>12.0f} {:>9} {:>8} {:>10.0f}".format(
+              shape,
+              result['messages'],
+              result['seconds'],
+              result['messages'] / result['seconds'],
+              result['api_calls'],
+              result['retries'],
+              result['peak_memory'] / 1024))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark the ingest upload queue populator")
+    subparsers = parser.add_subparsers(dest = "benchmark")
+    subparsers.required = True
+
+    keys = subparsers.add_parser("keys", help = "Benchmark message generation")
+    keys.set_defaults(func = keys_main)
+    keys.add_argument("--tiles", "-t",
+                      metavar = "<tiles>",
+                      type = int,
+                      default = 32,
+                      help = "Number of tiles in the X and Y dimensions (default: 32)")
+    keys.add_argument("--depth", "-z",
+                      metavar = "<depth>",
+                      type = int,
+                      default = 100,
+                      help = "Number of tiles in the Z dimension (default: 100)")
+    keys.add_argument("--repeat", "-r",
+                      metavar = "<repeat>",
+                      type = int,
+                      default = 3,
+                      help = "Number of runs, the best is reported (default: 3)")
+
+    handler = subparsers.add_parser("handler", help = "Benchmark the handler against a fake SQS queue")
+    handler.set_defaults(func = handler_main)
+    handler.add_argument("--latency", "-l",
+                         metavar = "<milliseconds>",
+                         type = float,
+                         default = 20,
+                         help = "Latency of each SQS API call (default: 20)")
+    handler.add_argument("--failure-rate", "-f",
+                         metavar = "<rate>",
+                         type = float,
+                         default = 0.0,
+                         help = "Probability that each message fails to send (default: 0.0)")
+    handler.add_argument("--packed",
+                         action = "store_true",
+                         help = "Send packed messages")
+    handler.add_argument("shapes",
+                         nargs = "*",
+                         default = sorted(JOB_SHAPES.keys()),
+                         metavar = "shape",
+                         help = "Job shapes to run ({}) (default: all)".format(", ".join(sorted(JOB_SHAPES.keys()))))
+
+    args = parser.parse_args()
+
+    if args.benchmark == "handler":
+        for shape in args.shapes:
+            if shape not in JOB_SHAPES:
+                parser.error("Unknown job shape '{}'".format(shape))
+
+    args.func(args)
@@ -1,13 +1,65 @@
 import boto3
 import json
 import time
+import random
 import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from botocore.client import Config
+from botocore.exceptions import ClientError, BotoCoreError
 
 class FailedToSendMessages(Exception):
     pass
 
+class FailedShard(Exception):
+    pass
+
 SQS_BATCH_SIZE = 10
-SQS_RETRY_TIMEOUT = 15
+SQS_MAX_IN_FLIGHT = 8 # Number of batches being sent concurrently
+SQS_MAX_PENDING = 64 # Number of sent batches that can wait on an earlier batch
+SQS_RETRY_COUNT = 3
+SQS_RETRY_BASE = 0.5 # Initial backoff, in seconds, doubled for each retry
+SQS_RETRY_TIMEOUT = 15 # Maximum backoff, in seconds
+
+# Seconds to wait for a connection to SQS and for a response to each request.
+# SQS_RETRY_COUNT attempts, with their backoff, take at most
+# 3 * (2 + 10) + 1 + 2 = 39 seconds, within LAMBDA_TIME_MARGIN
+SQS_CONNECT_TIMEOUT = 2
+SQS_READ_TIMEOUT = 10
+
+# SQS limits the total size of a batch, not just each message, so packed
+# messages are sized so that a full batch fits within the limit
+SQS_MAX_BATCH_BYTES = 256 * 1024
+PACKED_MESSAGE_BYTES = SQS_MAX_BATCH_BYTES // SQS_BATCH_SIZE - 1024
+PACKED_MESSAGE_VERSION = 2
+
+# Worker invocations can run up to the full Lambda timeout (5 minutes), so the
+# coordinator's read timeout has to be longer than botocore's 60 second default
+LAMBDA_READ_TIMEOUT = 60 * 5 + 30
+
+# Seconds the coordinator keeps for itself after the workers' deadline, to
+# collect their results and return the continuation
+FAN_OUT_MARGIN = 15
+
+# Maximum number of shards, so the continuation listing the unfinished shards
+# stays well under the 32KB Step Functions payload limit
+MAX_SHARDS = 64
+
+# The arguments that differ between shards, the only ones kept in 'shards'
+SHARD_KEYS = ['t_start', 't_stop', 'z_start', 'z_stop', 'cursor', 'unsent']
+
+# Time, in milliseconds, left for draining the in flight batches (including
+# their retries) once population stops to return a continuation. Must be
+# longer than a batch can take, see SQS_READ_TIMEOUT
+LAMBDA_TIME_MARGIN = 45 * 1000
+
+# Number of invocations in a row that can fail to send messages before the
+# failure is raised instead of returned as a continuation
+MAX_FAILED_INVOCATIONS = 3
+
+# How often, in seconds, the upload queue depth is sampled when 'max_queue_depth'
+# is given
+QUEUE_DEPTH_INTERVAL = 10
 
 def handler(args, context):
     """Populate the ingest upload SQS Queue with tile information
@@ -40,55 +92,331 @@ def handler(args, context):
             'z_stop': 0
             'z_tile_size': 16,
             'final_z_stop': 0, The full extent of the Z dimension
+
+            'shard_count': 1, Optional, if greater than 1 the tile space is
+                              split into disjoint shards (at most MAX_SHARDS)
+                              and a copy of this Lambda is invoked to
+                              populate each shard
+            'deadline': None, Optional, time (seconds since the epoch) to
+                              stop by, set by the coordinator of a fan out
+                              for its workers
+
+            'cursor': [t, z, y, x, tile], Optional, the last tile that was
+                                          sent, population resumes with
+                                          the following tile
+            'unsent': [[after, last]], Optional, ranges of messages before the
+                                       cursor that could not be sent, each
+                                       range contains the messages following
+                                       the tile 'after' up to and including
+                                       the tile 'last'
+
+            'packed': False, Optional, if True each message describes many
+                             tiles (see decode_message()) instead of one
+
+            'max_queue_depth': None, Optional, stop population while the upload
+                                     queue contains more messages than this
+
+            'sent': 0, Optional, number of messages sent by previous invocations
+            'shards': [], Optional, the SHARD_KEYS of the unfinished shards
+                          of a fan out
+            'failures': 0, Optional, number of previous invocations in a row
+                           that failed to send messages
         }
+        context (Context): Lambda context, used to stop before the Lambda times
+                           out and to locate the current function when sharding
+
+    Note: Population stops when less than LAMBDA_TIME_MARGIN of the Lambda's
+          run time, or before the 'deadline', is left. The returned arguments contain the cursor to
+          continue from and are passed back in until 'finished' is True.
+          Population also stops, with 'throttled' set, if the upload queue
+          holds more than 'max_queue_depth' messages, so the caller can wait
+          for the ingest clients to drain the queue before continuing.
+
+    Note: If messages cannot be sent population stops, with 'failed' set,
+          once the batches in flight are done. The messages that could not be
+          sent are returned in 'unsent' and are sent first when the arguments
+          are passed back in, so resuming doesn't require the queue to be
+          purged and no message is sent twice. After MAX_FAILED_INVOCATIONS
+          failed invocations in a row FailedToSendMessages is raised with a
+          Json message containing the 'cursor', the 'unsent' messages, and the
+          number of messages 'sent'.
 
     Returns:
-        int: Number of messages put into the queue
+        dict: The given args with the following keys updated
+              'sent': Total number of messages put into the queue, when packed
+                      this is less than the number of tiles
+              'cursor': The last tile that was sent or added to 'unsent'
+              'unsent': The messages that could not be sent
+              'finished': If all of the tiles have been sent
+              'throttled': If population stopped because of 'max_queue_depth'
+              'failed': If population stopped because messages could not be sent
+              'failures': Number of invocations in a row that failed
     """
-    print("Starting to populate upload queue")
-
-    queue = boto3.resource('sqs').Queue(args['upload_queue'])
+    if args.get('shard_count', 1) > 1:
+        return fan_out(args, context)
 
-    msgs = create_messages(args)
-    sent = 0
+    print("Starting to populate upload queue")
 
-    while True:
-        batch = []
-        for i in range(SQS_BATCH_SIZE):
-            try:
-                batch.append({
-                    'Id': str(i),
-                    'MessageBody': next(msgs),
-                    'DelaySeconds': 0
-                })
-            except StopIteration:
+    queue_url = args['upload_queue']
+    # send_batch() does the retrying, so the time a batch can take is bounded
+    config = Config(max_pool_connections=SQS_MAX_IN_FLIGHT,
+                    connect_timeout=SQS_CONNECT_TIMEOUT,
+                    read_timeout=SQS_READ_TIMEOUT,
+                    retries={'max_attempts': 0})
+    client = boto3.client('sqs', config=config)
+
+    cursor = args.get('cursor')
+    if cursor is not None:
+        print("Resuming after tile {}".format(cursor))
+
+    create = _create_packed_messages if args.get('packed', False) else _create_messages
+
+    # Messages that failed to send during previous invocations are sent first
+    resend = deque(create_batches(_resend_messages(create, args, args.get('unsent', []))))
+    batches = create_batches(_with_previous(create(args, cursor), cursor))
+    unsent = []
+    sent = args.get('sent', 0)
+    failed = False
+    finished = True
+    throttled = False
+
+    max_queue_depth = args.get('max_queue_depth')
+    next_sample = 0
+
+    with ThreadPoolExecutor(max_workers=SQS_MAX_IN_FLIGHT) as executor:
+        # Batches in the order they were created, the cursor only moves past a
+        # batch once it and all of the batches before it are done, with any
+        # messages that could not be sent added to unsent
+        pending = deque()
+        running = set()
+        while True:
+            # Keep the pipeline full, unless a batch failed or the time budget
+            # is used up and the in flight batches are being drained
+            while (not failed and finished and
+                   len(running) < SQS_MAX_IN_FLIGHT and
+                   len(pending) < SQS_MAX_PENDING):
+                # There are at most a few batches to resend, they are always
+                # sent so they are not lost when stopping
+                if len(resend) > 0:
+                    batch = resend.popleft()
+                else:
+                    if out_of_time(context, args.get('deadline')):
+                        print("Running out of time, stopping")
+                        finished = False
+                        break
+
+                    if max_queue_depth is not None and time.time() >= next_sample:
+                        next_sample = time.time() + QUEUE_DEPTH_INTERVAL
+                        depth = queue_depth(client, queue_url)
+                        if depth > max_queue_depth:
+                            print("Upload queue contains {} messages, stopping".format(depth))
+                            finished = False
+                            throttled = True
+                            break
+
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+
+                positions, msgs = batch
+                future = executor.submit(send_batch, client, queue_url, msgs)
+                pending.append((future, positions))
+                running.add(future)
+
+            if len(pending) == 0:
                 break
 
-        if len(batch) == 0:
-            break
+            # Wait for any batch, so a batch that is backing off doesn't
+            # keep the other batches from being sent
+            _, running = wait(running, return_when=FIRST_COMPLETED)
 
-        retry = 3
-        while retry > 0:
-            resp = queue.send_messages(Entries=batch)
-            sent += len(resp['Successful'])
+            while len(pending) > 0 and pending[0][0].done():
+                future, positions = pending.popleft()
+                count, failures = future.result()
+                sent += count
 
-            if 'Failed' in resp and len(resp['Failed']) > 0:
-                print("Batch failed to enqueue messages")
-                print("Retries left: {}".format(retry))
-                print("Boto3 send_messages response: {}".format(resp))
-                time.sleep(SQS_RETRY_TIMEOUT)
+                for i in failures:
+                    add_unsent(unsent, *positions[i])
 
-                ids = [f['Id'] for f in resp['Failed']]
-                batch = [b for b in batch if b['Id'] in ids]
-                retry -= 1
-                if retry == 0:
+                if len(failures) > 0 and not failed:
                     print("Exhausted retry count, stopping")
-                    raise FailedToSendMessages(batch) # SFN will relaunch the activity
-                continue
-            else:
+                    failed = True
+
+                # Resent messages are before the cursor
+                last = positions[-1][1]
+                if cursor is None or last > cursor:
+                    cursor = last
+
+    # Batches to resend that were not sent because of a failure
+    for positions, _ in resend:
+        for after, last in positions:
+            add_unsent(unsent, after, last)
+
+    failures = args.get('failures', 0) + 1 if failed else 0
+    if failures > MAX_FAILED_INVOCATIONS:
+        raise FailedToSendMessages(json.dumps({
+            'cursor': cursor,
+            'unsent': unsent,
+            'sent': sent,
+        }))
+
+    # If the stop happened right as the last batch was sent there is nothing
+    # left, but the next invocation will find that out quickly
+    args = args.copy()
+    args['sent'] = sent
+    args['cursor'] = cursor
+    args['unsent'] = unsent
+    args['finished'] = finished and not failed
+    args['throttled'] = throttled
+    args['failed'] = failed
+    args['failures'] = failures
+    return args
+
+def queue_depth(client, queue_url):
+    """Get the approximate number of messages waiting in a queue
+
+    Args:
+        client (SQS.Client): SQS client
+        queue_url (string): URL of the SQS queue
+
+    Returns:
+        int: Approximate number of visible messages in the queue
+    """
+    resp = client.get_queue_attributes(QueueUrl=queue_url,
+                                       AttributeNames=['ApproximateNumberOfMessages'])
+    return int(resp['Attributes']['ApproximateNumberOfMessages'])
+
+def out_of_time(context, deadline=None):
+    """Check if the Lambda is about to reach its time limit
+
+    Args:
+        context (Context|None): Lambda context, if None there is no time limit
+        deadline (None|float): Time, in seconds since the epoch, to stop by
+                               even if the Lambda has time left
+
+    Returns:
+        bool: If less than LAMBDA_TIME_MARGIN is left
+    """
+    remaining = []
+    if context is not None:
+        remaining.append(context.get_remaining_time_in_millis())
+    if deadline is not None:
+        remaining.append((deadline - time.time()) * 1000)
+    return len(remaining) > 0 and min(remaining) < LAMBDA_TIME_MARGIN
+
+def add_unsent(unsent, after, last):
+    """Add a message that could not be sent to a list of unsent ranges
+
+    Args:
+        unsent (list): List of [after, last] ranges, updated in place
+        after (None|list): Position of the message before the unsent message
+        last (list): Position of the unsent message
+    """
+    if len(unsent) > 0 and unsent[-1][1] == after:
+        unsent[-1][1] = last
+    else:
+        unsent.append([after, last])
+
+def _with_previous(msgs, after):
+    """Add the position of the previous message to each message
+
+    Args:
+        msgs (generator): Generator of (position, msg) tuples
+        after (None|list): Position before the first message
+
+    Returns:
+        generator: Generator of ((after, position), msg) tuples
+    """
+    for position, msg in msgs:
+        yield (after, position), msg
+        after = position
+
+def _resend_messages(create, args, unsent):
+    """Create the messages of ranges that could not be sent
+
+    Args:
+        create (function): _create_messages() or _create_packed_messages()
+        args (dict): Same arguments as populate_upload_queue()
+        unsent (list): List of [after, last] ranges, see add_unsent()
+
+    Returns:
+        generator: Generator of ((after, position), msg) tuples
+    """
+    for start, last in unsent:
+        for (after, position), msg in _with_previous(create(args, start), start):
+            yield (after, position), msg
+            if position >= last:
                 break
 
-    return sent
+def create_batches(msgs):
+    """Group tile messages into SQS sized batches
+
+    Args:
+        msgs (generator): Generator of (position, msg) tuples
+
+    Returns:
+        generator: Generator of (positions, msgs) tuples, each list containing
+                   up to SQS_BATCH_SIZE items
+    """
+    positions, batch = [], []
+    for position, msg in msgs:
+        positions.append(position)
+        batch.append(msg)
+
+        if len(batch) == SQS_BATCH_SIZE:
+            yield positions, batch
+            positions, batch = [], []
+
+    if len(batch) > 0:
+        yield positions, batch
+
+def send_batch(client, queue_url, msgs):
+    """Send a batch of messages, retrying the failed entries
+
+    Failed entries are retried with a jittered exponential backoff, so one
+    throttled batch doesn't stall all of the other batches in flight.
+
+    Args:
+        client (SQS.Client): SQS client to send the messages with
+        queue_url (string): URL of the SQS queue
+        msgs (list[string]): Up to SQS_BATCH_SIZE message bodies
+
+    Returns:
+        (int, list[int]): Tuple of the number of messages sent and the
+                          indexes of the messages that could not be sent
+    """
+    entries = [{
+        'Id': str(i),
+        'MessageBody': msg,
+        'DelaySeconds': 0
+    } for i, msg in enumerate(msgs)]
+
+    sent = 0
+    for attempt in range(SQS_RETRY_COUNT):
+        if attempt > 0:
+            backoff = min(SQS_RETRY_TIMEOUT, SQS_RETRY_BASE * 2 ** attempt)
+            time.sleep(random.uniform(0, backoff))
+
+        try:
+            resp = client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except (ClientError, BotoCoreError) as ex:
+            # BotoCoreError covers connection errors and read timeouts
+            print("Batch failed to enqueue messages: {}".format(ex))
+            continue
+
+        sent += len(resp.get('Successful', []))
+
+        if len(resp.get('Failed', [])) == 0:
+            return sent, []
+
+        print("Batch failed to enqueue messages")
+        print("Retries left: {}".format(SQS_RETRY_COUNT - attempt - 1))
+        print("Boto3 send_message_batch response: {}".format(resp))
+
+        ids = [f['Id'] for f in resp['Failed']]
+        entries = [e for e in entries if e['Id'] in ids]
+
+    return sent, [int(e['Id']) for e in entries]
 
 def create_messages(args):
     """Create all of the tile messages to be enqueued
@@ -99,59 +427,397 @@ def create_messages(args):
     Returns:
         list: List of strings containing Json data
     """
+    for _, msg in _create_messages(args):
+        yield msg
+
+def count_messages(args):
+    """Calculate the number of tile messages and chunks that will be enqueued
+
+    The counts are calculated directly from the arguments, without generating
+    any keys, and match the number of messages generated by create_messages().
+
+    Packed messages hold as many chunks as fit within PACKED_MESSAGE_BYTES, which
+    depends on the length of each chunk key, so their count cannot be calculated
+    without generating the keys.
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+
+    Returns:
+        (int, int): Tuple of the number of tile messages and number of chunks
+
+    Raises:
+        ValueError: If 'packed' is set in the arguments
+    """
+    if args.get('packed', False):
+        raise ValueError("Cannot count packed messages, count the tiles of the unpacked job")
+
+    count = lambda v: len(range(args[v + '_start'], args[v + '_stop'], args[v + '_tile_size']))
+
+    z_start = args['z_start']
+    z_tile_size = args['z_tile_size']
+    z_count = count('z')
+    final_z_stop = args['final_z_stop']
+
+    # Chunks that are completely below final_z_stop contain z_tile_size tiles
+    full = (final_z_stop - z_tile_size - z_start) // z_tile_size + 1
+    full = max(0, min(full, z_count))
 
-    tile_size = lambda v: args[v + "_tile_size"]
-    range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
-
-    # DP NOTE: generic version of
-    # BossBackend.encode_chunk_key and BossBackend.encode.tile_key
-    # from ingest-client/ingestclient/core/backend.py
-    def hashed_key(*args):
-        base = '&'.join(map(str,args))
-
-        md5 = hashlib.md5()
-        md5.update(base.encode())
-        digest = md5.hexdigest()
-
-        return '&'.join([digest, base])
-
-    for t in range_('t'):
-        for z in range_('z'):
-            for y in range_('y'):
-                for x in range_('x'):
-                    chunk_x = int(x/tile_size('x'))
-                    chunk_y = int(y/tile_size('y'))
-                    chunk_z = int(z/tile_size('z'))
-
-                    num_of_tiles = min(tile_size('z'), args['final_z_stop'] - z)
-
-                    chunk_key = hashed_key(num_of_tiles,
-                                           args['project_info'][0],
-                                           args['project_info'][1],
-                                           args['project_info'][2],
-                                           args['resolution'],
-                                           chunk_x,
-                                           chunk_y,
-                                           chunk_z,
-                                           t)
-
-                    for tile in range(z, z + num_of_tiles):
-                        tile_key = hashed_key(args['project_info'][0],
-                                              args['project_info'][1],
-                                              args['project_info'][2],
-                                              args['resolution'],
-                                              chunk_x,
-                                              chunk_y,
-                                              tile,
-                                              t)
-
-                        msg = {
-                            'job_id': args['job_id'],
-                            'upload_queue_arn': args['upload_queue'],
-                            'ingest_queue_arn': args['ingest_queue'],
-                            'chunk_key': chunk_key,
-                            'tile_key': tile_key,
-                        }
-
-                        yield json.dumps(msg)
+    # At most one chunk is clipped by final_z_stop, any after it are empty
+    partial = 0
+    if full < z_count:
+        partial = max(0, final_z_stop - (z_start + full * z_tile_size))
 
+    plane = count('t') * count('y') * count('x')
+    tiles = plane * (full * z_tile_size + partial)
+    chunks = plane * (full + (1 if partial > 0 else 0))
+
+    return tiles, chunks
+
+def _create_chunks(args, cursor=None):
+    """Create the chunks containing the tiles to be enqueued
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position of the last tile that was already enqueued
+                            Only tiles after this position are included
+
+    Returns:
+        list: List of ([t, z, y, x], chunk_key, tile_start, tile_stop) tuples
+              with the chunk position, the chunk key, and the range of tiles
+              within the chunk
+    """
+    x_tile_size = args['x_tile_size']
+    y_tile_size = args['y_tile_size']
+    z_tile_size = args['z_tile_size']
+    final_z_stop = args['final_z_stop']
+
+    range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], args[v + '_tile_size'])
+    t_range, z_range, y_range, x_range = range_('t'), range_('z'), range_('y'), range_('x')
+
+    # The collection, experiment, channel, and resolution don't change
+    project = '&'.join(map(str, list(args['project_info']) + [args['resolution']]))
+
+    resume = None if cursor is None else list(cursor[:4])
+
+    for t in t_range:
+        for z in z_range:
+            num_of_tiles = min(z_tile_size, final_z_stop - z)
+            tile_stop = z + num_of_tiles
+
+            # Prefix and suffix of the chunk key for this t and z
+            prefix = '{}&{}&'.format(num_of_tiles, project)
+            suffix = '&{}&{}'.format(int(z/z_tile_size), t)
+
+            for y in y_range:
+                chunk_y = '&{}'.format(int(y/y_tile_size))
+
+                for x in x_range:
+                    tile_start = z
+
+                    if resume is not None:
+                        # Positions are generated in increasing order, so all
+                        # chunks before the cursor's chunk were already sent
+                        position = [t, z, y, x]
+                        if position < resume:
+                            continue
+                        elif position == resume:
+                            tile_start = cursor[4] + 1
+                        else:
+                            resume = None
+
+                    if tile_start < tile_stop:
+                        base = prefix + str(int(x/x_tile_size)) + chunk_y + suffix
+                        digest = hashlib.md5(base.encode()).hexdigest()
+                        yield [t, z, y, x], digest + '&' + base, tile_start, tile_stop
+
+def tile_keys(chunk_key, tile_start, tile_stop):
+    """Create the tile keys for a range of tiles within a chunk
+
+    Args:
+        chunk_key (string): Key of the chunk containing the tiles
+        tile_start (int): First tile (z index) in the range
+        tile_stop (int): End of the tile range, exclusive
+
+    Returns:
+        list: List of (tile, tile_key) tuples
+    """
+    # digest&num_of_tiles&col&exp&ch&res&x&y&z&t
+    parts = chunk_key.split('&')
+
+    # col&exp&ch&res&x&y&tile&t
+    prefix = '&'.join(parts[2:8]) + '&'
+    suffix = '&' + parts[9]
+
+    md5 = hashlib.md5
+    for tile in range(tile_start, tile_stop):
+        base = prefix + str(tile) + suffix
+        yield tile, md5(base.encode()).hexdigest() + '&' + base
+
+def _create_messages(args, cursor=None):
+    """Create the tile messages to be enqueued, with the position of each tile
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position of the last tile that was already enqueued
+                            Only tiles after this position are created
+
+    Returns:
+        list: List of ([t, z, y, x, tile], string) tuples with the tile position
+              and Json data
+    """
+    # Json body with everything except the chunk and tile keys, which are
+    # appended for each tile. Built so the keys are always last, as the
+    # Lambda runtime (Python 2.7) doesn't preserve dictionary order.
+    head = json.dumps({
+        'job_id': args['job_id'],
+        'upload_queue_arn': args['upload_queue'],
+        'ingest_queue_arn': args['ingest_queue'],
+    })[:-1] + ', "chunk_key": "'
+
+    for position, chunk_key, tile_start, tile_stop in _create_chunks(args, cursor):
+        chunk_head = head + chunk_key + '", "tile_key": "'
+        for tile, tile_key in tile_keys(chunk_key, tile_start, tile_stop):
+            yield position + [tile], chunk_head + tile_key + '"}'
+
+def _create_packed_messages(args, cursor=None):
+    """Create packed messages, each describing the tiles of many chunks
+
+    Each message contains as many chunks as fit within PACKED_MESSAGE_BYTES.
+    The chunks are stored as [chunk_key, tile_start, tile_stop] and the
+    individual tile messages can be recreated using decode_message().
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position of the last tile that was already enqueued
+                            Only tiles after this position are included
+
+    Returns:
+        list: List of ([t, z, y, x, tile], string) tuples with the position of
+              the last tile in the message and Json data
+    """
+    msg = {
+        'version': PACKED_MESSAGE_VERSION,
+        'job_id': args['job_id'],
+        'upload_queue_arn': args['upload_queue'],
+        'ingest_queue_arn': args['ingest_queue'],
+        'chunks': [],
+    }
+    size = len(json.dumps(msg))
+
+    last = None
+    for position, chunk_key, tile_start, tile_stop in _create_chunks(args, cursor):
+        chunk = [chunk_key, tile_start, tile_stop]
+        chunk_size = len(json.dumps(chunk)) + 2 # ', ' separator
+
+        if len(msg['chunks']) > 0 and size + chunk_size > PACKED_MESSAGE_BYTES:
+            yield last, json.dumps(msg)
+            msg['chunks'] = []
+            size = len(json.dumps(msg))
+
+        msg['chunks'].append(chunk)
+        size += chunk_size
+        last = position + [tile_stop - 1]
+
+    if len(msg['chunks']) > 0:
+        yield last, json.dumps(msg)
+
+def decode_message(body):
+    """Decode an upload queue message into individual tile messages
+
+    Messages without a version are single tile messages and are returned as is.
+
+    Args:
+        body (string): Json data of the SQS message
+
+    Returns:
+        list[dict]: List of tile messages, each containing the keys job_id,
+                    upload_queue_arn, ingest_queue_arn, chunk_key, and tile_key
+    """
+    msg = json.loads(body)
+    version = msg.get('version', 1)
+
+    if version == 1:
+        return [msg]
+    elif version == PACKED_MESSAGE_VERSION:
+        return [{
+            'job_id': msg['job_id'],
+            'upload_queue_arn': msg['upload_queue_arn'],
+            'ingest_queue_arn': msg['ingest_queue_arn'],
+            'chunk_key': chunk_key,
+            'tile_key': tile_key,
+        } for chunk_key, tile_start, tile_stop in msg['chunks']
+          for _, tile_key in tile_keys(chunk_key, tile_start, tile_stop)]
+    else:
+        raise ValueError("Unsupported message version {}".format(version))
+
+def split_range(start, stop, step, count):
+    """Split range(start, stop, step) into at most count contiguous pieces
+
+    Every piece starts on a step boundary, so iterating over the pieces
+    produces exactly the same values as iterating over the original range.
+
+    Args:
+        start (int): Start of the range
+        stop (int): Stop of the range
+        step (int): Step size of the range
+        count (int): Maximum number of pieces to create
+
+    Returns:
+        list[(int, int)]: List of (start, stop) tuples
+    """
+    length = len(range(start, stop, step))
+    count = max(1, min(count, length))
+
+    size, extra = divmod(length, count)
+    pieces = []
+    offset = 0
+    for i in range(count):
+        piece_start = start + offset * step
+        offset += size + (1 if i < extra else 0)
+        piece_stop = stop if i == count - 1 else start + offset * step
+        pieces.append((piece_start, piece_stop))
+    return pieces
+
+def create_shards(args):
+    """Split the tile space of a populate job into disjoint shards
+
+    The T dimension is split first and if there are fewer T values than the
+    requested number of shards the Z dimension is split, on chunk boundaries,
+    to make up the difference.
+
+    Args:
+        args (dict): Same arguments as handler(), 'shard_count' is the
+                     maximum number of shards to create, up to MAX_SHARDS
+
+    Returns:
+        list[dict]: List of handler() arguments, one per shard
+    """
+    count = min(args['shard_count'], MAX_SHARDS)
+
+    ts = split_range(args['t_start'], args['t_stop'], args['t_tile_size'], count)
+    zs = split_range(args['z_start'], args['z_stop'], args['z_tile_size'],
+                     max(1, count // len(ts)))
+
+    shards = []
+    for t_start, t_stop in ts:
+        for z_start, z_stop in zs:
+            shard = args.copy()
+            shard['shard_count'] = 1
+            shard['t_start'] = t_start
+            shard['t_stop'] = t_stop
+            shard['z_start'] = z_start
+            shard['z_stop'] = z_stop
+
+            # Don't invoke a worker for shards clipped by final_z_stop
+            tiles, _ = count_messages(dict(shard, packed=False))
+            if tiles > 0:
+                shards.append(shard)
+    return shards
+
+def fan_out(args, context):
+    """Populate the upload queue by invoking a copy of this Lambda per shard
+
+    The workers are given a deadline before this Lambda's time limit, so they
+    return before it times out, and unfinished shards are returned in 'shards'
+    and invoked again by the next continuation.
+
+    Args:
+        args (dict): Same arguments as handler()
+        context (Context|None): Lambda context, used to locate the current
+                                function and to set the workers' deadline
+
+    Returns:
+        dict: The given args with 'sent', 'shards', 'finished', 'throttled',
+              'failed', and 'failures' updated. The shards to continue with
+              include any failed shards, with the cursor they reached. Shards
+              that finished are not included, so continuing doesn't send their
+              messages again.
+
+    Raises:
+        FailedShard: If shards failed in more than MAX_FAILED_INVOCATIONS
+                     invocations in a row. The Json message contains the total
+                     number of messages 'sent' and the 'shards' to continue with.
+    """
+    shards = args.get('shards')
+    if shards is None:
+        shards = [shard_state(shard) for shard in create_shards(args)]
+        print("Populating upload queue using {} shards".format(len(shards)))
+    else:
+        print("Continuing {} unfinished shards".format(len(shards)))
+
+    # Arguments shared by all of the shards
+    exclude = SHARD_KEYS + ['shards', 'sent', 'failures', 'finished', 'failed', 'throttled']
+    base = dict((k, v) for k, v in args.items() if k not in exclude)
+    base['shard_count'] = 1
+    base['sent'] = 0
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        base['deadline'] = time.time() + remaining - FAN_OUT_MARGIN
+
+    config = Config(read_timeout=LAMBDA_READ_TIMEOUT,
+                    retries={'max_attempts': 0})
+    client = boto3.client('lambda', config=config)
+
+    def invoke(shard):
+        payload = dict(base, **shard)
+        resp = client.invoke(FunctionName=context.function_name,
+                             InvocationType='RequestResponse',
+                             Payload=json.dumps(payload).encode())
+        payload = resp['Payload'].read().decode()
+        if 'FunctionError' in resp:
+            raise FailedShard(payload)
+        return json.loads(payload)
+
+    def resume(shard, ex):
+        """Get the shard to resume a failed shard from and the messages it sent"""
+        try:
+            # FailedToSendMessages contains the progress the worker made
+            error = json.loads(json.loads(str(ex))['errorMessage'])
+            return dict(shard, cursor=error['cursor'], unsent=error['unsent']), error['sent']
+        except (ValueError, KeyError, TypeError):
+            return shard, 0 # Resume from the shard's previous cursor
+
+    results, failed = [], []
+    if len(shards) > 0:
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = {executor.submit(invoke, shard): shard for shard in shards}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as ex:
+                    print("Shard failed: {}".format(ex))
+                    failed.append(resume(futures[future], ex))
+
+    sent = sum(result['sent'] for result in results) + sum(count for _, count in failed)
+    print("Shards sent {} messages".format(sent))
+
+    args = args.copy()
+    args['sent'] = args.get('sent', 0) + sent
+    args['shards'] = ([shard_state(result) for result in results if not result['finished']] +
+                      [shard for shard, _ in failed])
+
+    failures = args.get('failures', 0) + 1 if len(failed) > 0 else 0
+    if failures > MAX_FAILED_INVOCATIONS:
+        raise FailedShard(json.dumps({
+            'sent': args['sent'],
+            'shards': args['shards'],
+        }))
+
+    args['finished'] = len(args['shards']) == 0
+    args['failed'] = len(failed) > 0
+    args['failures'] = failures
+    args['throttled'] = any(result.get('throttled', False) for result in results)
+    return args
+
+def shard_state(shard):
+    """Select the arguments that differ between shards, see SHARD_KEYS
+
+    Args:
+        shard (dict): Arguments of a shard, as returned by create_shards() or
+                      a worker
+
+    Returns:
+        dict: The SHARD_KEYS of the shard
+    """
+    return dict((k, shard[k]) for k in SHARD_KEYS if shard.get(k) is not None)
@@ -14,42 +14,89 @@
 
 from __future__ import print_function
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from urllib2 import urlopen
 import json
+import time
 import boto3
 
 PROTOCOL = 'http://'
 PORT = ':8500'
 ENDPOINT = '/v1/health/node/'
+CATALOG_ENDPOINT = '/v1/health/state/any'
 
-# Yes, max number of consul instances to retrieve from Route53 _should_ be a
-# string!
+# Check modes
+#   catalog: Ask one agent for the health checks of the whole cluster and fall
+#            back to checking each node if no agent answers
+#   node: Check each node
+CATALOG_MODE = 'catalog'
+NODE_MODE = 'node'
+
+# Yes, number of consul records to retrieve per request from Route53 _should_
+# be a string!
 MAX_CONSUL_INSTANCES = '20'
 
 NORMAL_ROUTE53_WEIGHT = 1
 SICK_ROUTE53_WEIGHT = 0
 
+# Seconds to wait for a single health check
+PROBE_TIMEOUT = 10
+
+# Seconds to wait for all health checks, leaving the rest of the Lambda's
+# 30 second timeout for updating Route53 and publishing to SNS
+PROBE_DEADLINE = 20
+
+# Seconds to wait for a single catalog request and for all of the catalog
+# requests, the rest of PROBE_DEADLINE is left for checking each node
+CATALOG_TIMEOUT = 3
+CATALOG_DEADLINE = 8
+
+# Number of consecutive failed or passing health checks before a node's
+# Route53 weight is changed
+FAILURE_THRESHOLD = 3
+RECOVERY_THRESHOLD = 3
+
+# Seconds between repeated alerts for a node that keeps failing
+ALERT_INTERVAL = 60 * 60
+
+# State key holding when the last alert about finding no instances was sent,
+# never an EC2 instance ID so it is dropped once instances are found again
+NO_INSTANCES_KEY = 'no-instances'
+
+# Number of data points CloudWatch accepts in one PutMetricData call
+MAX_METRIC_DATA = 20
+
 def lambda_handler(event, context):
     """Entry point to AWS lambda function.
 
     Args:
-        event (dict): Expected keys: vpc_id, vpc_name, topic_arn
+        event (dict): Expected keys: vpc_id, vpc_name, topic_arn, state_bucket, state_key,
+                      metric_namespace
+                      Optional keys: check_mode (default: catalog)
         context (Context): Unused.
     """
     vpc_id = event['vpc_id']
     vpc_name = event['vpc_name']
     topic_arn = event['topic_arn']
+    state_bucket = event['state_bucket']
+    state_key = event['state_key']
+    metric_namespace = event['metric_namespace']
+    check_mode = event.get('check_mode', CATALOG_MODE)
 
     sns_client = boto3.client('sns')
     route53_client = boto3.client('route53')
+    s3_client = boto3.client('s3')
+    state = load_state(s3_client, state_bucket, state_key)
 
     zones = route53_client.list_hosted_zones_by_name(
         DNSName=vpc_name, MaxItems='1')
     if 'HostedZones' not in zones:
         msg = 'Invalid response from Route53 - no HostedZones!'
-        sns_publish_no_consuls(sns_client, topic_arn, msg, vpc_name)
         print(msg)
+        if record_missing(state, time.time()):
+            sns_publish_no_consuls(sns_client, topic_arn, msg, vpc_name)
+        save_state(s3_client, state_bucket, state_key, state)
         return
 
     zone_id = None
@@ -61,25 +108,27 @@ def lambda_handler(event, context):
 
     if zone_id is None:
         msg = '{} not found in Route53!'.format(vpc_name)
-        sns_publish_no_consuls(sns_client, topic_arn, msg, vpc_name)
         print(msg)
+        if record_missing(state, time.time()):
+            sns_publish_no_consuls(sns_client, topic_arn, msg, vpc_name)
+        save_state(s3_client, state_bucket, state_key, state)
         return
 
     dns_name = 'consul.' + vpc_name
 
-    hosts = route53_client.list_resource_record_sets(
-        HostedZoneId=zone_id,
-        StartRecordName=dns_name,
-        StartRecordType='CNAME',
-        MaxItems=MAX_CONSUL_INSTANCES)
+    record_sets = get_route53_records(route53_client, zone_id, dns_name)
 
-    if 'ResourceRecordSets' not in hosts or len(hosts['ResourceRecordSets']) < 1:
+    if len(record_sets) < 1:
         msg = 'Invalid response from Route53 - no ResourceRecordSets!'
-        sns_publish_no_consuls(sns_client, topic_arn, msg, vpc_name)
         print(msg)
+        if record_missing(state, time.time()):
+            sns_publish_no_consuls(sns_client, topic_arn, msg, vpc_name)
+        save_state(s3_client, state_bucket, state_key, state)
         return
 
-    for record_set in hosts['ResourceRecordSets']:
+    nodes = []
+    records = {}
+    for record_set in record_sets:
         if len(record_set['ResourceRecords']) < 1:
             print('No ResourceRecords found.')
             continue
@@ -90,37 +139,321 @@ def lambda_handler(event, context):
 
         inst_id = record_set['SetIdentifier']
         hostname = record_set['ResourceRecords'][0]['Value']
+        records[inst_id] = record_set
         try:
             ip = get_ip_from_host_name(hostname)
             node_id = get_node_id(ip)
         except:
-            print('Could not construct node id from ip: {}'.format(ip))
+            print('Could not construct node id from hostname: {}'.format(hostname))
             continue
 
         url = PROTOCOL + ip + PORT + ENDPOINT + node_id
-        print('Checking consul server {} at {}...'.format(url, str(datetime.now())))
+        nodes.append((inst_id, hostname, ip, url))
+
+    # Check all of the servers before acting on any of the results
+    start = time.time()
+    results = None
+    if check_mode == CATALOG_MODE:
+        print('Checking consul catalog at {}...'.format(str(datetime.now())))
+        checks, latency = get_catalog_checks([n[2] for n in nodes], CATALOG_DEADLINE)
+        if checks is not None:
+            results = [(node_checks(checks, get_node_id(ip)), latency)
+                       for inst_id, hostname, ip, url in nodes]
+
+    if results is None:
+        print('Checking consul servers {} at {}...'.format([n[3] for n in nodes], str(datetime.now())))
+        deadline = PROBE_DEADLINE - (time.time() - start)
+        results = probe_all([n[3] for n in nodes], deadline)
+
+    now = time.time()
+
+    updates = []
+    checks = []
+    for (inst_id, hostname, ip, url), (raw, latency) in zip(nodes, results):
+        healthy = raw is not None and validate(raw)
+        if not healthy:
+            if raw is None:
+                raw = 'Error connecting to consul HTTP endpoint.'
+
+            # Health check failed.
+            print(raw)
+
+        checks.append((inst_id, latency, healthy))
+        weight, alert = record_check(state, inst_id, healthy, now)
+        if alert:
+            # Publish failure to SNS topic.
+            sns_publish_sick(sns_client, ip, raw, topic_arn, vpc_name)
+
+        # Weight of 0 so a failing instance gets no traffic, or the default
+        # weight so a recovered instance receives traffic, normally.
+        # Only write the records whose weight actually changes
+        if weight is not None and records[inst_id].get('Weight') != weight:
+            updates.append((dns_name, hostname, inst_id, weight))
+
+    put_metrics(boto3.client('cloudwatch'), metric_namespace, 'consul', vpc_name, checks)
+
+    # Forget instances that no longer exist
+    save_state(s3_client, state_bucket, state_key,
+               dict((k, v) for k, v in state.items() if k in records))
+
+    update_route53_weights(route53_client, zone_id, updates)
+
+
+def get_route53_records(route53_client, zone_id, dns_name):
+    """Read all of the records for the given DNS name.
+
+    Args:
+        route53_client (boto3.Route53.Client): Client for interacting with Route53.
+        zone_id (string): Id of hosted zone.
+        dns_name (string): DNS name of the records.
+
+    Returns:
+        (list): Record sets, as returned by list_resource_record_sets().
+    """
+    record_sets = []
+    paginator = route53_client.get_paginator('list_resource_record_sets')
+    pages = paginator.paginate(HostedZoneId=zone_id,
+                               StartRecordName=dns_name,
+                               StartRecordType='CNAME',
+                               PaginationConfig={'PageSize': MAX_CONSUL_INSTANCES})
+    for page in pages:
+        for record_set in page['ResourceRecordSets']:
+            if not record_set['Name'].startswith(dns_name):
+                # No more records for consul.
+                return record_sets
+
+            record_sets.append(record_set)
+
+    return record_sets
 
+
+def get_catalog_checks(ips, deadline):
+    """Ask the consul agents, one at a time, for the health checks of every
+    node in the cluster.
+
+    Args:
+        ips (list): IP addresses of the consul agents.
+        deadline (int): Seconds to spend trying the agents.
+
+    Returns:
+        (tuple): Health checks from the first agent that answered (None if
+                 none did) and the latency of the request, in milliseconds.
+    """
+    end = time.time() + deadline
+    for ip in ips:
+        remaining = end - time.time()
+        if remaining <= 0:
+            break
+
+        url = PROTOCOL + ip + PORT + CATALOG_ENDPOINT
+        start = time.time()
         try:
-            raw = urlopen(url, timeout=10).read()
-        except:
-            raw = 'Error connecting to consul HTTP endpoint.'
-        else:
-            if validate(raw):
-                # Set weight in Route53 to default to ensure it receives
-                # traffic, normally.
-                update_route53_weight(
-                    route53_client, zone_id, dns_name, hostname, inst_id, NORMAL_ROUTE53_WEIGHT)
-                continue
+            checks = json.loads(urlopen(url, timeout=min(CATALOG_TIMEOUT, remaining)).read())
+            return checks, (time.time() - start) * 1000
+        except Exception as ex:
+            print('Could not get health checks from {}: {}'.format(url, ex))
+
+    return None, None
+
+
+def node_checks(checks, node_id):
+    """Select the health checks of one node from the cluster's health checks.
+
+    Args:
+        checks (list): Health checks, as returned by get_catalog_checks().
+        node_id (string): Node id as known to Consul cluster.
+
+    Returns:
+        (string): The node's health checks, in the same form as a response
+                  from ENDPOINT, or an error message if the node is not known
+                  to the cluster.
+    """
+    selected = [check for check in checks if check['Node'] == node_id]
+    if len(selected) == 0:
+        return 'Node {} not found in the consul catalog.'.format(node_id)
+    return json.dumps(selected)
+
+
+def probe(url):
+    """Request the health status from one server.
+
+    Args:
+        url (string): Health check URL.
+
+    Returns:
+        (string|None): Response body or None if the request failed.
+    """
+    try:
+        return urlopen(url, timeout=PROBE_TIMEOUT).read()
+    except:
+        return None
+
+
+def timed_probe(url):
+    """Call probe() and measure how long it took.
+
+    Args:
+        url (string): Health check URL.
+
+    Returns:
+        (tuple): probe() result and the latency, in milliseconds.
+    """
+    start = time.time()
+    result = probe(url)
+    return result, (time.time() - start) * 1000
+
+
+def probe_all(urls, deadline):
+    """Call timed_probe() for all of the given URLs concurrently.
+
+    Probes that have not finished when the deadline passes are reported as
+    failed, so one hung server cannot delay the checks of the others.
+
+    Args:
+        urls (list): Health check URLs.
+        deadline (int): Seconds to wait for all of the probes to finish.
+
+    Returns:
+        (list): timed_probe() results, in the same order as urls.
+    """
+    if len(urls) == 0:
+        return []
+
+    pool = ThreadPoolExecutor(max_workers=len(urls))
+    futures = [pool.submit(timed_probe, url) for url in urls]
+    done, _ = wait(futures, timeout=deadline)
+    pool.shutdown(wait=False)
+
+    timed_out = (None, deadline * 1000)
+    return [f.result() if f in done else timed_out for f in futures]
+
 
-        # Health check failed.
-        print(raw)
+def put_metrics(cw_client, namespace, service, vpc_name, checks):
+    """Publish the latency and status of each health check to CloudWatch.
+
+    Latency is published both per instance and for the whole service, so
+    alarms do not have to track individual instances.
+
+    Args:
+        cw_client (boto3.CloudWatch.Client): Client for interacting with CloudWatch.
+        namespace (string): CloudWatch namespace of the metrics.
+        service (string): Name of the service that was checked.
+        vpc_name (string): Name of VPC.
+        checks (list): Tuples of (inst_id, latency, healthy), with latency
+                       in milliseconds.
+    """
+    service_dims = [{'Name': 'VPC', 'Value': vpc_name},
+                    {'Name': 'Service', 'Value': service}]
+
+    data = []
+    for inst_id, latency, healthy in checks:
+        inst_dims = service_dims + [{'Name': 'InstanceId', 'Value': inst_id}]
+        data.append({'MetricName': 'ProbeLatency', 'Dimensions': service_dims,
+                     'Value': latency, 'Unit': 'Milliseconds'})
+        data.append({'MetricName': 'ProbeLatency', 'Dimensions': inst_dims,
+                     'Value': latency, 'Unit': 'Milliseconds'})
+        data.append({'MetricName': 'ProbeHealthy', 'Dimensions': inst_dims,
+                     'Value': 1 if healthy else 0, 'Unit': 'Count'})
+
+    try:
+        for i in range(0, len(data), MAX_METRIC_DATA):
+            cw_client.put_metric_data(Namespace=namespace,
+                                      MetricData=data[i:i + MAX_METRIC_DATA])
+    except Exception as ex:
+        # Metrics are informational, don't fail the health check over them
+        print('Could not publish metrics: {}'.format(ex))
+
+
+def load_state(s3_client, bucket, key):
+    """Read the per node state saved by the previous run.
+
+    Args:
+        s3_client (boto3.S3.Client): Client for interacting with S3.
+        bucket (string): S3 bucket containing the state.
+        key (string): S3 key of the state object.
+
+    Returns:
+        (dict): State keyed by EC2 instance ID, empty if there is no saved state.
+    """
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+        return json.loads(obj['Body'].read())
+    except Exception as ex:
+        print('Could not load monitor state: {}'.format(ex))
+        return {}
 
-        # Publish failure to SNS topic.
-        sns_publish_sick(sns_client, ip, raw, topic_arn, vpc_name)
 
-        # Set weight in Route53 to 0 so instance gets no traffic.
-        update_route53_weight(
-            route53_client, zone_id, dns_name, hostname, inst_id, SICK_ROUTE53_WEIGHT)
+def save_state(s3_client, bucket, key, state):
+    """Save the per node state for the next run.
+
+    Args:
+        s3_client (boto3.S3.Client): Client for interacting with S3.
+        bucket (string): S3 bucket containing the state.
+        key (string): S3 key of the state object.
+        state (dict): State keyed by EC2 instance ID.
+    """
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(state))
+
+
+def record_check(state, inst_id, healthy, now):
+    """Record a health check result and decide what to do about it.
+
+    The Route53 weight only changes after FAILURE_THRESHOLD consecutive
+    failures or RECOVERY_THRESHOLD consecutive successes, and an alert is
+    only sent once per ALERT_INTERVAL while the node keeps failing.
+
+    Args:
+        state (dict): State keyed by EC2 instance ID, updated in place.
+        inst_id (string): EC2 instance ID.
+        healthy (bool): Result of the health check.
+        now (float): Current time, in seconds since the epoch.
+
+    Returns:
+        (tuple): New Route53 weight (None to leave it alone) and whether to
+                 send an alert.
+    """
+    node = state.setdefault(inst_id, {'failures': 0, 'successes': 0, 'alerted': None})
+
+    if healthy:
+        node['failures'] = 0
+        node['successes'] += 1
+        if node['successes'] < RECOVERY_THRESHOLD:
+            return None, False
+
+        node['alerted'] = None
+        return NORMAL_ROUTE53_WEIGHT, False
+
+    node['successes'] = 0
+    node['failures'] += 1
+    if node['failures'] < FAILURE_THRESHOLD:
+        return None, False
+
+    alert = node['alerted'] is None or now - node['alerted'] >= ALERT_INTERVAL
+    if alert:
+        node['alerted'] = now
+    return SICK_ROUTE53_WEIGHT, alert
+
+
+def record_missing(state, now):
+    """Record a run that found no instances and decide whether to alert.
+
+    Like a failing node, the alert is only repeated once per ALERT_INTERVAL
+    while there are no instances.
+
+    Args:
+        state (dict): State keyed by EC2 instance ID, updated in place.
+        now (float): Current time, in seconds since the epoch.
+
+    Returns:
+        (bool): Whether to send an alert.
+    """
+    alerted = state.get(NO_INSTANCES_KEY)
+    if alerted is not None and now - alerted < ALERT_INTERVAL:
+        return False
+
+    state[NO_INSTANCES_KEY] = now
+    return True
+
 
 def get_ip_from_host_name(name):
     """Extract ip from host name.
@@ -244,30 +577,36 @@ Raw health check: {1}
     )
 
 
-def update_route53_weight(route53_client, zone_id, dns_name, private_dns_name, inst_id, weight):
-    """Change weight for given instance in Route53 (DNS).
+def update_route53_weights(route53_client, zone_id, updates):
+    """Change weights for the given instances in Route53 (DNS) in one batch.
 
     Args:
         route53_client (boto3.Route53.Client): Client for interacting with Route53.
         zone_id (string): Id of hosted zone.
-        dns_name (string): "Public" DNS name of consul instance.
-        private_dns_name (string): Internal DNS name of consul instance as known to Route53.
-        inst_id (dict): EC2 instance ID.
-        weight (int): New weight for instance.
+        updates (list): Tuples of (dns_name, private_dns_name, inst_id, weight)
+                        for the instances whose weight changed.
     """
+    if len(updates) == 0:
+        return
+
+    changes = []
+    for dns_name, private_dns_name, inst_id, weight in updates:
+        print('Setting weight of {} to {}'.format(inst_id, weight))
+        changes.append({
+            'Action': 'UPSERT',
+            'ResourceRecordSet': {
+                'Name': dns_name,
+                'Type': 'CNAME',
+                'ResourceRecords': [{'Value': private_dns_name}],
+                'TTL': 300,
+                'SetIdentifier': inst_id,
+                'Weight': weight
+            }
+        })
+
     route53_client.change_resource_record_sets(
         HostedZoneId=zone_id,
         ChangeBatch = {
-            'Changes': [{
-                'Action': 'UPSERT',
-                'ResourceRecordSet': {
-                    'Name': dns_name,
-                    'Type': 'CNAME',
-                    'ResourceRecords': [{'Value': private_dns_name}],
-                    'TTL': 300,
-                    'SetIdentifier': inst_id,
-                    'Weight': weight
-                }
-            }]
+            'Changes': changes
         }
     )
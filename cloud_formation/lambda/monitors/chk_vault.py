@@ -14,9 +14,11 @@
 
 from __future__ import print_function
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from urllib2 import urlopen, HTTPError
 import json
+import time
 import boto3
 
 PROTOCOL = 'http://'
@@ -26,16 +28,42 @@ ENDPOINT = '/v1/sys/health'
 NORMAL_ROUTE53_WEIGHT = 1
 SICK_ROUTE53_WEIGHT = 0
 
+# Seconds to wait for a single health check
+PROBE_TIMEOUT = 10
+
+# Seconds to wait for all health checks, leaving the rest of the Lambda's
+# 30 second timeout for updating Route53 and publishing to SNS
+PROBE_DEADLINE = 20
+
+# Number of consecutive failed or passing health checks before a node's
+# Route53 weight is changed
+FAILURE_THRESHOLD = 3
+RECOVERY_THRESHOLD = 3
+
+# Seconds between repeated alerts for a node that keeps failing
+ALERT_INTERVAL = 60 * 60
+
+# State key holding when the last alert about finding no instances was sent,
+# never an EC2 instance ID so it is dropped once instances are found again
+NO_INSTANCES_KEY = 'no-instances'
+
+# Number of data points CloudWatch accepts in one PutMetricData call
+MAX_METRIC_DATA = 20
+
 def lambda_handler(event, context):
     """Entry point to AWS lambda function.
 
     Args:
-        event (dict): Expected keys: vpc_id, vpc_name, topic_arn
+        event (dict): Expected keys: vpc_id, vpc_name, topic_arn, state_bucket, state_key,
+                      metric_namespace
         context (Context): Unused.
     """
     vpc_id = event['vpc_id']
     vpc_name = event['vpc_name']
     topic_arn = event['topic_arn']
+    state_bucket = event['state_bucket']
+    state_key = event['state_key']
+    metric_namespace = event['metric_namespace']
 
     ec2_client = boto3.client('ec2')
     resp = ec2_client.describe_instances(Filters=[
@@ -51,54 +79,259 @@ def lambda_handler(event, context):
 
     sns_client = boto3.client('sns')
     route53_client = boto3.client('route53')
+    s3_client = boto3.client('s3')
 
-    if len(resp['Reservations']) == 0:
+    instances = [inst for reserv in resp['Reservations'] for inst in reserv['Instances']]
+    if len(instances) == 0:
         print('No vault instances found!')
-        sns_publish_no_vaults(sns_client, topic_arn, vpc_name)
-
-    for reserv in resp['Reservations']:
-
-        for inst in reserv['Instances']:
-            ip = inst['PrivateIpAddress']
-            url = PROTOCOL + ip + PORT + ENDPOINT
-            print('Checking vault server {} at {}...'.format(url, str(datetime.now())))
-
-            try:
-                raw = urlopen(url, timeout=10).read()
-            except HTTPError as err:
-                if err.getcode() == 500:
-                    # Vault returns a status code of 500 if sealed or not
-                    # initialized.
-                    raw = 'Vault sealed or uninitialized.'
-                elif err.getcode() == 429:
-                    # Vault returns 429 if it's unsealed and in standby mode.
-                    # This is not an error condition.
-                    print('Unsealed and in standby mode.')
-                    update_route53_weight(
-                        route53_client, vpc_name, inst, NORMAL_ROUTE53_WEIGHT)
-                    continue
-                else:
-                    raw = 'Status code: {}, reason: {}'.format(
-                        err.getcode(), err.reason)
-            except:
-                raw = 'Unknown error.'
-            else:
-                if validate(raw):
-                    # Set weight in Route53 to default to ensure it receives
-                    # traffic, normally.
-                    update_route53_weight(
-                        route53_client, vpc_name, inst, NORMAL_ROUTE53_WEIGHT)
-                    continue
-
+        state = load_state(s3_client, state_bucket, state_key)
+        if record_missing(state, time.time()):
+            sns_publish_no_vaults(sns_client, topic_arn, vpc_name)
+        save_state(s3_client, state_bucket, state_key, state)
+        return
+
+    urls = [PROTOCOL + inst['PrivateIpAddress'] + PORT + ENDPOINT for inst in instances]
+    print('Checking vault servers {} at {}...'.format(urls, str(datetime.now())))
+
+    # Check all of the servers before acting on any of the results
+    results = probe_all(urls, PROBE_DEADLINE)
+
+    state = load_state(s3_client, state_bucket, state_key)
+    now = time.time()
+
+    weights = []
+    checks = []
+    for inst, ((code, raw), latency) in zip(instances, results):
+        healthy = False
+        if code == 200:
+            healthy = validate(raw)
+        elif code == 500:
+            # Vault returns a status code of 500 if sealed or not
+            # initialized.
+            raw = 'Vault sealed or uninitialized.'
+        elif code == 429:
+            # Vault returns 429 if it's unsealed and in standby mode.
+            # This is not an error condition.
+            print('Unsealed and in standby mode.')
+            healthy = True
+
+        if not healthy:
             # Health check failed.
             print(raw)
 
+        checks.append((inst['InstanceId'], latency, healthy))
+        weight, alert = record_check(state, inst['InstanceId'], healthy, now)
+        if alert:
             # Publish failure to SNS topic.
             sns_publish_sealed(sns_client, inst, raw, topic_arn, vpc_name)
 
-            # Set weight in Route53 to 0 so instance gets no traffic.
-            update_route53_weight(
-                route53_client, vpc_name, inst, SICK_ROUTE53_WEIGHT)
+        if weight is not None:
+            # Weight of 0 so a failing instance gets no traffic, or the
+            # default weight so a recovered instance receives traffic, normally.
+            weights.append((inst, weight))
+
+    put_metrics(boto3.client('cloudwatch'), metric_namespace, 'vault', vpc_name, checks)
+
+    # Forget instances that no longer exist
+    instance_ids = set(inst['InstanceId'] for inst in instances)
+    save_state(s3_client, state_bucket, state_key,
+               dict((k, v) for k, v in state.items() if k in instance_ids))
+
+    zones_resp = route53_client.list_hosted_zones_by_name(
+        DNSName=vpc_name, MaxItems='1')
+    zone_id = zones_resp['HostedZones'][0]['Id'].split('/')[-1]
+
+    records = {}
+    updates = []
+    for inst, weight in weights:
+        dns_name = find_name(inst['Tags'])
+        if dns_name not in records:
+            records[dns_name] = get_route53_records(route53_client, zone_id, dns_name)
+
+        current = records[dns_name].get(inst['InstanceId'])
+        if current is not None and current.get('Weight') == weight:
+            continue
+
+        updates.append((dns_name, inst['PrivateDnsName'], inst['InstanceId'], weight))
+
+    update_route53_weights(route53_client, zone_id, updates)
+
+def probe(url):
+    """Request the health status from one server.
+
+    Args:
+        url (string): Health check URL.
+
+    Returns:
+        (tuple): HTTP status code (None if the request failed) and the
+                 response body or error message.
+    """
+    try:
+        return 200, urlopen(url, timeout=PROBE_TIMEOUT).read()
+    except HTTPError as err:
+        return err.getcode(), 'Status code: {}, reason: {}'.format(
+            err.getcode(), err.reason)
+    except:
+        return None, 'Unknown error.'
+
+def timed_probe(url):
+    """Call probe() and measure how long it took.
+
+    Args:
+        url (string): Health check URL.
+
+    Returns:
+        (tuple): probe() result and the latency, in milliseconds.
+    """
+    start = time.time()
+    result = probe(url)
+    return result, (time.time() - start) * 1000
+
+def probe_all(urls, deadline):
+    """Call timed_probe() for all of the given URLs concurrently.
+
+    Probes that have not finished when the deadline passes are reported as
+    failed, so one hung server cannot delay the checks of the others.
+
+    Args:
+        urls (list): Health check URLs.
+        deadline (int): Seconds to wait for all of the probes to finish.
+
+    Returns:
+        (list): timed_probe() results, in the same order as urls.
+    """
+    if len(urls) == 0:
+        return []
+
+    pool = ThreadPoolExecutor(max_workers=len(urls))
+    futures = [pool.submit(timed_probe, url) for url in urls]
+    done, _ = wait(futures, timeout=deadline)
+    pool.shutdown(wait=False)
+
+    timed_out = ((None, 'Health check timed out.'), deadline * 1000)
+    return [f.result() if f in done else timed_out for f in futures]
+
+def put_metrics(cw_client, namespace, service, vpc_name, checks):
+    """Publish the latency and status of each health check to CloudWatch.
+
+    Latency is published both per instance and for the whole service, so
+    alarms do not have to track individual instances.
+
+    Args:
+        cw_client (boto3.CloudWatch.Client): Client for interacting with CloudWatch.
+        namespace (string): CloudWatch namespace of the metrics.
+        service (string): Name of the service that was checked.
+        vpc_name (string): Name of VPC.
+        checks (list): Tuples of (inst_id, latency, healthy), with latency
+                       in milliseconds.
+    """
+    service_dims = [{'Name': 'VPC', 'Value': vpc_name},
+                    {'Name': 'Service', 'Value': service}]
+
+    data = []
+    for inst_id, latency, healthy in checks:
+        inst_dims = service_dims + [{'Name': 'InstanceId', 'Value': inst_id}]
+        data.append({'MetricName': 'ProbeLatency', 'Dimensions': service_dims,
+                     'Value': latency, 'Unit': 'Milliseconds'})
+        data.append({'MetricName': 'ProbeLatency', 'Dimensions': inst_dims,
+                     'Value': latency, 'Unit': 'Milliseconds'})
+        data.append({'MetricName': 'ProbeHealthy', 'Dimensions': inst_dims,
+                     'Value': 1 if healthy else 0, 'Unit': 'Count'})
+
+    try:
+        for i in range(0, len(data), MAX_METRIC_DATA):
+            cw_client.put_metric_data(Namespace=namespace,
+                                      MetricData=data[i:i + MAX_METRIC_DATA])
+    except Exception as ex:
+        # Metrics are informational, don't fail the health check over them
+        print('Could not publish metrics: {}'.format(ex))
+
+def load_state(s3_client, bucket, key):
+    """Read the per node state saved by the previous run.
+
+    Args:
+        s3_client (boto3.S3.Client): Client for interacting with S3.
+        bucket (string): S3 bucket containing the state.
+        key (string): S3 key of the state object.
+
+    Returns:
+        (dict): State keyed by EC2 instance ID, empty if there is no saved state.
+    """
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+        return json.loads(obj['Body'].read())
+    except Exception as ex:
+        print('Could not load monitor state: {}'.format(ex))
+        return {}
+
+def save_state(s3_client, bucket, key, state):
+    """Save the per node state for the next run.
+
+    Args:
+        s3_client (boto3.S3.Client): Client for interacting with S3.
+        bucket (string): S3 bucket containing the state.
+        key (string): S3 key of the state object.
+        state (dict): State keyed by EC2 instance ID.
+    """
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(state))
+
+def record_check(state, inst_id, healthy, now):
+    """Record a health check result and decide what to do about it.
+
+    The Route53 weight only changes after FAILURE_THRESHOLD consecutive
+    failures or RECOVERY_THRESHOLD consecutive successes, and an alert is
+    only sent once per ALERT_INTERVAL while the node keeps failing.
+
+    Args:
+        state (dict): State keyed by EC2 instance ID, updated in place.
+        inst_id (string): EC2 instance ID.
+        healthy (bool): Result of the health check.
+        now (float): Current time, in seconds since the epoch.
+
+    Returns:
+        (tuple): New Route53 weight (None to leave it alone) and whether to
+                 send an alert.
+    """
+    node = state.setdefault(inst_id, {'failures': 0, 'successes': 0, 'alerted': None})
+
+    if healthy:
+        node['failures'] = 0
+        node['successes'] += 1
+        if node['successes'] < RECOVERY_THRESHOLD:
+            return None, False
+
+        node['alerted'] = None
+        return NORMAL_ROUTE53_WEIGHT, False
+
+    node['successes'] = 0
+    node['failures'] += 1
+    if node['failures'] < FAILURE_THRESHOLD:
+        return None, False
+
+    alert = node['alerted'] is None or now - node['alerted'] >= ALERT_INTERVAL
+    if alert:
+        node['alerted'] = now
+    return SICK_ROUTE53_WEIGHT, alert
+
+def record_missing(state, now):
+    """Record a run that found no instances and decide whether to alert.
+
+    Like a failing node, the alert is only repeated once per ALERT_INTERVAL
+    while there are no instances.
+
+    Args:
+        state (dict): State keyed by EC2 instance ID, updated in place.
+        now (float): Current time, in seconds since the epoch.
+
+    Returns:
+        (bool): Whether to send an alert.
+    """
+    alerted = state.get(NO_INSTANCES_KEY)
+    if alerted is not None and now - alerted < ALERT_INTERVAL:
+        return False
+
+    state[NO_INSTANCES_KEY] = now
+    return True
 
 def validate(resp):
     """Check health status response from application.
@@ -194,34 +427,63 @@ Find the number of the sealed vault instance using:\r\n
 """.format(ip, raw_err, domain_name)
     )
 
-def update_route53_weight(route53_client, vpc_name, inst_data, weight):
-    """Change weight for given instance in Route53 (DNS).
+def get_route53_records(route53_client, zone_id, dns_name):
+    """Read the weighted records for the given DNS name.
 
     Args:
         route53_client (boto3.Route53.Client): Client for interacting with Route53.
-        vpc_name: Name of VPC instance runs in.
-        inst_data (dict): Instance info as returned by describe_instances().
-        weight (int): New weight for instance.
+        zone_id (string): Id of hosted zone.
+        dns_name (string): DNS name of the records.
+
+    Returns:
+        (dict): Records keyed by SetIdentifier (EC2 instance ID).
     """
-    zones_resp = route53_client.list_hosted_zones_by_name(
-        DNSName=vpc_name, MaxItems='1')
-    zone_id = zones_resp['HostedZones'][0]['Id'].split('/')[-1]
-    inst_id = inst_data['InstanceId']
-    dns_name = find_name(inst_data['Tags'])
-    private_dns_name = inst_data['PrivateDnsName']
+    records = {}
+    paginator = route53_client.get_paginator('list_resource_record_sets')
+    pages = paginator.paginate(HostedZoneId=zone_id,
+                               StartRecordName=dns_name,
+                               StartRecordType='CNAME')
+    for page in pages:
+        for record in page['ResourceRecordSets']:
+            # Route53 ends the name with a trailing period.
+            if record['Name'].rstrip('.') != dns_name.rstrip('.'):
+                return records
+
+            if 'SetIdentifier' in record:
+                records[record['SetIdentifier']] = record
+
+    return records
+
+def update_route53_weights(route53_client, zone_id, updates):
+    """Change weights for the given instances in Route53 (DNS) in one batch.
+
+    Args:
+        route53_client (boto3.Route53.Client): Client for interacting with Route53.
+        zone_id (string): Id of hosted zone.
+        updates (list): Tuples of (dns_name, private_dns_name, inst_id, weight)
+                        for the instances whose weight changed.
+    """
+    if len(updates) == 0:
+        return
+
+    changes = []
+    for dns_name, private_dns_name, inst_id, weight in updates:
+        print('Setting weight of {} to {}'.format(inst_id, weight))
+        changes.append({
+            'Action': 'UPSERT',
+            'ResourceRecordSet': {
+                'Name': dns_name,
+                'Type': 'CNAME',
+                'ResourceRecords': [{'Value': private_dns_name}],
+                'TTL': 300,
+                'SetIdentifier': inst_id,
+                'Weight': weight
+            }
+        })
+
     route53_client.change_resource_record_sets(
         HostedZoneId=zone_id,
         ChangeBatch = {
-            'Changes': [{
-                'Action': 'UPSERT',
-                'ResourceRecordSet': {
-                    'Name': dns_name,
-                    'Type': 'CNAME',
-                    'ResourceRecords': [{'Value': private_dns_name}],
-                    'TTL': 300,
-                    'SetIdentifier': inst_id,
-                    'Weight': weight
-                }
-            }]
+            'Changes': changes
         }
     )
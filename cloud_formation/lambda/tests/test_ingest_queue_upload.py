@@ -0,0 +1,381 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+import os, sys
+import io
+import time
+import threading
+import json
+import hashlib
+
+# Allow unit test files to import the target Lambda
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+lambda_dir = os.path.normpath(os.path.join(cur_dir, '..', 'ingest_populate'))
+sys.path.append(lambda_dir)
+
+import ingest_queue_upload as iqu
+
+
+# DP NOTE: generic version of
+# BossBackend.encode_chunk_key and BossBackend.encode.tile_key
+# from ingest-client/ingestclient/core/backend.py
+# The Lambda builds the same keys from reused prefixes, this is the reference
+def hashed_key(*args):
+    base = '&'.join(map(str,args))
+
+    md5 = hashlib.md5()
+    md5.update(base.encode())
+    digest = md5.hexdigest()
+
+    return '&'.join([digest, base])
+
+def job(**kwargs):
+    """Create the arguments of a small upload queue job"""
+    args = {
+        'job_id': 7,
+        'upload_queue': 'https://sqs.us-east-1.amazonaws.com/123/upload',
+        'ingest_queue': 'https://sqs.us-east-1.amazonaws.com/123/ingest',
+        'resolution': 0,
+        'project_info': [1, 2, 3],
+        't_start': 0, 't_stop': 2, 't_tile_size': 1,
+        'x_start': 0, 'x_stop': 2048, 'x_tile_size': 1024,
+        'y_start': 0, 'y_stop': 1024, 'y_tile_size': 1024,
+        'z_start': 0, 'z_stop': 48, 'z_tile_size': 16,
+        'final_z_stop': 48,
+    }
+    args.update(kwargs)
+    return args
+
+# Jobs covering stops that are not a multiple of the tile size and chunks
+# clipped, or emptied, by final_z_stop
+JOBS = [
+    job(),
+    job(x_stop=2500, y_stop=1500),
+    job(x_start=1024, x_stop=3000, t_start=3, t_stop=8, t_tile_size=2),
+    job(z_stop=40, final_z_stop=37),
+    job(z_stop=48, final_z_stop=33),
+    job(z_stop=64, final_z_stop=32),
+    job(z_start=16, z_stop=64, final_z_stop=20),
+    job(z_stop=5, z_tile_size=16, final_z_stop=5),
+    job(x_stop=0),
+]
+
+
+class TestCountMessages(unittest.TestCase):
+    def test_matches_messages(self):
+        for args in JOBS:
+            with self.subTest(args=args):
+                tiles, chunks = iqu.count_messages(args)
+                self.assertEqual(tiles, len(list(iqu.create_messages(args))))
+                self.assertEqual(chunks, len(list(iqu._create_chunks(args))))
+
+    def test_packed(self):
+        with self.assertRaises(ValueError):
+            iqu.count_messages(job(packed=True))
+
+
+class TestCreateMessages(unittest.TestCase):
+    def test_keys(self):
+        msg = json.loads(next(iqu.create_messages(job())))
+
+        self.assertEqual(msg['job_id'], 7)
+        self.assertEqual(msg['chunk_key'].split('&')[1:], ['16', '1', '2', '3', '0', '0', '0', '0', '0'])
+        self.assertEqual(msg['tile_key'].split('&')[1:], ['1', '2', '3', '0', '0', '0', '0', '0'])
+
+    def test_reference_keys(self):
+        for args in JOBS:
+            with self.subTest(args=args):
+                project = args['project_info'] + [args['resolution']]
+                for (t, z, y, x, tile), msg in iqu._create_messages(args):
+                    msg = json.loads(msg)
+                    x_idx = x // args['x_tile_size']
+                    y_idx = y // args['y_tile_size']
+                    z_idx = z // args['z_tile_size']
+                    num_of_tiles = min(args['z_tile_size'], args['final_z_stop'] - z)
+
+                    self.assertEqual(msg['chunk_key'],
+                                     hashed_key(num_of_tiles, *project, x_idx, y_idx, z_idx, t))
+                    self.assertEqual(msg['tile_key'],
+                                     hashed_key(*project, x_idx, y_idx, tile, t))
+
+    def test_resume(self):
+        for args in JOBS:
+            msgs = list(iqu._create_messages(args))
+            for i in range(0, len(msgs), 7):
+                with self.subTest(args=args, cursor=msgs[i][0]):
+                    self.assertEqual(list(iqu._create_messages(args, msgs[i][0])), msgs[i + 1:])
+
+    def test_resume_last(self):
+        args = job()
+        msgs = list(iqu._create_messages(args))
+        self.assertEqual(list(iqu._create_messages(args, msgs[-1][0])), [])
+
+
+class TestPackedMessages(unittest.TestCase):
+    def setUp(self):
+        # Small messages, so the jobs need several packed messages
+        self.size = iqu.PACKED_MESSAGE_BYTES
+        iqu.PACKED_MESSAGE_BYTES = 1024
+
+    def tearDown(self):
+        iqu.PACKED_MESSAGE_BYTES = self.size
+
+    def decode(self, msgs):
+        return [tile for _, msg in msgs for tile in iqu.decode_message(msg)]
+
+    def test_round_trip(self):
+        for args in JOBS:
+            with self.subTest(args=args):
+                expected = [json.loads(msg) for msg in iqu.create_messages(args)]
+                packed = list(iqu._create_packed_messages(args))
+
+                self.assertEqual(self.decode(packed), expected)
+                for _, msg in packed:
+                    self.assertLessEqual(len(msg), iqu.PACKED_MESSAGE_BYTES)
+
+    def test_resume(self):
+        args = job(x_stop=2500, y_stop=1500)
+        expected = [json.loads(msg) for _, msg in iqu._create_messages(args)]
+        packed = list(iqu._create_packed_messages(args))
+        self.assertGreater(len(packed), 2)
+
+        for i, (cursor, _) in enumerate(packed):
+            resumed = self.decode(iqu._create_packed_messages(args, cursor))
+            sent = len(self.decode(packed[:i + 1]))
+            self.assertEqual(resumed, expected[sent:])
+
+    def test_single_tile_message(self):
+        msg = next(iqu.create_messages(job()))
+        self.assertEqual(iqu.decode_message(msg), [json.loads(msg)])
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ValueError):
+            iqu.decode_message(json.dumps({'version': 99}))
+
+
+class TestShards(unittest.TestCase):
+    def test_split_range(self):
+        for start, stop, step, count in [(0, 10, 1, 3), (0, 48, 16, 2), (3, 8, 2, 5), (0, 5, 16, 4)]:
+            with self.subTest(range=(start, stop, step), count=count):
+                pieces = iqu.split_range(start, stop, step, count)
+                self.assertLessEqual(len(pieces), count)
+                values = [v for piece_start, piece_stop in pieces
+                            for v in range(piece_start, piece_stop, step)]
+                self.assertEqual(values, list(range(start, stop, step)))
+
+    def test_cover_all_messages(self):
+        for args in JOBS:
+            expected = sorted(iqu.create_messages(args))
+            for count in [2, 3, 5, 16]:
+                with self.subTest(args=args, shard_count=count):
+                    shards = iqu.create_shards(dict(args, shard_count=count))
+                    self.assertLessEqual(len(shards), count)
+
+                    msgs = [msg for shard in shards for msg in iqu.create_messages(shard)]
+                    self.assertEqual(sorted(msgs), expected)
+                    for shard in shards:
+                        self.assertEqual(shard['shard_count'], 1)
+
+
+class TestTimeBudget(unittest.TestCase):
+    def test_batch_fits_in_margin(self):
+        backoff = sum(min(iqu.SQS_RETRY_TIMEOUT, iqu.SQS_RETRY_BASE * 2 ** attempt)
+                      for attempt in range(1, iqu.SQS_RETRY_COUNT))
+        requests = iqu.SQS_RETRY_COUNT * (iqu.SQS_CONNECT_TIMEOUT + iqu.SQS_READ_TIMEOUT)
+        self.assertLess((backoff + requests) * 1000, iqu.LAMBDA_TIME_MARGIN)
+
+
+class FakeSQS(object):
+    """Stand-in for the SQS client that fails to send the given messages
+
+    Args:
+        broken (set): Message bodies that fail to send
+    """
+    def __init__(self, broken=()):
+        self.broken = set(broken)
+        self.lock = threading.Lock()
+        self.received = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        for entry in Entries:
+            if entry['MessageBody'] in self.broken:
+                failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+            else:
+                successful.append({'Id': entry['Id']})
+                with self.lock:
+                    self.received.append(entry['MessageBody'])
+        return {'Successful': successful, 'Failed': failed}
+
+
+class TestHandler(unittest.TestCase):
+    def setUp(self):
+        self.sqs = FakeSQS()
+        for patcher in [mock.patch.object(iqu.boto3, 'client', return_value=self.sqs),
+                        mock.patch.object(iqu.time, 'sleep')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_job(self, args, broken, invocations=1):
+        """Run the handler with the broken messages failing for the given
+        number of invocations and then to completion"""
+        self.sqs.broken = set(broken)
+        result = args
+        for _ in range(invocations):
+            result = iqu.handler(result, None)
+            self.assertTrue(result['failed'])
+            self.assertFalse(result['finished'])
+            self.assertGreater(len(result['unsent']), 0)
+
+        self.sqs.broken = set()
+        while not result['finished']:
+            result = iqu.handler(result, None)
+        return result
+
+    def test_send(self):
+        args = job(x_stop=2500, y_stop=1500)
+        result = iqu.handler(args, None)
+
+        self.assertTrue(result['finished'])
+        self.assertEqual(result['unsent'], [])
+        self.assertEqual(result['sent'], iqu.count_messages(args)[0])
+        self.assertEqual(self.sqs.received, list(iqu.create_messages(args)))
+
+    def test_resend_unsent(self):
+        args = job(x_stop=2500, y_stop=1500)
+        expected = list(iqu.create_messages(args))
+
+        for broken in [expected[:1], expected[5:25], expected[100:101] + expected[150:153], expected[-1:]]:
+            with self.subTest(broken=len(broken)):
+                self.sqs.received = []
+                result = self.run_job(args, broken, invocations=2)
+
+                # Every message is sent exactly once
+                self.assertEqual(sorted(self.sqs.received), sorted(expected))
+                self.assertEqual(result['sent'], len(expected))
+
+    def test_resend_packed(self):
+        args = job(x_stop=2500, y_stop=1500, packed=True)
+        with mock.patch.object(iqu, 'PACKED_MESSAGE_BYTES', 1024):
+            expected = [msg for _, msg in iqu._create_packed_messages(args)]
+            self.run_job(args, expected[2:4] + expected[-1:])
+
+        tiles = [tile for msg in self.sqs.received for tile in iqu.decode_message(msg)]
+        self.assertEqual(sorted(tiles, key=json.dumps),
+                         sorted((json.loads(msg) for msg in iqu.create_messages(args)), key=json.dumps))
+
+    def test_too_many_failures(self):
+        args = job()
+        broken = list(iqu.create_messages(args))[3:4]
+        self.sqs.broken = set(broken)
+
+        for _ in range(iqu.MAX_FAILED_INVOCATIONS):
+            args = iqu.handler(args, None)
+
+        with self.assertRaises(iqu.FailedToSendMessages) as ctx:
+            iqu.handler(args, None)
+
+        error = json.loads(str(ctx.exception))
+        self.assertEqual(len(error['unsent']), 1)
+        self.assertEqual(error['sent'], iqu.count_messages(job())[0] - 1)
+
+
+class FakeLambda(object):
+    """Stand-in for the Lambda client that runs the invoked handler in process
+
+    Args:
+        broken (set): Indexes of the invocations that fail
+    """
+    def __init__(self, broken=()):
+        self.broken = set(broken)
+        self.lock = threading.Lock()
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        args = json.loads(Payload.decode())
+        with self.lock:
+            index = len(self.payloads)
+            self.payloads.append(args)
+
+        if index in self.broken:
+            error = {'errorMessage': 'Task timed out'}
+            return {'FunctionError': 'Unhandled', 'Payload': io.BytesIO(json.dumps(error).encode())}
+
+        result = iqu.handler(args, None)
+        return {'Payload': io.BytesIO(json.dumps(result).encode())}
+
+
+class FakeContext(object):
+    function_name = 'IngestUpload'
+
+    def __init__(self, remaining):
+        self.end = time.time() + remaining / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.end - time.time()) * 1000)
+
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.sqs = FakeSQS()
+        self.lambda_ = FakeLambda()
+        clients = {'sqs': self.sqs, 'lambda': self.lambda_}
+        for patcher in [mock.patch.object(iqu.boto3, 'client', side_effect=lambda service, **kwargs: clients[service]),
+                        mock.patch.object(iqu.time, 'sleep')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_out_of_time(self):
+        self.assertFalse(iqu.out_of_time(None))
+        self.assertTrue(iqu.out_of_time(FakeContext(30 * 1000)))
+        self.assertTrue(iqu.out_of_time(None, time.time() + 30))
+        self.assertTrue(iqu.out_of_time(FakeContext(300 * 1000), time.time() + 30))
+        self.assertFalse(iqu.out_of_time(FakeContext(300 * 1000), time.time() + 100))
+
+    def test_deadline(self):
+        context = FakeContext(300 * 1000)
+        result = iqu.handler(job(shard_count=4), context)
+
+        self.assertTrue(result['finished'])
+        for payload in self.lambda_.payloads:
+            self.assertLessEqual(payload['deadline'], context.end - iqu.FAN_OUT_MARGIN)
+            self.assertGreater(payload['deadline'], context.end - iqu.FAN_OUT_MARGIN - 5)
+
+    def test_failed_shard(self):
+        args = job(x_stop=2500, y_stop=1500, shard_count=4)
+        self.lambda_.broken = {1}
+
+        result = iqu.handler(args, FakeContext(300 * 1000))
+        self.assertTrue(result['failed'])
+        self.assertEqual(len(result['shards']), 1)
+
+        while not result['finished']:
+            result = iqu.handler(result, FakeContext(300 * 1000))
+
+        # The failed shard started over, the others were not sent again
+        self.assertEqual(sorted(self.sqs.received), sorted(iqu.create_messages(args)))
+        self.assertEqual(result['sent'], len(self.sqs.received))
+
+    def test_continuation_size(self):
+        args = job(x_stop=10 * 1024, y_stop=10 * 1024, t_stop=100, shard_count=1000)
+
+        # The workers' deadline has already passed, so every shard is unfinished
+        result = iqu.handler(args, FakeContext(iqu.FAN_OUT_MARGIN * 1000))
+
+        self.assertEqual(len(result['shards']), iqu.MAX_SHARDS)
+        for shard in result['shards']:
+            self.assertEqual(sorted(shard), sorted(k for k in iqu.SHARD_KEYS if k != 'cursor'))
+        self.assertLess(len(json.dumps(result)), 32 * 1024)
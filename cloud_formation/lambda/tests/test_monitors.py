@@ -0,0 +1,354 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+import os, sys
+import io
+import json
+
+# Allow unit test files to import the target Lambdas
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+lambda_dir = os.path.normpath(os.path.join(cur_dir, '..', 'monitors'))
+sys.path.append(lambda_dir)
+
+try:
+    import urllib2
+except ImportError:
+    # The monitors run on Python 2, give them urllib2's names from urllib
+    import types
+    import urllib.request, urllib.error
+    urllib2 = types.ModuleType('urllib2')
+    urllib2.urlopen = urllib.request.urlopen
+    urllib2.HTTPError = urllib.error.HTTPError
+    sys.modules['urllib2'] = urllib2
+
+import chk_consul
+import chk_vault
+
+
+EVENT = {
+    'vpc_id': 'vpc-1234',
+    'vpc_name': 'test.boss',
+    'topic_arn': 'arn:aws:sns:us-east-1:123456789012:alerts',
+    'state_bucket': 'bucket',
+    'state_key': 'monitor.json',
+    'metric_namespace': 'BOSS',
+}
+
+VAULT_HEALTHY = (200, json.dumps({'initialized': True, 'sealed': False}))
+VAULT_SEALED = (500, 'Status code: 500, reason: Internal Server Error')
+
+def consul_response(node_id, status):
+    return json.dumps([{'Node': node_id, 'CheckID': 'serfHealth', 'Status': status}])
+
+def record(name, instance_id, hostname, weight):
+    return {
+        'Name': name + '.',
+        'Type': 'CNAME',
+        'ResourceRecords': [{'Value': hostname}],
+        'TTL': 300,
+        'SetIdentifier': instance_id,
+        'Weight': weight,
+    }
+
+
+class FakeS3(object):
+    """S3 client holding the monitor's saved state"""
+    def __init__(self, state=None):
+        self.state = state
+
+    def get_object(self, Bucket, Key):
+        if self.state is None:
+            raise Exception('NoSuchKey')
+        return {'Body': io.BytesIO(json.dumps(self.state).encode())}
+
+    def put_object(self, Bucket, Key, Body):
+        self.state = json.loads(Body)
+
+class MonitorTestCase(unittest.TestCase):
+    """Runs a monitor's lambda_handler() against mock AWS clients, with the
+    health checks answered by the given results"""
+    monitor = None
+
+    def setUp(self):
+        # Silence the Lambda's progress messages
+        patcher = mock.patch('sys.stdout')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.s3 = FakeS3()
+        self.sns = mock.MagicMock()
+        self.route53 = mock.MagicMock()
+        self.ec2 = mock.MagicMock()
+        clients = {
+            's3': self.s3,
+            'sns': self.sns,
+            'route53': self.route53,
+            'ec2': self.ec2,
+            'cloudwatch': mock.MagicMock(),
+        }
+
+        patcher = mock.patch.object(self.monitor.boto3, 'client', side_effect=lambda name: clients[name])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.now = 1000000.0
+        patcher = mock.patch.object(self.monitor.time, 'time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_records(self, records):
+        """Set the records listed for any name"""
+        paginate = self.route53.get_paginator.return_value.paginate
+        paginate.return_value = [{'ResourceRecordSets': records}]
+
+    def run_checks(self, results, event={}):
+        with mock.patch.object(self.monitor, 'probe_all', return_value=results):
+            self.monitor.lambda_handler(dict(EVENT, **event), None)
+
+    def weight_changes(self):
+        """(SetIdentifier, Weight) of every record changed, per call"""
+        return [[(c['ResourceRecordSet']['SetIdentifier'], c['ResourceRecordSet']['Weight'])
+                 for c in call[1]['ChangeBatch']['Changes']]
+                for call in self.route53.change_resource_record_sets.call_args_list]
+
+class VaultTestCase(MonitorTestCase):
+    monitor = chk_vault
+
+    def setUp(self):
+        super(VaultTestCase, self).setUp()
+
+        self.instances = [{
+            'InstanceId': 'i-{}'.format(i),
+            'PrivateIpAddress': '10.0.1.{}'.format(i),
+            'PrivateDnsName': 'ip-10-0-1-{}.ec2.internal'.format(i),
+            'Tags': [{'Key': 'Name', 'Value': 'vault.test.boss'}],
+        } for i in range(1, 4)]
+        self.ec2.describe_instances.return_value = {'Reservations': [{'Instances': self.instances}]}
+        self.route53.list_hosted_zones_by_name.return_value = {
+            'HostedZones': [{'Name': 'test.boss.', 'Id': '/hostedzone/Z1'}]}
+
+    def set_weights(self, *weights):
+        self.set_records([record('vault.test.boss', inst['InstanceId'], inst['PrivateDnsName'], weight)
+                          for inst, weight in zip(self.instances, weights)])
+
+class TestVaultWeights(VaultTestCase):
+    def test_unchanged(self):
+        self.set_weights(1, 1, 1)
+        self.s3.state = dict((inst['InstanceId'], {'failures': 0, 'successes': chk_vault.RECOVERY_THRESHOLD,
+                                                   'alerted': None})
+                             for inst in self.instances)
+        self.run_checks([(VAULT_HEALTHY, 5.0)] * 3)
+
+        self.route53.change_resource_record_sets.assert_not_called()
+
+        # The records for the name are only read once per run
+        paginate = self.route53.get_paginator.return_value.paginate
+        self.assertEqual(paginate.call_count, 1)
+
+    def test_changed(self):
+        self.set_weights(1, 0, 0)
+        self.s3.state = {'i-1': {'failures': chk_vault.FAILURE_THRESHOLD - 1, 'successes': 0, 'alerted': None},
+                         'i-2': {'failures': 0, 'successes': chk_vault.RECOVERY_THRESHOLD - 1, 'alerted': None},
+                         'i-3': {'failures': chk_vault.FAILURE_THRESHOLD, 'successes': 0, 'alerted': self.now}}
+        self.run_checks([(VAULT_SEALED, 5.0), (VAULT_HEALTHY, 5.0), (VAULT_SEALED, 5.0)])
+
+        # i-3 is already out of rotation, so only the other two are written,
+        # in one batch
+        self.assertEqual(self.weight_changes(), [[('i-1', 0), ('i-2', 1)]])
+
+        change = self.route53.change_resource_record_sets.call_args[1]
+        self.assertEqual(change['HostedZoneId'], 'Z1')
+        self.assertEqual(change['ChangeBatch']['Changes'][0]['ResourceRecordSet']['ResourceRecords'],
+                         [{'Value': 'ip-10-0-1-1.ec2.internal'}])
+
+    def test_missing_record(self):
+        self.set_weights(0, 0)
+        self.s3.state = {'i-3': {'failures': 0, 'successes': chk_vault.RECOVERY_THRESHOLD - 1, 'alerted': None}}
+        self.run_checks([(VAULT_HEALTHY, 5.0)] * 3)
+
+        self.assertEqual(self.weight_changes(), [[('i-3', 1)]])
+
+class ConsulTestCase(MonitorTestCase):
+    monitor = chk_consul
+
+    def setUp(self):
+        super(ConsulTestCase, self).setUp()
+
+        self.route53.list_hosted_zones_by_name.return_value = {
+            'HostedZones': [{'Name': 'test.boss.', 'Id': '/hostedzone/Z1'}]}
+
+    def set_weights(self, *weights):
+        self.set_records([record('consul.test.boss', 'i-{}'.format(i),
+                                 'ip-10-0-1-{}.ec2.internal'.format(i), weight)
+                          for i, weight in enumerate(weights, 1)])
+
+class TestConsulWeights(ConsulTestCase):
+    def test_unchanged(self):
+        self.set_weights(1, 0)
+        self.s3.state = {'i-2': {'failures': chk_consul.FAILURE_THRESHOLD, 'successes': 0, 'alerted': self.now}}
+        results = [(consul_response('11', 'passing'), 5.0),
+                   (consul_response('12', 'critical'), 5.0)]
+        for _ in range(chk_consul.RECOVERY_THRESHOLD + 1):
+            self.run_checks(results, {'check_mode': chk_consul.NODE_MODE})
+
+        self.route53.change_resource_record_sets.assert_not_called()
+
+    def test_changed(self):
+        self.set_weights(1, 0, 1)
+        self.s3.state = {'i-1': {'failures': chk_consul.FAILURE_THRESHOLD - 1, 'successes': 0, 'alerted': None},
+                         'i-2': {'failures': 0, 'successes': chk_consul.RECOVERY_THRESHOLD - 1, 'alerted': None}}
+        results = [(None, 10000.0),
+                   (consul_response('12', 'passing'), 5.0),
+                   (consul_response('13', 'passing'), 5.0)]
+        self.run_checks(results, {'check_mode': chk_consul.NODE_MODE})
+
+        self.assertEqual(self.weight_changes(), [[('i-1', 0), ('i-2', 1)]])
+
+    def test_catalog(self):
+        self.set_weights(1, 1)
+        self.s3.state = {'i-2': {'failures': chk_consul.FAILURE_THRESHOLD - 1, 'successes': 0, 'alerted': None}}
+        checks = [{'Node': '11', 'CheckID': 'serfHealth', 'Status': 'passing'},
+                  {'Node': '12', 'CheckID': 'serfHealth', 'Status': 'critical'}]
+
+        with mock.patch.object(chk_consul, 'get_catalog_checks', return_value=(checks, 5.0)) as catalog:
+            self.run_checks([])
+
+        # Both nodes are answered from the one catalog request
+        catalog.assert_called_once_with(['10.0.1.1', '10.0.1.2'], chk_consul.CATALOG_DEADLINE)
+        self.assertEqual(self.weight_changes(), [[('i-2', 0)]])
+
+class TestRecordCheck(unittest.TestCase):
+    """record_check() and record_missing() are the same in both monitors"""
+    monitors = (chk_vault, chk_consul)
+
+    def test_failure_threshold(self):
+        for monitor in self.monitors:
+            with self.subTest(monitor=monitor.__name__):
+                state = {}
+                for _ in range(monitor.FAILURE_THRESHOLD - 1):
+                    self.assertEqual(monitor.record_check(state, 'i-1', False, 0), (None, False))
+                self.assertEqual(monitor.record_check(state, 'i-1', False, 0),
+                                 (monitor.SICK_ROUTE53_WEIGHT, True))
+
+    def test_flapping(self):
+        for monitor in self.monitors:
+            with self.subTest(monitor=monitor.__name__):
+                # A single result in between restarts the count
+                state = {}
+                for _ in range(10):
+                    for healthy in [False] * (monitor.FAILURE_THRESHOLD - 1) + [True]:
+                        self.assertEqual(monitor.record_check(state, 'i-1', healthy, 0), (None, False))
+
+    def test_recovery_threshold(self):
+        for monitor in self.monitors:
+            with self.subTest(monitor=monitor.__name__):
+                state = {'i-1': {'failures': monitor.FAILURE_THRESHOLD, 'successes': 0, 'alerted': 0}}
+                for _ in range(monitor.RECOVERY_THRESHOLD - 1):
+                    self.assertEqual(monitor.record_check(state, 'i-1', True, 10), (None, False))
+                self.assertEqual(monitor.record_check(state, 'i-1', True, 10),
+                                 (monitor.NORMAL_ROUTE53_WEIGHT, False))
+
+                # Failing again after recovering alerts straight away
+                for _ in range(monitor.FAILURE_THRESHOLD):
+                    weight, alert = monitor.record_check(state, 'i-1', False, 20)
+                self.assertEqual((weight, alert), (monitor.SICK_ROUTE53_WEIGHT, True))
+
+    def test_alert_interval(self):
+        for monitor in self.monitors:
+            with self.subTest(monitor=monitor.__name__):
+                state = {}
+                alerts = []
+                for now in range(0, monitor.ALERT_INTERVAL * 2 + 1, 60):
+                    weight, alert = monitor.record_check(state, 'i-1', False, now)
+                    if alert:
+                        alerts.append(now)
+
+                first = 60 * (monitor.FAILURE_THRESHOLD - 1)
+                self.assertEqual(alerts, [first, first + monitor.ALERT_INTERVAL])
+
+    def test_nodes_independent(self):
+        for monitor in self.monitors:
+            with self.subTest(monitor=monitor.__name__):
+                state = {}
+                for _ in range(monitor.FAILURE_THRESHOLD):
+                    monitor.record_check(state, 'i-1', False, 0)
+                self.assertEqual(monitor.record_check(state, 'i-2', False, 0), (None, False))
+
+    def test_record_missing(self):
+        for monitor in self.monitors:
+            with self.subTest(monitor=monitor.__name__):
+                state = {}
+                self.assertTrue(monitor.record_missing(state, 0))
+                self.assertFalse(monitor.record_missing(state, monitor.ALERT_INTERVAL - 1))
+                self.assertTrue(monitor.record_missing(state, monitor.ALERT_INTERVAL))
+
+class TestVaultAlerts(VaultTestCase):
+    def test_alert_once(self):
+        self.set_weights(1, 1, 1)
+        results = [(VAULT_SEALED, 5.0), (VAULT_HEALTHY, 5.0), (VAULT_HEALTHY, 5.0)]
+        for _ in range(chk_vault.FAILURE_THRESHOLD + 2):
+            self.run_checks(results)
+            self.now += 60
+
+        self.assertEqual(self.sns.publish.call_count, 1)
+        self.assertIn('10.0.1.1', self.sns.publish.call_args[1]['Message'])
+
+    def test_forget_instances(self):
+        self.set_weights(1, 1, 1)
+        self.s3.state = {'i-9': {'failures': 1, 'successes': 0, 'alerted': None}}
+        self.run_checks([(VAULT_HEALTHY, 5.0)] * 3)
+
+        self.assertEqual(sorted(self.s3.state), ['i-1', 'i-2', 'i-3'])
+
+    def test_no_instances(self):
+        self.ec2.describe_instances.return_value = {'Reservations': []}
+        for _ in range(3):
+            self.run_checks([])
+            self.now += 60
+
+        self.assertEqual(self.sns.publish.call_count, 1)
+        self.assertIn(chk_vault.NO_INSTANCES_KEY, self.s3.state)
+
+        # Alerts again once ALERT_INTERVAL has passed
+        self.now += chk_vault.ALERT_INTERVAL
+        self.run_checks([])
+        self.assertEqual(self.sns.publish.call_count, 2)
+
+        # and the key is dropped once there are instances again
+        self.ec2.describe_instances.return_value = {'Reservations': [{'Instances': self.instances}]}
+        self.set_weights(1, 1, 1)
+        self.run_checks([(VAULT_HEALTHY, 5.0)] * 3)
+        self.assertNotIn(chk_vault.NO_INSTANCES_KEY, self.s3.state)
+
+class TestConsulAlerts(ConsulTestCase):
+    def test_alert_once(self):
+        self.set_weights(1, 1)
+        results = [(consul_response('11', 'critical'), 5.0),
+                   (consul_response('12', 'passing'), 5.0)]
+        for _ in range(chk_consul.FAILURE_THRESHOLD + 2):
+            self.run_checks(results, {'check_mode': chk_consul.NODE_MODE})
+            self.now += 60
+
+        self.assertEqual(self.sns.publish.call_count, 1)
+        self.assertIn('10.0.1.1', self.sns.publish.call_args[1]['Message'])
+
+    def test_no_records(self):
+        self.set_records([])
+        for _ in range(3):
+            self.run_checks([])
+            self.now += 60
+
+        self.assertEqual(self.sns.publish.call_count, 1)
@@ -0,0 +1,280 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+import os, sys
+import json
+
+from botocore.exceptions import ClientError
+
+# Allow unit test files to import the target Lambda
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+lambda_dir = os.path.normpath(os.path.join(cur_dir, '..', 'updateRoute53'))
+sys.path.append(lambda_dir)
+
+# The Lambda creates its clients when it is imported
+with mock.patch('boto3.client'):
+    import index
+
+
+SUBNETS = {'subnet-a': 'vpc-a', 'subnet-b': 'vpc-b'}
+VPCS = {'vpc-a': 'a.boss', 'vpc-b': 'b.boss'}
+ZONES = {'a.boss': 'ZA', 'b.boss': 'ZB'}
+
+
+def instance(instance_id, name, state='running'):
+    return {
+        'InstanceId': instance_id,
+        'State': {'Name': state},
+        'PrivateDnsName': '' if state == 'terminated' else instance_id + '.ec2.internal',
+        'Tags': [{'Key': 'Name', 'Value': name}],
+    }
+
+def record(instance_id, name):
+    return {
+        'Name': name + '.',
+        'Type': 'CNAME',
+        'ResourceRecords': [{'Value': instance_id + '.ec2.internal'}],
+        'TTL': 300,
+        'SetIdentifier': instance_id,
+        'Weight': 1,
+    }
+
+def notification(action, instance_id, subnet_id='subnet-a'):
+    msg = {
+        'Event': action,
+        'EC2InstanceId': instance_id,
+        'Details': {'Subnet ID': subnet_id},
+    }
+    return {'Sns': {'Message': json.dumps(msg)}}
+
+
+class FakePaginator(object):
+    def __init__(self, paginate):
+        self.paginate = paginate
+
+class FakeEC2(object):
+    """EC2 client with a fixed set of instances, supporting the
+    instance-id, tag:Name, and instance-state-name filters"""
+    def __init__(self, instances):
+        self.instances = instances
+        self.paginate_calls = []
+
+    def describe_subnets(self, SubnetIds):
+        return {'Subnets': [{'VpcId': SUBNETS[SubnetIds[0]]}]}
+
+    def describe_vpcs(self, VpcIds):
+        return {'Vpcs': [{'Tags': [{'Key': 'Name', 'Value': VPCS[VpcIds[0]]}]}]}
+
+    def get_paginator(self, name):
+        return FakePaginator(self.describe_instances)
+
+    def describe_instances(self, Filters):
+        self.paginate_calls.append(Filters)
+
+        def matches(instance, f):
+            if f['Name'] == 'instance-id':
+                return instance['InstanceId'] in f['Values']
+            if f['Name'] == 'tag:Name':
+                return index.find_name(instance['Tags']) in f['Values']
+            if f['Name'] == 'instance-state-name':
+                return instance['State']['Name'] in f['Values']
+            raise ValueError(f['Name'])
+
+        instances = [i for i in self.instances
+                     if all(matches(i, f) for f in Filters)]
+        return [{'Reservations': [{'Instances': instances}]}]
+
+class FakeRoute53(object):
+    """Route53 client with a set of records per zone, where any ChangeBatch
+    containing a change for one of the rejected instances fails"""
+    def __init__(self, records=None, rejected=()):
+        self.records = records or {}
+        self.rejected = rejected
+        self.batches = [] # (zone_id, changes) of each call
+        self.applied = [] # (zone_id, change) of each change that was applied
+        self.list_calls = 0
+
+    def list_hosted_zones_by_name(self, DNSName, MaxItems):
+        return {'HostedZones': [{'Id': '/hostedzone/' + ZONES[DNSName]}]}
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None):
+        self.list_calls += 1
+        return {'ResourceRecordSets': self.records.get(HostedZoneId, [])}
+
+    def get_paginator(self, name):
+        return FakePaginator(lambda HostedZoneId: [self.list_resource_record_sets(HostedZoneId)])
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        changes = ChangeBatch['Changes']
+        self.batches.append((HostedZoneId, changes))
+
+        for change in changes:
+            if change['ResourceRecordSet']['SetIdentifier'] in self.rejected:
+                error = {'Error': {'Code': 'InvalidChangeBatch', 'Message': 'Rejected'}}
+                raise ClientError(error, 'ChangeResourceRecordSets')
+
+        self.applied.extend((HostedZoneId, change) for change in changes)
+
+    def actions(self):
+        return sorted((zone_id, c['Action'], c['ResourceRecordSet']['SetIdentifier'])
+                      for zone_id, c in self.applied)
+
+
+class Route53TestCase(unittest.TestCase):
+    def setUp(self):
+        index.cache.clear()
+
+        # Silence the Lambda's progress messages
+        patcher = mock.patch('sys.stdout')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def clients(self, instances, records=None, rejected=()):
+        ec2 = FakeEC2(instances)
+        route53 = FakeRoute53(records, rejected)
+
+        for name, client in (('compute', ec2), ('dns', route53)):
+            patcher = mock.patch.object(index, name, client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        return ec2, route53
+
+class TestNotifications(Route53TestCase):
+    def test_grouped_by_zone(self):
+        instances = [instance('i-1', 'api.a.boss'),
+                     instance('i-2', 'api.a.boss'),
+                     instance('i-3', 'api.b.boss')]
+        ec2, route53 = self.clients(instances)
+
+        event = {'Records': [notification('autoscaling:EC2_INSTANCE_LAUNCH', 'i-1', 'subnet-a'),
+                             notification('autoscaling:EC2_INSTANCE_LAUNCH', 'i-3', 'subnet-b'),
+                             notification('autoscaling:EC2_INSTANCE_LAUNCH', 'i-2', 'subnet-a')]}
+        index.handler(event, None)
+
+        batches = sorted((zone_id, [c['ResourceRecordSet']['SetIdentifier'] for c in changes])
+                         for zone_id, changes in route53.batches)
+        self.assertEqual(batches, [('ZA', ['i-1', 'i-2']), ('ZB', ['i-3'])])
+
+        # All of the instances are described together
+        self.assertEqual(len(ec2.paginate_calls), 1)
+
+        change = route53.applied[0][1]
+        self.assertEqual(change['Action'], 'UPSERT')
+        self.assertEqual(change['ResourceRecordSet']['ResourceRecords'],
+                         [{'Value': 'i-1.ec2.internal'}])
+
+    def test_terminate(self):
+        instances = [instance('i-1', 'api.a.boss', 'terminated'),
+                     instance('i-2', 'api.a.boss', 'terminated')]
+        records = {'ZA': [record('i-1', 'api.a.boss'),
+                          record('i-2', 'api.a.boss'),
+                          record('i-3', 'api.a.boss')]}
+        ec2, route53 = self.clients(instances, records)
+
+        event = {'Records': [notification('autoscaling:EC2_INSTANCE_TERMINATE', 'i-1'),
+                             notification('autoscaling:EC2_INSTANCE_LAUNCH_ERROR', 'i-2')]}
+        index.handler(event, None)
+
+        self.assertEqual(route53.actions(), [('ZA', 'DELETE', 'i-1'), ('ZA', 'DELETE', 'i-2')])
+        self.assertEqual(len(route53.batches), 1)
+
+        # The records for a name are only listed once
+        self.assertEqual(route53.list_calls, 1)
+
+    def test_skipped_events(self):
+        ec2, route53 = self.clients([instance('i-1', 'api.a.boss')])
+
+        event = {'Records': [notification('autoscaling:TEST_NOTIFICATION', 'i-1'),
+                             notification('autoscaling:EC2_INSTANCE_LAUNCH', 'i-2'),
+                             notification('autoscaling:EC2_INSTANCE_TERMINATE', 'i-1')]}
+        index.handler(event, None)
+
+        # i-2 no longer exists and i-1 has no record to delete
+        self.assertEqual(route53.batches, [])
+
+    def test_rejected_batch(self):
+        instances = [instance('i-1', 'api.a.boss'),
+                     instance('i-2', 'api.a.boss'),
+                     instance('i-3', 'api.a.boss')]
+        ec2, route53 = self.clients(instances, rejected=['i-2'])
+
+        event = {'Records': [notification('autoscaling:EC2_INSTANCE_LAUNCH', i)
+                             for i in ('i-1', 'i-2', 'i-3')]}
+        index.handler(event, None)
+
+        # One change doesn't stop the rest of the batch from being applied
+        self.assertEqual(route53.actions(), [('ZA', 'UPSERT', 'i-1'), ('ZA', 'UPSERT', 'i-3')])
+        self.assertEqual([len(changes) for _, changes in route53.batches], [3, 1, 1, 1])
+
+    def test_max_changes(self):
+        ec2, route53 = self.clients([], rejected=['i-150'])
+
+        changes = [{'Action': 'DELETE', 'ResourceRecordSet': record('i-{}'.format(i), 'api.a.boss')}
+                   for i in range(index.MAX_CHANGES + 60)]
+        index.apply_changes('ZA', changes)
+
+        # Only the batch with the rejected change is retried one at a time
+        sizes = [len(changes) for _, changes in route53.batches]
+        self.assertEqual(sizes, [index.MAX_CHANGES, 60] + [1] * 60)
+        self.assertEqual(len(route53.applied), index.MAX_CHANGES + 59)
+
+class TestReconcile(Route53TestCase):
+    def test_stale_records(self):
+        instances = [instance('i-running', 'api.a.boss'),
+                     instance('i-stopped', 'api.a.boss', 'stopped'),
+                     instance('i-terminated', 'api.a.boss', 'terminated'),
+                     instance('i-renamed', 'other.a.boss')]
+        records = {'ZA': [record(i, 'api.a.boss')
+                          for i in ('i-running', 'i-stopped', 'i-terminated', 'i-renamed', 'i-gone')]}
+        records['ZA'].append(record('static', 'api.a.boss'))
+        ec2, route53 = self.clients(instances, records)
+
+        index.reconcile({'vpc_name': 'a.boss'}, None)
+
+        # Only records for instances confirmed to be terminated or gone are
+        # removed, stopped and renamed instances may come back
+        self.assertEqual(route53.actions(), [('ZA', 'DELETE', 'i-gone'),
+                                             ('ZA', 'DELETE', 'i-terminated')])
+
+    def test_missing_records(self):
+        instances = [instance('i-1', 'api.a.boss'),
+                     instance('i-2', 'api.a.boss'),
+                     instance('i-3', 'api.a.boss', 'pending'),
+                     instance('i-4', 'web.a.boss')]
+        ec2, route53 = self.clients(instances, {'ZA': [record('i-1', 'api.a.boss')]})
+
+        index.reconcile({'vpc_name': 'a.boss'}, None)
+
+        # i-3 isn't running yet and web.a.boss isn't managed by the Lambda
+        self.assertEqual(route53.actions(), [('ZA', 'UPSERT', 'i-2')])
+        self.assertEqual(route53.applied[0][1]['ResourceRecordSet']['Name'], 'api.a.boss')
+
+    def test_no_records(self):
+        ec2, route53 = self.clients([instance('i-1', 'api.a.boss')])
+
+        index.reconcile({'vpc_name': 'a.boss'}, None)
+
+        self.assertEqual(ec2.paginate_calls, [])
+        self.assertEqual(route53.batches, [])
+
+    def test_event(self):
+        ec2, route53 = self.clients([], {'ZB': [record('i-1', 'api.b.boss')]})
+
+        # A scheduled event, instead of SNS notifications
+        index.handler({'vpc_name': 'b.boss'}, None)
+
+        self.assertEqual(route53.actions(), [('ZB', 'DELETE', 'i-1')])
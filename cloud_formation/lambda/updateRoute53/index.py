@@ -1,8 +1,43 @@
 import json
+import time
 import boto3
+from botocore.exceptions import ClientError
 
-# NOTE: Currently only works on AutoScale notifications, if an instances is manually
-#       terminated the DNS record will not be deleted.
+# NOTE: AutoScale notifications keep the records up to date as instances launch
+#       and terminate. Records for instances that are terminated manually are
+#       cleaned up by the scheduled reconcile() sweep.
+
+# Subnet, VPC, and hosted zone lookups are cached for this long (seconds)
+CACHE_TTL = 60 * 60
+
+# Number of changes applied in one ChangeBatch
+MAX_CHANGES = 100
+
+# Module level, so the clients and cache survive across warm invocations
+compute = boto3.client('ec2')
+dns = boto3.client('route53')
+cache = {} # key: (expiration, value)
+
+def cached(key, lookup):
+    now = time.time()
+    if key in cache and cache[key][0] > now:
+        return cache[key][1]
+
+    value = lookup()
+    cache[key] = (now + CACHE_TTL, value)
+    return value
+
+def lookup_vpc_id(subnet_id):
+    response = compute.describe_subnets(SubnetIds=[subnet_id])
+    return response['Subnets'][0]['VpcId']
+
+def lookup_vpc_name(vpc_id):
+    response = compute.describe_vpcs(VpcIds=[vpc_id])
+    return find_name(response['Vpcs'][0]['Tags'])
+
+def lookup_zone_id(vpc_name):
+    response = dns.list_hosted_zones_by_name(DNSName=vpc_name, MaxItems='1')
+    return response['HostedZones'][0]['Id'].split('/')[-1]
 
 def where(xs, predicate):
     for x in xs:
@@ -14,74 +49,195 @@ def find_name(xs):
     tag = where(xs, lambda x: x['Key'] == "Name")
     return None if tag is None else tag['Value']
 
+def describe_instances(instance_ids):
+    # Filtering on instance-id, instead of passing InstanceIds, doesn't fail
+    # if some of the instances no longer exist
+    instances = {}
+    paginator = compute.get_paginator('describe_instances')
+    for i in range(0, len(instance_ids), MAX_CHANGES):
+        filters = [{'Name': 'instance-id', 'Values': instance_ids[i:i + MAX_CHANGES]}]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+    return instances
+
+def apply_changes(zone_id, changes):
+    for i in range(0, len(changes), MAX_CHANGES):
+        batch = changes[i:i + MAX_CHANGES]
+        try:
+            dns.change_resource_record_sets(HostedZoneId=zone_id,
+                                            ChangeBatch={'Changes': batch})
+        except ClientError as ex:
+            # A ChangeBatch is all or nothing, so apply the changes one at a
+            # time so that one stale change doesn't block the others
+            print("Could not apply changes, applying individually: {}".format(ex))
+            for change in batch:
+                try:
+                    dns.change_resource_record_sets(HostedZoneId=zone_id,
+                                                    ChangeBatch={'Changes': [change]})
+                except ClientError as ex:
+                    print("Could not {} {} record for instance {}: {}".format(
+                          change['Action'],
+                          change['ResourceRecordSet']['Name'],
+                          change['ResourceRecordSet'].get('SetIdentifier'),
+                          ex))
+
+LAUNCH = ('autoscaling:EC2_INSTANCE_LAUNCH', )
+TERMINATE = ('autoscaling:EC2_INSTANCE_TERMINATE', 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR')
+
 def handler(event, context):
+    if 'Records' not in event:
+        return reconcile(event, context)
+
+    # Changes for all of the records are grouped by hosted zone and applied
+    # in one ChangeBatch per zone
+    events = []
     for record in event['Records']:
         msg = json.loads(record['Sns']['Message'])
 
         action = msg['Event']
         if action == "autoscaling:TEST_NOTIFICATION":
             print("Test test, this is a test")
-            return
+            continue
+
+        if action not in LAUNCH + TERMINATE:
+            print("Unsupported event '{}'".format(action))
+            continue
 
         instance_id = msg['EC2InstanceId']
         subnet_id = msg['Details']['Subnet ID']
         print("Event {} on instance {}".format(action, instance_id))
 
-        compute = boto3.client('ec2')
-        dns = boto3.client('route53')
+        vpc_id = cached(('vpc_id', subnet_id), lambda: lookup_vpc_id(subnet_id))
+        vpc_name = cached(('vpc_name', vpc_id), lambda: lookup_vpc_name(vpc_id))
+        zone_id = cached(('zone_id', vpc_name), lambda: lookup_zone_id(vpc_name))
 
-        response = compute.describe_subnets(SubnetIds=[subnet_id])
-        vpc_id = response['Subnets'][0]['VpcId']
-        response = compute.describe_vpcs(VpcIds=[vpc_id])
-        vpc_name = find_name(response['Vpcs'][0]['Tags'])
+        events.append((action, instance_id, vpc_name, zone_id))
 
-        response = dns.list_hosted_zones_by_name(DNSName=vpc_name, MaxItems='1')
-        zone_id = response['HostedZones'][0]['Id'].split('/')[-1]
+    if len(events) == 0:
+        return
 
-        response = compute.describe_instances(InstanceIds=[instance_id])
-        instance = response['Reservations'][0]['Instances'][0]
-        dns_name = find_name(instance['Tags'])
+    instances = describe_instances(list(set(e[1] for e in events)))
 
-        if action in ('autoscaling:EC2_INSTANCE_LAUNCH', ):
+    changes = {}
+    records = {}
+    for action, instance_id, vpc_name, zone_id in events:
+        instance = instances.get(instance_id)
+        if instance is None:
+            # Any record left behind is removed by the reconcile() sweep
+            print("Instance {} no longer exists".format(instance_id))
+            continue
+
+        dns_name = find_name(instance.get('Tags', []))
+
+        if action in LAUNCH:
             hostname = instance['PrivateDnsName']
 
             print("Map {} to {} in VPC {}".format(dns_name, hostname, vpc_name))
 
-            dns.change_resource_record_sets(
-                HostedZoneId = zone_id,
-                ChangeBatch = {
-                    'Changes': [{
-                        'Action': 'CREATE',
-                        'ResourceRecordSet': {
-                            'Name': dns_name,
-                            'Type': 'CNAME',
-                            'ResourceRecords': [{'Value': hostname}],
-                            'TTL': 300,
-                            'SetIdentifier': instance_id,
-                            'Weight': 1,
-                        }
-                    }]
-                }
-            )
-        elif action in ('autoscaling:EC2_INSTANCE_TERMINATE', 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR'):
-            # Have to lookup the record based on instance_id because after delete, PrivateDnsName is empty
-            response = dns.list_resource_record_sets(
-                HostedZoneId=zone_id,
-                StartRecordName=dns_name,
-                StartRecordType='CNAME'
-            )
-
-            record = where(response['ResourceRecordSets'], lambda x: x['SetIdentifier'] == instance_id)
-
-            dns.change_resource_record_sets(
-                HostedZoneId=zone_id,
-                ChangeBatch = {
-                    'Changes': [{
-                        'Action': 'DELETE',
-                        'ResourceRecordSet': record
-                    }]
+            # UPSERT, as reconcile() may have already added the record
+            change = {
+                'Action': 'UPSERT',
+                'ResourceRecordSet': {
+                    'Name': dns_name,
+                    'Type': 'CNAME',
+                    'ResourceRecords': [{'Value': hostname}],
+                    'TTL': 300,
+                    'SetIdentifier': instance_id,
+                    'Weight': 1,
                 }
-            )
+            }
         else:
-            print("Unsupported event '{}'".format(action))
-            return
+            # Have to lookup the record based on instance_id because after delete, PrivateDnsName is empty
+            key = (zone_id, dns_name)
+            if key not in records:
+                response = dns.list_resource_record_sets(
+                    HostedZoneId=zone_id,
+                    StartRecordName=dns_name,
+                    StartRecordType='CNAME'
+                )
+                records[key] = response['ResourceRecordSets']
+
+            record = where(records[key], lambda x: x.get('SetIdentifier') == instance_id)
+            if record is None:
+                print("No record for instance {}".format(instance_id))
+                continue
+
+            change = {
+                'Action': 'DELETE',
+                'ResourceRecordSet': record
+            }
+
+        changes.setdefault(zone_id, []).append(change)
+
+    for zone_id, zone_changes in changes.items():
+        apply_changes(zone_id, zone_changes)
+
+def reconcile(event, context):
+    # Scheduled sweep of all weighted CNAME records in the VPC's hosted zone
+    # Deletes records for instances that are terminated or no longer exist and
+    # adds records for running instances with a managed name but no record
+    vpc_name = event['vpc_name']
+    zone_id = cached(('zone_id', vpc_name), lambda: lookup_zone_id(vpc_name))
+
+    records = []
+    paginator = dns.get_paginator('list_resource_record_sets')
+    for page in paginator.paginate(HostedZoneId=zone_id):
+        for record in page['ResourceRecordSets']:
+            if record['Type'] == 'CNAME' and 'SetIdentifier' in record and 'Weight' in record:
+                records.append(record)
+
+    if len(records) == 0:
+        return
+
+    # Only names that already have weighted records are managed by this Lambda
+    dns_names = list(set(r['Name'].rstrip('.') for r in records))
+
+    instances = {}
+    paginator = compute.get_paginator('describe_instances')
+    filters = [{'Name': 'tag:Name', 'Values': dns_names},
+               {'Name': 'instance-state-name', 'Values': ['pending', 'running']}]
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instances[instance['InstanceId']] = instance
+
+    # Only records for instances are removed, and only once the instance is
+    # confirmed to be terminated or gone, not if it was stopped or renamed
+    stale = [r for r in records
+             if r['SetIdentifier'].startswith('i-') and r['SetIdentifier'] not in instances]
+    current = describe_instances(list(set(r['SetIdentifier'] for r in stale)))
+
+    changes = []
+    for record in stale:
+        instance = current.get(record['SetIdentifier'])
+        if instance is not None and instance['State']['Name'] != 'terminated':
+            continue
+
+        print("Remove {} record for instance {}".format(record['Name'], record['SetIdentifier']))
+        changes.append({'Action': 'DELETE', 'ResourceRecordSet': record})
+
+    existing = set(r['SetIdentifier'] for r in records)
+    for instance_id, instance in instances.items():
+        hostname = instance.get('PrivateDnsName')
+        if instance_id in existing or instance['State']['Name'] != 'running' or not hostname:
+            continue
+
+        dns_name = find_name(instance['Tags'])
+        print("Map {} to {} in VPC {}".format(dns_name, hostname, vpc_name))
+        changes.append({
+            'Action': 'UPSERT',
+            'ResourceRecordSet': {
+                'Name': dns_name,
+                'Type': 'CNAME',
+                'ResourceRecords': [{'Value': hostname}],
+                'TTL': 300,
+                'SetIdentifier': instance_id,
+                'Weight': 1,
+            }
+        })
+
+    # A notification may have changed a record since it was listed, the next
+    # sweep will pick up anything that is still out of sync
+    apply_changes(zone_id, changes)
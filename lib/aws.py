@@ -24,15 +24,431 @@ Author:
     Derek Pryor <Derek.Pryor@jhuapl.edu>
 """
 
+import io
 import os
 import time
 import json
+import copy
 import re
 import sys
+import tempfile
+import fnmatch
+import zipfile
+import hashlib
+import functools
+import threading
+import weakref
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 from boto3.session import Session
+from botocore.exceptions import ClientError
 
 from . import constants as const
 from . import hosts
+from . import exceptions
+
+def paginate(client, operation, key, **kwargs):
+    """Iterate over the items from every page of results of a list / describe call.
+
+    Pages are requested as the items are consumed, so stopping early avoids
+    requesting the rest of the pages.
+
+    Args:
+        client (Client) : Boto3 client to make the call with
+        operation (string) : Name of the client method (Example: 'describe_instances')
+        key (string) : Key in each page that contains the list of items, nested
+                       keys are separated by '.' (Example: 'DistributionList.Items')
+        kwargs : Arguments for the call
+
+    Returns:
+        (generator) : Generator yielding each item
+    """
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        for k in key.split('.'):
+            page = page.get(k) or {}
+        for item in page or []:
+            yield item
+
+_clients = weakref.WeakKeyDictionary() # session: {service: client}
+_clients_lock = threading.Lock()
+_resources = threading.local() # .pool = {session: {service: resource}}
+
+def get_client(session, service):
+    """Get the Boto3 client for the given service, creating one client per session.
+
+    Boto3 clients can be shared between threads, but creating clients from
+    the same session is not thread safe, so clients are created under a lock.
+
+    Args:
+        session (Session) : Active Boto3 session
+        service (string) : Name of the AWS service (Example: 'ec2')
+
+    Returns:
+        (Client) : Boto3 client
+    """
+    with _clients_lock:
+        clients = _clients.setdefault(session, {})
+        if service not in clients:
+            clients[service] = session.client(service)
+        return clients[service]
+
+def get_resource(session, service):
+    """Get the Boto3 resource for the given service, creating one resource per
+    session for each thread.
+
+    Boto3 resources cannot be shared between threads, so each thread gets its
+    own resource.
+
+    Args:
+        session (Session) : Active Boto3 session
+        service (string) : Name of the AWS service (Example: 's3')
+
+    Returns:
+        (ServiceResource) : Boto3 resource
+    """
+    if not hasattr(_resources, 'pool'):
+        _resources.pool = weakref.WeakKeyDictionary()
+
+    resources = _resources.pool.setdefault(session, {})
+    if service not in resources:
+        with _clients_lock:
+            resources[service] = session.resource(service)
+    return resources[service]
+
+# Number of seconds the result of a lookup is reused for
+LOOKUP_CACHE_TTL = 5 * 60
+
+class LookupCache(object):
+    """Cache of lookup results, keyed by session, lookup function, and arguments.
+
+    Empty results (None, False, empty collections) are not cached, so looking
+    up a resource that doesn't exist yet will query AWS again the next time.
+
+    Dictionaries and lists are copied when they are returned, so a caller
+    modifying its result doesn't change the cached value.
+
+    Args:
+        ttl (int) : Number of seconds a result is reused for
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = weakref.WeakKeyDictionary() # session: {key: (expiration, value)}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, key, lookup):
+        """Get the cached value for key, calling lookup() if there is none
+
+        Args:
+            session (Session) : Boto3 session the lookup is performed with
+            key (tuple) : Tuple of (lookup name, arguments)
+            lookup (function) : Function taking no arguments that performs the lookup
+
+        Returns:
+            (object) : The value returned by lookup()
+        """
+        now = time.time()
+        with self.lock:
+            entries = self.sessions.setdefault(session, {})
+            if key in entries and entries[key][0] > now:
+                self.hits += 1
+                return self._copy(entries[key][1])
+            self.misses += 1
+
+        # Don't hold the lock while talking to AWS, so other lookups can proceed
+        value = lookup()
+
+        if value:
+            with self.lock:
+                self.sessions.setdefault(session, {})[key] = (now + self.ttl, value)
+        return self._copy(value)
+
+    @staticmethod
+    def _copy(value):
+        """Copy mutable values, so callers cannot modify the cached value"""
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+        return value
+
+    def invalidate(self, session=None, lookup=None):
+        """Remove cached values
+
+        Args:
+            session (Session|None) : Only remove values for this session
+            lookup (string|None) : Only remove values for this lookup function
+        """
+        with self.lock:
+            sessions = list(self.sessions.values()) if session is None else [self.sessions.get(session, {})]
+            for entries in sessions:
+                if lookup is None:
+                    entries.clear()
+                else:
+                    for key in [k for k in entries if k[0] == lookup]:
+                        del entries[key]
+
+    def stats(self):
+        """Get the cache hit and miss counters
+
+        Returns:
+            (dict) : Dictionary with the keys 'hits' and 'misses'
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+_lookup_cache = LookupCache(LOOKUP_CACHE_TTL)
+
+def cached_lookup(func):
+    """Decorator that caches the results of a lookup function
+
+    The first argument to the lookup must be the Boto3 session. Lookups with
+    a session of None are not cached.
+    """
+    @functools.wraps(func)
+    def wrapper(session, *args, **kwargs):
+        if session is None:
+            return func(session, *args, **kwargs)
+
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        return _lookup_cache.get(session, key, lambda: func(session, *args, **kwargs))
+    return wrapper
+
+def invalidate_lookups(session=None, lookup=None):
+    """Remove cached lookup results, so the next lookup queries AWS
+
+    Args:
+        session (Session|None) : Only remove results for this session
+        lookup (string|None) : Only remove results of the lookup function with
+                               this name (Example: 'vpc_id_lookup')
+    """
+    _lookup_cache.invalidate(session, lookup)
+
+    with _inventories_lock:
+        if session is None:
+            _inventories.clear()
+        else:
+            _inventories.pop(session, None)
+
+def lookup_cache_stats():
+    """Get the number of lookups served from the cache (hits) and from AWS (misses)
+
+    Returns:
+        (dict) : Dictionary with the keys 'hits' and 'misses'
+    """
+    return _lookup_cache.stats()
+
+# Maximum number of lookups run at the same time by lookup_all()
+LOOKUP_WORKERS = 10
+
+def lookup_all(session, lookups, max_workers=LOOKUP_WORKERS):
+    """Run independent lookups at the same time and return all of the results.
+
+    Each lookup is called with the session as the first argument, followed by
+    the given arguments.
+
+    Example:
+        arns = lookup_all(session, {
+            'role': (role_arn_lookup, 'endpoint'),
+            'ami': (ami_lookup, 'endpoint.boss'),
+        })
+        arns['role']
+
+    Args:
+        session (Session|None) : Boto3 session used to lookup information in AWS
+        lookups (dict) : Dictionary of result name and tuple of the lookup
+                         function and its arguments (excluding the session)
+        max_workers (int) : Maximum number of lookups to run at the same time
+
+    Returns:
+        (dict) : Dictionary of result name and the lookup's result
+
+    Raises:
+        Exception : The exception raised by the first failed lookup
+    """
+    if len(lookups) == 0:
+        return {}
+
+    workers = min(max_workers, len(lookups))
+    with ThreadPoolExecutor(max_workers=workers) as tpe:
+        futures = {name: tpe.submit(lookup[0], session, *lookup[1:])
+                   for name, lookup in lookups.items()}
+
+    return {name: future.result() for name, future in futures.items()}
+
+class VpcInventory(object):
+    """In memory copy of the instances, subnets, security groups, and route
+    tables in a VPC, indexed by their Name tags.
+
+    Everything is read with a few paginated describe calls and is read again
+    once the copy is older than the ttl. The lookups return None for names
+    that are not in the copy, so that the caller can look them up directly.
+
+    Args:
+        session (Session) : Boto3 session used to read the inventory
+        vpc_domain (string) : Name of the VPC
+        ttl (int) : Number of seconds before the inventory is read again
+    """
+    def __init__(self, session, vpc_domain, ttl=LOOKUP_CACHE_TTL):
+        self.session = session
+        self.vpc_domain = vpc_domain
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expiration = 0
+        self.vpc_id = None
+
+    def covers(self, name):
+        """Check if a resource name belongs to this VPC
+
+        Args:
+            name (string) : Name tag of an instance or subnet
+
+        Returns:
+            (bool) : If the resource name is in the VPC's domain
+        """
+        return name == self.vpc_domain or name.endswith('.' + self.vpc_domain)
+
+    def refresh(self):
+        """Read the inventory from AWS"""
+        vpc_id = vpc_id_lookup(self.session, self.vpc_domain)
+        client = get_client(self.session, 'ec2')
+
+        def describe(operation, key):
+            """Yield all items returned by the given describe operation for the VPC"""
+            if vpc_id is None:
+                return []
+            return paginate(client, operation, key, Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
+
+        def name(item):
+            tag = _find(item.get('Tags', []), lambda x: x["Key"] == "Name")
+            return None if tag is None else tag['Value']
+
+        instances = {}
+        for reservation in describe('describe_instances', 'Reservations'):
+            for instance in reservation['Instances']:
+                instances.setdefault(name(instance), []).append(instance)
+
+        subnets = {name(x): x['SubnetId'] for x in describe('describe_subnets', 'Subnets')}
+
+        sgs = NoneDict()
+        for sg in describe('describe_security_groups', 'SecurityGroups'):
+            sgs[name(sg)] = sg['GroupId']
+
+        rts = {name(x): x['RouteTableId'] for x in describe('describe_route_tables', 'RouteTables')}
+
+        with self.lock:
+            self.vpc_id = vpc_id
+            self._instances = instances
+            self._subnets = subnets
+            self._sgs = sgs
+            self._rts = rts
+            self.expiration = time.time() + self.ttl
+
+    def _current(self):
+        if self.expiration <= time.time():
+            self.refresh()
+        return self
+
+    def instances(self, hostname, running_only=True):
+        """Lookup the EC2 instances with the given hostname
+
+        Args:
+            hostname (string) : Name tag of the instances
+            running_only (bool) : Whether or not to only return running instances
+
+        Returns:
+            (list|None) : List of instance dictionaries, as returned by describe_instances(),
+                          or None if there are no instances with the hostname
+        """
+        instances = self._current()._instances.get(hostname)
+        if instances is not None and running_only:
+            instances = [i for i in instances if i['State']['Name'] == 'running']
+        return instances
+
+    def subnet_id(self, name):
+        """Lookup the Id for the Subnet with the given name, or None"""
+        return self._current()._subnets.get(name)
+
+    def sg_ids(self):
+        """Lookup the Ids for all of the Security Groups, as a NoneDict of name and Id"""
+        return NoneDict(self._current()._sgs)
+
+    def sg_id(self, name):
+        """Lookup the Id for the Security Group with the given name, or None"""
+        return self._current()._sgs[name]
+
+    def rt_id(self, name):
+        """Lookup the Id for the Route Table with the given name, or None"""
+        return self._current()._rts.get(name)
+
+_inventories = weakref.WeakKeyDictionary() # session: {vpc_domain: VpcInventory}
+_inventories_lock = threading.Lock()
+
+def prefetch_vpc_inventory(session, vpc_domain):
+    """Read everything in a VPC, so that the instance, subnet, security group,
+    and route table lookups for it are served from memory.
+
+    Lookups for names in the VPC's domain, or for the VPC's ID, made with the
+    same session will use the VpcInventory until invalidate_lookups() is called.
+
+    Args:
+        session (Session) : Boto3 session used to read the inventory
+        vpc_domain (string) : Name of the VPC
+
+    Returns:
+        (VpcInventory) : The inventory for the VPC
+    """
+    inventory = VpcInventory(session, vpc_domain)
+    inventory.refresh()
+    with _inventories_lock:
+        _inventories.setdefault(session, {})[vpc_domain] = inventory
+    return inventory
+
+def _find_inventory(session, name=None, vpc_id=None):
+    """Find the registered VpcInventory covering the given name or VPC ID
+
+    Returns:
+        (VpcInventory|None) : The inventory or None if no inventory covers the
+                              name / VPC ID
+    """
+    if session is None:
+        return None
+
+    with _inventories_lock:
+        inventories = list(_inventories.get(session, {}).values())
+
+    for inventory in inventories:
+        if name is not None and inventory.covers(name):
+            return inventory
+        if vpc_id is not None and inventory.vpc_id == vpc_id:
+            return inventory
+    return None
+
+def _instances(session, hostname, running_only=True):
+    """Lookup the EC2 instances with the given hostname, from a VpcInventory if
+    one covers the hostname and knows about it
+
+    Args:
+        session (Session) : Active Boto3 session
+        hostname (string) : Hostname of the EC2 instances
+        running_only (bool) : Whether or not to only return running instances
+
+    Returns:
+        (list) : List of instance dictionaries, as returned by describe_instances()
+    """
+    inventory = _find_inventory(session, name=hostname)
+    if inventory is not None:
+        instances = inventory.instances(hostname, running_only)
+        if instances is not None:
+            return instances
+
+    filters = [{"Name":"tag:Name", "Values":[hostname]}]
+    if running_only:
+        filters.append({"Name":"instance-state-name", "Values":["running"]})
+
+    client = get_client(session, 'ec2')
+    reservations = paginate(client, 'describe_instances', 'Reservations', Filters=filters)
+    return [r['Instances'][0] for r in reservations if len(r['Instances']) > 0]
 
 def create_session(credentials):
     """Read the AWS from the credentials dictionary and then create a boto3
@@ -65,19 +481,12 @@ def machine_lookup_all(session, hostname, public_ip = True):
     Returns:
         (list) : List of IP addresses
     """
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
-
     addresses = []
-    items = response['Reservations']
-    if len(items) > 0:
-        for i in items:
-            item = i['Instances'][0]
-            if 'PublicIpAddress' in item and public_ip:
-                addresses.append(item['PublicIpAddress'])
-            elif 'PrivateIpAddress' in item and not public_ip:
-                addresses.append(item['PrivateIpAddress'])
+    for item in _instances(session, hostname):
+        if 'PublicIpAddress' in item and public_ip:
+            addresses.append(item['PublicIpAddress'])
+        elif 'PrivateIpAddress' in item and not public_ip:
+            addresses.append(item['PrivateIpAddress'])
     return addresses
 
 def machine_lookup(session, hostname, public_ip = True):
@@ -107,22 +516,18 @@ def machine_lookup(session, hostname, public_ip = True):
     except:
         idx = 0
 
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
-
-    item = response['Reservations']
+    item = _instances(session, hostname)
     if len(item) == 0:
         print("Could not find IP address for '{}'".format(hostname))
         return None
     else:
-        item.sort(key = lambda i: i['Instances'][0]["InstanceId"])
+        item = sorted(item, key = lambda i: i["InstanceId"])
 
         if len(item) <= idx:
             print("Could not find IP address for '{}' index '{}'".format(hostname, idx))
             return None
         else:
-            item = item[idx]['Instances'][0]
+            item = item[idx]
             if 'PublicIpAddress' in item and public_ip:
                 return item['PublicIpAddress']
             elif 'PrivateIpAddress' in item and not public_ip:
@@ -144,7 +549,7 @@ def rds_lookup(session, hostname):
         (string|None) : Public DNS or None if one could not be located.
     """
 
-    client = session.client('rds')
+    client = get_client(session, 'rds')
     response = client.describe_db_instances(DBInstanceIdentifier=hostname)
 
     item = response['DBInstances']
@@ -171,26 +576,89 @@ def _find(xs, predicate):
     return None
 
 
-def asg_restart(session, hostname, timeout, callback=None):
-    """Terminate all of the instances for an ASG, with the given timeout between
-    each termination.
+def asg_restart(session, hostname, timeout, callback=None, batch_size=1,
+                healthy=None, max_failures=0, poll=15):
+    """Terminate all of the instances for an ASG, a batch at a time, waiting for
+    the ASG to replace them before moving on to the next batch.
+
+    After each batch is terminated the ASG is polled until it has its desired
+    number of InService and Healthy instances again (not counting the terminated
+    instances) and the healthy() check passes, or until timeout seconds pass.
+
+    Args:
+        session (Session) : Active Boto3 session
+        hostname (string) : Hostname of the EC2 instances created by the ASG
+        timeout (int) : Maximum number of seconds to wait for each batch to be
+                        replaced and healthy
+        callback (None|function) : Function called after each batch is replaced
+        batch_size (int) : Number of instances to terminate at a time
+        healthy (None|function) : Function that returns if the service is healthy
+                                  (Example: the Consul cluster has quorum)
+        max_failures (int) : Number of batches that can fail to become healthy
+                             within the timeout before the restart is aborted
+        poll (int) : Number of seconds between checks of the ASG / service health
+
+    Raises:
+        StatusCheckError : If the ASG could not be located, the service is not
+                           healthy before the restart, or more than max_failures
+                           batches didn't become healthy
     """
-    client = session.client('ec2')
-    resource = session.resource('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
+    asg_name = asg_name_lookup(session, hostname)
+    if asg_name is None:
+        raise exceptions.StatusCheckError("Could not locate the ASG", hostname)
 
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            id = instance['InstanceId']
-            print("Terminating {} instance {}".format(hostname, id))
-            resource.Instance(id).terminate()
-            print("Sleeping for {} minutes".format(timeout/60.0))
-            time.sleep(timeout)
+    client = get_client(session, 'autoscaling')
+
+    def describe():
+        resp = client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+        return resp['AutoScalingGroups'][0]
+
+    if healthy is not None and not healthy():
+        raise exceptions.StatusCheckError("Not restarting, service is not healthy", hostname)
 
-            if callback is not None:
-                callback()
+    # Read all of the instances first, as terminating takes a while
+    instances = [i['InstanceId'] for i in describe()['Instances']
+                 if i['LifecycleState'] == 'InService']
+    terminated = set()
+    failures = 0
 
+    for i in range(0, len(instances), batch_size):
+        batch = instances[i:i + batch_size]
+        for id in batch:
+            print("Terminating {} instance {}".format(hostname, id))
+            client.terminate_instance_in_auto_scaling_group(InstanceId=id,
+                                                            ShouldDecrementDesiredCapacity=False)
+            terminated.add(id)
+
+        # The instances for the hostname have changed
+        invalidate_lookups(session)
+
+        print("Waiting up to {} minutes for the replacement(s) to be healthy".format(timeout/60.0))
+        start = time.time()
+        while True:
+            time.sleep(poll)
+
+            group = describe()
+            in_service = [x for x in group['Instances']
+                          if x['InstanceId'] not in terminated and
+                             x['LifecycleState'] == 'InService' and
+                             x['HealthStatus'] == 'Healthy']
+            if len(in_service) >= group['DesiredCapacity'] and (healthy is None or healthy()):
+                print("Replacement(s) healthy after {:.1f} minutes".format((time.time() - start)/60.0))
+                break
+
+            if time.time() - start >= timeout:
+                failures += 1
+                print("Replacement(s) not healthy after {} minutes".format(timeout/60.0))
+                if failures > max_failures:
+                    msg = "Aborting restart, {} batch(es) failed to become healthy".format(failures)
+                    raise exceptions.StatusCheckError(msg, hostname)
+                break
+
+        if callback is not None:
+            callback()
+
+@cached_lookup
 def asg_name_lookup(session, hostname):
     """Lookup the Group name for the ASG creating the EC2 instances with the given hostname
 
@@ -205,18 +673,18 @@ def asg_name_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('autoscaling')
-    response = client.describe_auto_scaling_groups()
-    if len(response['AutoScalingGroups']) == 0:
-        return None
-    else:
-        # DP NOTE: Unfortunatly describe_auto_scaling_groups() doesn't allow filtering results
-        for g in response['AutoScalingGroups']:
-            t = _find(g['Tags'], lambda x: x['Key'] == 'Name')
-            if t and t['Value'] == hostname:
-                return g['AutoScalingGroupName']
-        return None
+    client = get_client(session, 'autoscaling')
+    # describe_auto_scaling_groups() doesn't allow filtering results, so look
+    # for the ASG's Name tag instead of walking every group's tags
+    tags = paginate(client, 'describe_tags', 'Tags',
+                    Filters=[{'Name': 'key', 'Values': ['Name']},
+                             {'Name': 'value', 'Values': [hostname]}])
+    for tag in tags:
+        if tag['ResourceType'] == 'auto-scaling-group':
+            return tag['ResourceId']
+    return None
 
+@cached_lookup
 def vpc_id_lookup(session, vpc_domain):
     """Lookup the Id for the VPC with the given domain name.
 
@@ -231,7 +699,7 @@ def vpc_id_lookup(session, vpc_domain):
     if session is None:
         return None
 
-    client = session.client('ec2')
+    client = get_client(session, 'ec2')
     response = client.describe_vpcs(Filters=[{"Name": "tag:Name", "Values": [vpc_domain]}])
     if len(response['Vpcs']) == 0:
         return None
@@ -239,6 +707,7 @@ def vpc_id_lookup(session, vpc_domain):
         return response['Vpcs'][0]['VpcId']
 
 
+@cached_lookup
 def subnet_id_lookup(session, subnet_domain):
     """Lookup the Id for the Subnet with the given domain name.
 
@@ -253,13 +722,20 @@ def subnet_id_lookup(session, subnet_domain):
     if session is None:
         return None
 
-    client = session.client('ec2')
+    inventory = _find_inventory(session, name=subnet_domain)
+    if inventory is not None:
+        subnet_id = inventory.subnet_id(subnet_domain)
+        if subnet_id is not None:
+            return subnet_id
+
+    client = get_client(session, 'ec2')
     response = client.describe_subnets(Filters=[{"Name": "tag:Name", "Values": [subnet_domain]}])
     if len(response['Subnets']) == 0:
         return None
     else:
         return response['Subnets'][0]['SubnetId']
 
+@cached_lookup
 def azs_lookup(session, lambda_compatible_only=False):
     """Lookup all of the Availablity Zones for the connected region.
 
@@ -273,7 +749,7 @@ def azs_lookup(session, lambda_compatible_only=False):
     if session is None:
         return []
 
-    client = session.client('ec2')
+    client = get_client(session, 'ec2')
     response = client.describe_availability_zones()
     # SH Removing Hack as subnet A is already in Production and causes issues trying to delete
     #    We will strip out subnets A and C when creating the lambdas.
@@ -289,6 +765,201 @@ def azs_lookup(session, lambda_compatible_only=False):
                 rtn.remove(az)
     return rtn
 
+# Number of seconds before an AmiCatalog is read again in full, instead of
+# only reading the AMIs created since the last refresh. Also removes AMIs that
+# were deregistered from the catalog.
+AMI_CATALOG_FULL_TTL = 24 * 60 * 60
+
+class AmiCatalog(object):
+    """Local copy of the AMIs matching a set of filters, saved to disk so that
+    it can be reused between runs.
+
+    The catalog is kept per account and region. After the first full read
+    only the AMIs created since the last refresh are read from AWS (using
+    the creation-date filter), so a refresh is a small describe_images call.
+    As deregistered AMIs are only dropped by a full read, the newest match
+    returned by find() is checked against AWS first.
+
+    Args:
+        session (Session) : Boto3 session used to read the AMIs
+        name (string) : Name of the catalog, used in the file name
+        owners (list|None) : List of AMI owners (Example: ['self']) or None for
+                             all AMIs the account can launch
+        filters (list) : describe_images() filters for the AMIs to catalog
+        directory (string|None) : Directory the catalog file is saved in
+                                  (default: AMI_CATALOG_DIR)
+        ttl (int) : Number of seconds before the catalog is refreshed
+        full_ttl (int) : Number of seconds before the catalog is read in full
+    """
+    def __init__(self, session, name, owners, filters=[],
+                 directory=None, ttl=LOOKUP_CACHE_TTL, full_ttl=AMI_CATALOG_FULL_TTL):
+        self.session = session
+        self.owners = owners
+        self.filters = filters
+        self.ttl = ttl
+        self.full_ttl = full_ttl
+        self.lock = threading.Lock()
+
+        account = get_account_id_from_session(session)
+        region = session.region_name
+        file_name = "{}.{}.{}.json".format(name, account, region)
+        self.path = os.path.join(directory or const.AMI_CATALOG_DIR, file_name)
+
+        self.updated = 0 # time of the last refresh
+        self.full_updated = 0 # time of the last full refresh
+        self.images = {} # ImageId: image
+        self.load()
+
+    def load(self):
+        """Read the catalog from disk, if it has been saved before"""
+        try:
+            with open(self.path, 'r') as fh:
+                data = json.load(fh)
+        except (IOError, ValueError):
+            return
+
+        self.updated = data['updated']
+        self.full_updated = data['full_updated']
+        self.images = data['images']
+
+    def save(self):
+        """Save the catalog to disk"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        data = {
+            'updated': self.updated,
+            'full_updated': self.full_updated,
+            'images': self.images,
+        }
+
+        # Write to a temporary file first so other processes never read a partial file
+        directory, name = os.path.split(self.path)
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix=name + '.', delete=False) as fh:
+            try:
+                json.dump(data, fh)
+            except:
+                os.remove(fh.name)
+                raise
+        os.replace(fh.name, self.path)
+
+    def refresh(self, force=False):
+        """Read new AMIs from AWS, if the catalog is older than the ttl
+
+        Args:
+            force (bool) : Refresh even if the catalog is newer than the ttl
+        """
+        with self.lock:
+            now = time.time()
+            if not force and now - self.updated < self.ttl:
+                return
+
+            filters = list(self.filters)
+            full = now - self.full_updated >= self.full_ttl
+            if not full:
+                # Start a day before the last refresh, as the creation date is
+                # when the AMI was started, not when it became available.
+                # Creation dates are in UTC
+                day = datetime.datetime.utcfromtimestamp(self.updated).date() - datetime.timedelta(days=1)
+                today = datetime.datetime.utcfromtimestamp(now).date()
+                dates = []
+                while day <= today:
+                    dates.append(day.isoformat() + "*")
+                    day += datetime.timedelta(days=1)
+                filters.append({"Name": "creation-date", "Values": dates})
+
+            kwargs = {'Filters': filters}
+            if self.owners is not None:
+                kwargs['Owners'] = self.owners
+
+            client = get_client(self.session, 'ec2')
+            response = client.describe_images(**kwargs)
+
+            images = {} if full else dict(self.images)
+            for image in response['Images']:
+                tag = _find(image.get('Tags', []), lambda x: x["Key"] == "Commit")
+                images[image['ImageId']] = {
+                    'ImageId': image['ImageId'],
+                    'Name': image['Name'],
+                    'CreationDate': image['CreationDate'],
+                    'Commit': None if tag is None else tag["Value"],
+                }
+
+            self.images = images
+            self.updated = now
+            if full:
+                self.full_updated = now
+            self.save()
+
+    def available(self, image_id):
+        """Check that an AMI in the catalog still exists in AWS, removing it
+        from the catalog if it has been deregistered
+
+        Args:
+            image_id (string) : Id of the AMI to check
+
+        Returns:
+            (bool) : If the AMI can still be launched
+        """
+        client = get_client(self.session, 'ec2')
+        try:
+            response = client.describe_images(ImageIds=[image_id])
+            images = [i for i in response['Images']
+                      if i['ImageId'] == image_id and i.get('State') != 'deregistered']
+        except ClientError as ex:
+            if not ex.response['Error']['Code'].startswith('InvalidAMIID'):
+                raise
+            images = []
+
+        if len(images) > 0:
+            return True
+
+        with self.lock:
+            if self.images.pop(image_id, None) is not None:
+                self.save()
+        return False
+
+    def find(self, predicate):
+        """Find the AMIs matching the predicate, refreshing the catalog first if
+        needed and again if no AMIs match
+
+        The newest match is checked with available(), so that an AMI that has
+        been deregistered since it was cataloged is never returned first
+
+        Args:
+            predicate (function) : Function that takes an image and returns if it matches
+
+        Returns:
+            (list) : List of image dictionaries (with the keys ImageId, Name,
+                     CreationDate, and Commit), newest first
+        """
+        def match():
+            images = [i for i in self.images.values() if predicate(i)]
+            images.sort(key=lambda x: x['CreationDate'], reverse=True)
+            return images
+
+        self.refresh()
+        images = match()
+        if len(images) == 0:
+            # The AMI may have been created since the last refresh
+            self.refresh(force=True)
+            images = match()
+
+        while len(images) > 0 and not self.available(images[0]['ImageId']):
+            images.pop(0)
+        return images
+
+@cached_lookup
+def boss_ami_catalog(session):
+    """Get the AmiCatalog containing all of the BOSS AMIs the account can launch
+
+    Args:
+        session (Session) : Active Boto3 session
+
+    Returns:
+        (AmiCatalog) : The catalog of '.boss' AMIs
+    """
+    return AmiCatalog(session, 'boss', None, [{"Name": "name", "Values": ["*.boss-*"]}])
+
 def ami_lookup(session, ami_name, version = None):
     """Lookup the Id for the AMI with the given name.
 
@@ -310,34 +981,45 @@ def ami_lookup(session, ami_name, version = None):
     if session is None:
         return None
 
-    specific = False
-    if ami_name.endswith(".boss"):
-        ami_version = os.environ["AMI_VERSION"] if version is None else version
-        if ami_version == "latest":
-            # limit latest searching to only versions tagged with hash information
-            ami_search = ami_name + "-h*"
-        else:
-            ami_search = ami_name + "-" + ami_version
-            specific = True
-    else:
-        ami_search = ami_name
+    if ami_name.endswith(".boss") and version is None:
+        version = os.environ["AMI_VERSION"]
 
-    client = session.client('ec2')
-    response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_search]}])
-    if len(response['Images']) == 0:
-        if specific:
-            print("Could not locate AMI '{}', trying to find the latest '{}' AMI".format(ami_search, ami_name))
-            return ami_lookup(session, ami_name, version = "latest")
-        else:
+    return _ami_lookup(session, ami_name, version)
+
+@cached_lookup
+def _ami_lookup(session, ami_name, ami_version):
+    """Lookup the Id for the AMI with the given name and version.
+
+    Implementation of ami_lookup() with the AMI_VERSION environmental variable
+    already resolved, so that the results can be cached.
+    """
+    if not ami_name.endswith(".boss"):
+        client = get_client(session, 'ec2')
+        response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_name]}])
+        if len(response['Images']) == 0:
             return None
-    else:
+
         response['Images'].sort(key=lambda x: x["CreationDate"], reverse=True)
         image = response['Images'][0]
-        ami = image['ImageId']
         tag = _find(image.get('Tags', []), lambda x: x["Key"] == "Commit")
-        commit = None if tag is None else tag["Value"]
+        return (image['ImageId'], None if tag is None else tag["Value"])
+
+    catalog = boss_ami_catalog(session)
+    if ami_version == "latest":
+        # limit latest searching to only versions tagged with hash information
+        prefix = ami_name + "-h"
+        images = catalog.find(lambda x: x['Name'].startswith(prefix))
+    else:
+        ami_search = ami_name + "-" + ami_version
+        images = catalog.find(lambda x: fnmatch.fnmatchcase(x['Name'], ami_search))
+        if len(images) == 0:
+            print("Could not locate AMI '{}', trying to find the latest '{}' AMI".format(ami_search, ami_name))
+            return ami_lookup(session, ami_name, version = "latest")
+
+    if len(images) == 0:
+        return None
 
-        return (ami, commit)
+    return (images[0]['ImageId'], images[0]['Commit'])
 
 class NoneDict(dict):
     """Custom Dictionary that returns none if the key doesn't exist.
@@ -350,6 +1032,7 @@ class NoneDict(dict):
         else:
             return super().__getitem__(key)
 
+@cached_lookup
 def sg_lookup_all(session, vpc_id):
     """Lookup the Ids for all of the VPC Security Groups.
 
@@ -366,21 +1049,22 @@ def sg_lookup_all(session, vpc_id):
     if session is None:
         return NoneDict()
 
-    client = session.client('ec2')
-    response = client.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
+    inventory = _find_inventory(session, vpc_id=vpc_id)
+    if inventory is not None:
+        return inventory.sg_ids()
 
-    if len(response['SecurityGroups']) == 0:
-        return NoneDict()
-    else:
-        sgs = NoneDict()
-        for sg in response['SecurityGroups']:
-            key = _find(sg.get('Tags', []), lambda x: x["Key"] == "Name")
-            if key:
-                key = key['Value']
-            sgs[key] = sg['GroupId']
+    client = get_client(session, 'ec2')
+    sgs = NoneDict()
+    for sg in paginate(client, 'describe_security_groups', 'SecurityGroups',
+                       Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]):
+        key = _find(sg.get('Tags', []), lambda x: x["Key"] == "Name")
+        if key:
+            key = key['Value']
+        sgs[key] = sg['GroupId']
 
-        return sgs
+    return sgs
 
+@cached_lookup
 def sg_lookup(session, vpc_id, group_name):
     """Lookup the Id for the VPC Security Group with the given name.
 
@@ -396,7 +1080,13 @@ def sg_lookup(session, vpc_id, group_name):
     if session is None:
         return None
 
-    client = session.client('ec2')
+    inventory = _find_inventory(session, vpc_id=vpc_id)
+    if inventory is not None:
+        sg_id = inventory.sg_id(group_name)
+        if sg_id is not None:
+            return sg_id
+
+    client = get_client(session, 'ec2')
     response = client.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
                                                         {"Name": "tag:Name", "Values": [group_name]}])
 
@@ -405,6 +1095,7 @@ def sg_lookup(session, vpc_id, group_name):
     else:
         return response['SecurityGroups'][0]['GroupId']
 
+@cached_lookup
 def rt_lookup(session, vpc_id, rt_name):
     """Lookup the Id for the VPC Route Table with the given name.
 
@@ -420,7 +1111,13 @@ def rt_lookup(session, vpc_id, rt_name):
     if session is None:
         return None
 
-    client = session.client('ec2')
+    inventory = _find_inventory(session, vpc_id=vpc_id)
+    if inventory is not None:
+        rt_id = inventory.rt_id(rt_name)
+        if rt_id is not None:
+            return rt_id
+
+    client = get_client(session, 'ec2')
     response = client.describe_route_tables(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
                                                      {"Name": "tag:Name", "Values": [rt_name]}])
 
@@ -448,11 +1145,10 @@ def rt_name_default(session, vpc_id, new_rt_name):
     Returns:
         None
     """
-    client = session.client('ec2')
-    response = client.describe_route_tables(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
-
+    client = get_client(session, 'ec2')
     rt_id = None
-    for rt in response['RouteTables']:
+    for rt in paginate(client, 'describe_route_tables', 'RouteTables',
+                       Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]):
         nt = _find(rt['Tags'], lambda x: x['Key'] == 'Name')
         if nt is None or nt['Value'] == '':
             rt_id = rt['RouteTableId']
@@ -461,11 +1157,13 @@ def rt_name_default(session, vpc_id, new_rt_name):
         print("Could not locate unnamed default route table")
         return
 
-    resource = session.resource('ec2')
+    resource = get_resource(session, 'ec2')
     rt = resource.RouteTable(rt_id)
     response = rt.create_tags(Tags=[{"Key": "Name", "Value": new_rt_name}])
+    invalidate_lookups(session, 'rt_lookup')
 
 
+@cached_lookup
 def peering_lookup(session, from_id, to_id, owner_id=None):
     """Lookup the Id for the Peering Connection between the two VPCs.
 
@@ -490,7 +1188,7 @@ def peering_lookup(session, from_id, to_id, owner_id=None):
     if owner_id is None:
         owner_id = get_account_id_from_session(session)
 
-    client = session.client('ec2')
+    client = get_client(session, 'ec2')
     response = client.describe_vpc_peering_connections(Filters=[{"Name": "requester-vpc-info.vpc-id",
                                                                  "Values": [from_id]},
                                                                 {"Name": "requester-vpc-info.owner-id",
@@ -525,7 +1223,7 @@ def keypair_lookup(session):
     if session is None:
         return None
 
-    client = session.client('ec2')
+    client = get_client(session, 'ec2')
     response = client.describe_key_pairs()
 
     # If SSH_KEY exists and points to a valid Key Pair, use it
@@ -568,24 +1266,17 @@ def instanceid_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_instances(
-        Filters=[{"Name": "tag:Name", "Values": [hostname]}])
-
-    item = response['Reservations']
+    item = _instances(session, hostname, running_only=False)
     if len(item) == 0:
         return None
     else:
-        item = item[0]['Instances']
-        if len(item) == 0:
-            return None
-        else:
-            item = item[0]
-            if 'InstanceId' in item:
-                return item['InstanceId']
-            return None
+        item = item[0]
+        if 'InstanceId' in item:
+            return item['InstanceId']
+        return None
 
 
+@cached_lookup
 def cert_arn_lookup(session, domain_name):
     """Looks up the ARN for a SSL Certificate
 
@@ -600,9 +1291,8 @@ def cert_arn_lookup(session, domain_name):
     if session is None:
         return None
 
-    client = session.client('acm')
-    response = client.list_certificates()
-    for certs in response['CertificateSummaryList']:
+    client = get_client(session, 'acm')
+    for certs in paginate(client, 'list_certificates', 'CertificateSummaryList'):
         if certs['DomainName'] == domain_name:
             return certs['CertificateArn']
         if certs['DomainName'].startswith('*'):    # if it is a wildcard domain like "*.thebossdev.io"
@@ -627,25 +1317,17 @@ def instance_public_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_instances(
-        Filters=[{"Name": "tag:Name", "Values": [hostname]},
-                 {"Name": "instance-state-name", "Values": ["running"]}])
-
-    item = response['Reservations']
+    item = _instances(session, hostname)
     if len(item) == 0:
         return None
     else:
-        item = item[0]['Instances']
-        if len(item) == 0:
-            return None
-        else:
-            item = item[0]
-            if 'PublicDnsName' in item:
-                return item['PublicDnsName']
-            return None
+        item = item[0]
+        if 'PublicDnsName' in item:
+            return item['PublicDnsName']
+        return None
 
 
+@cached_lookup
 def cloudfront_public_lookup(session, hostname):
     """
     Lookup cloudfront public domain name which has hostname as the origin.
@@ -660,12 +1342,8 @@ def cloudfront_public_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('cloudfront')
-    response = client.list_distributions(
-        MaxItems='100'
-    )
-    items = response["DistributionList"]["Items"]
-    for item in items:
+    client = get_client(session, 'cloudfront')
+    for item in paginate(client, 'list_distributions', 'DistributionList.Items'):
         cloud_front_domain_name = item["DomainName"]
         if item["Aliases"]["Quantity"] > 0:
             if hostname in item["Aliases"]["Items"]:
@@ -673,6 +1351,7 @@ def cloudfront_public_lookup(session, hostname):
     return None
 
 
+@cached_lookup
 def elb_public_lookup(session, hostname):
     """Lookup the Public DNS name for a ELB
 
@@ -688,12 +1367,10 @@ def elb_public_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('elb')
-    responses = client.describe_load_balancers()
-
+    client = get_client(session, 'elb')
     hostname_ = hostname.replace(".", "-")
 
-    for response in responses["LoadBalancerDescriptions"]:
+    for response in paginate(client, 'describe_load_balancers', 'LoadBalancerDescriptions'):
         if response["LoadBalancerName"].startswith(hostname_):
             return response["DNSName"]
     return None
@@ -701,6 +1378,7 @@ def elb_public_lookup(session, hostname):
 
 # Should be something more like elb_check / elb_name_check, because
 # _lookup is normally used to return the ID of something
+@cached_lookup
 def lb_lookup(session, lb_name):
     """Look up ELB Id by name
 
@@ -717,15 +1395,14 @@ def lb_lookup(session, lb_name):
 
     lb_name = lb_name.replace('.', '-')
 
-    client = session.client('elb')
-    response = client.describe_load_balancers()
-
-    for i in range(len(response['LoadBalancerDescriptions'])):
-        if (response['LoadBalancerDescriptions'][i]['LoadBalancerName']) == lb_name:
+    client = get_client(session, 'elb')
+    for lb in paginate(client, 'describe_load_balancers', 'LoadBalancerDescriptions'):
+        if lb['LoadBalancerName'] == lb_name:
             return True
     return False
 
 
+@cached_lookup
 def sns_topic_lookup(session, topic_name):
     """Lookup up SNS topic ARN given a topic name
 
@@ -740,10 +1417,8 @@ def sns_topic_lookup(session, topic_name):
     if session is None:
         return None
 
-    client = session.client('sns')
-    response = client.list_topics()
-    topics_list = response['Topics']
-    for topic in topics_list:
+    client = get_client(session, 'sns')
+    for topic in paginate(client, 'list_topics', 'Topics'):
         arn_topic_name = topic["TopicArn"].split(':').pop()
         if arn_topic_name == topic_name:
             return topic["TopicArn"]
@@ -760,10 +1435,11 @@ def sqs_delete_all(session, domain):
     Raises:
         (boto3.ClientError): If queue not found.
     """
-    client = session.client('sqs')
-    resp = client.list_queues(QueueNamePrefix=domain.replace('.','-'))
+    client = get_client(session, 'sqs')
+    # Read all of the URLs before deleting, so deletes don't shift the pages
+    urls = list(paginate(client, 'list_queues', 'QueueUrls', QueueNamePrefix=domain.replace('.','-')))
 
-    for url in resp.get('QueueUrls', []):
+    for url in urls:
         client.delete_queue(QueueUrl=url)
 
 def sqs_lookup_url(session, queue_name):
@@ -779,7 +1455,7 @@ def sqs_lookup_url(session, queue_name):
     Raises:
         (boto3.ClientError): If queue not found.
     """
-    client = session.client('sqs')
+    client = get_client(session, 'sqs')
     resp = client.get_queue_url(QueueName=queue_name)
     return resp['QueueUrl']
 
@@ -800,7 +1476,7 @@ def request_cert(session, domain_name, validation_domain):
     if session is None:
         return None
 
-    client = session.client('acm')
+    client = get_client(session, 'acm')
     validation_options = [
         {
             'DomainName': domain_name,
@@ -829,6 +1505,7 @@ def get_hosted_zone(session):
     else:
         return None
 
+@cached_lookup
 def get_hosted_zone_id(session, hosted_zone):
     """Look up Hosted Zone ID by DNS Name
 
@@ -843,7 +1520,7 @@ def get_hosted_zone_id(session, hosted_zone):
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     response = client.list_hosted_zones_by_name(
         DNSName=hosted_zone,
         MaxItems='1'
@@ -873,7 +1550,7 @@ def set_domain_to_dns_name(session, domain_name, dns_resource, hosted_zone):
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     hosted_zone_id = get_hosted_zone_id(session, hosted_zone)
 
     if hosted_zone_id is None:
@@ -922,7 +1599,7 @@ def get_dns_resource_for_domain_name(session, domain_name, dns_resource, hosted_
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     hosted_zone_id = get_hosted_zone_id(session, hosted_zone)
 
     if hosted_zone_id is None:
@@ -965,23 +1642,23 @@ def route53_delete_records(session, hosted_zone, cname):
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     hosted_zone_id = get_hosted_zone_id(session, hosted_zone)
 
     if hosted_zone_id is None:
         print("Could not locate Route53 Hosted Zone '{}'".format(hosted_zone))
         return None
 
-    response = client.list_resource_record_sets(
-        HostedZoneId=hosted_zone_id,
-        StartRecordName=cname,
-        StartRecordType='CNAME'
-    )
+    records = paginate(client, 'list_resource_record_sets', 'ResourceRecordSets',
+                       HostedZoneId=hosted_zone_id,
+                       StartRecordName=cname,
+                       StartRecordType='CNAME')
 
     changes = []
-    for record in response['ResourceRecordSets']:
+    for record in records:
         if not record['Name'].startswith(cname):
-            continue
+            # Records are sorted by name, there are no more matching records
+            break
         changes.append({
             'Action': 'DELETE',
             'ResourceRecordSet': record
@@ -1016,12 +1693,14 @@ def sns_unsubscribe_all(session, topic, region="us-east-1", account=None):
 
     topic = "arn:aws:sns:{}:{}:{}".format(region, account, topic.replace(".", "-"))
 
-    client = session.client('sns')
-    response = client.list_subscriptions()
+    client = get_client(session, 'sns')
+    # Read all of the subscriptions before unsubscribing, so unsubscribing doesn't shift the pages
+    subscriptions = [res['SubscriptionArn']
+                     for res in paginate(client, 'list_subscriptions', 'Subscriptions')
+                     if res['TopicArn'] == topic]
 
-    for res in response['Subscriptions']:
-        if res['TopicArn'] == topic:
-            client.unsubscribe(SubscriptionArn=res['SubscriptionArn'])
+    for arn in subscriptions:
+        client.unsubscribe(SubscriptionArn=arn)
 
     return None
 
@@ -1039,7 +1718,7 @@ def sns_create_topic(session, topic):
     if session is None:
         return None
 
-    client = session.client("sns")
+    client = get_client(session, "sns")
     response = client.create_topic(Name=topic)
     print(response)
     if response is None:
@@ -1058,24 +1737,28 @@ def policy_delete_all(session, domain, path="/"):
     Raises:
         (boto3.ClientError): If queue not found.
     """
-    client = session.client('iam')
-    resp = client.list_policies(Scope='Local', PathPrefix=path)
-
+    client = get_client(session, 'iam')
     prefix = domain.replace('.', '-')
-    for policy in resp.get('Policies', []):
-        if policy['PolicyName'].startswith(prefix):
-            ARN = policy['Arn']
-            if policy['AttachmentCount'] > 0:
-                # cannot delete a policy if it is still in use
-                attached = client.list_entities_for_policy(PolicyArn=ARN)
-                for group in attached.get('PolicyGroups', []):
-                    client.detach_group_policy(GroupName=group['GroupName'], PolicyArn=ARN)
-                for user in attached.get('PolicyUsers', []):
-                    client.detach_user_policy(UserName=user['UserName'], PolicyArn=ARN)
-                for role in attached.get('PolicyRoles', []):
-                    client.detach_role_policy(RoleName=role['RoleName'], PolicyArn=ARN)
-            client.delete_policy(PolicyArn=ARN)
 
+    # Read all of the policies before deleting, so deletes don't shift the pages
+    policies = [policy
+                for policy in paginate(client, 'list_policies', 'Policies', Scope='Local', PathPrefix=path)
+                if policy['PolicyName'].startswith(prefix)]
+
+    for policy in policies:
+        ARN = policy['Arn']
+        if policy['AttachmentCount'] > 0:
+            # cannot delete a policy if it is still in use
+            attached = client.list_entities_for_policy(PolicyArn=ARN)
+            for group in attached.get('PolicyGroups', []):
+                client.detach_group_policy(GroupName=group['GroupName'], PolicyArn=ARN)
+            for user in attached.get('PolicyUsers', []):
+                client.detach_user_policy(UserName=user['UserName'], PolicyArn=ARN)
+            for role in attached.get('PolicyRoles', []):
+                client.detach_role_policy(RoleName=role['RoleName'], PolicyArn=ARN)
+        client.delete_policy(PolicyArn=ARN)
+
+@cached_lookup
 def role_arn_lookup(session, role_name):
     """
     Returns the arn associated the the role name.
@@ -1090,13 +1773,14 @@ def role_arn_lookup(session, role_name):
     if session is None:
         return None
 
-    client = session.client('iam')
+    client = get_client(session, 'iam')
     response = client.get_role(RoleName=role_name)
     if response is None:
         return None
     else:
         return response['Role']['Arn']
 
+@cached_lookup
 def instance_profile_arn_lookup(session, instance_profile_name):
     """
     Returns the arn associated the the role name.
@@ -1111,7 +1795,7 @@ def instance_profile_arn_lookup(session, instance_profile_name):
     if session is None:
         return None
 
-    client = session.client('iam')
+    client = get_client(session, 'iam')
     response = client.get_instance_profile(InstanceProfileName=instance_profile_name)
     if response is None:
         return None
@@ -1132,7 +1816,7 @@ def s3_bucket_exists(session, name):
     Returns:
         (bool): True if bucket exists.
     """
-    client = session.client('s3')
+    client = get_client(session, 's3')
     resp = client.list_buckets()
     for bucket in resp['Buckets']:
         if bucket['Name'] == name:
@@ -1140,6 +1824,7 @@ def s3_bucket_exists(session, name):
 
     return False
 
+@cached_lookup
 def get_account_id_from_session(session):
     """
     gets the account id from the session using the iam client.  This method will work even
@@ -1153,7 +1838,7 @@ def get_account_id_from_session(session):
     if session is None:
         return None
 
-    return session.client('iam').list_users(MaxItems=1)["Users"][0]["Arn"].split(':')[4]
+    return get_client(session, 'iam').list_users(MaxItems=1)["Users"][0]["Arn"].split(':')[4]
 
 # DP TODO: refactor all lambda server functions into some common entity so it is easy to handle multiple accounts
 def get_lambda_s3_bucket(session):
@@ -1207,7 +1892,45 @@ def get_lambda_server_key(session):
     else:
         raise NameError("Unknown session account used, {}, lambda_build_server for this session is unknown.".format(account))
 
+def lambda_file_key(name, file):
+    """Create the S3 key for a single file Lambda uploaded with upload_lambda_file()
+
+    The key contains a hash of the file's contents, so when the code changes the
+    CloudFormation template changes too and the Lambda is redeployed.
+
+    Args:
+        name (string): Name of the Lambda (Example: 'updateRoute53.vpc.boss')
+        file (string): File path to file containing lambda source code
+
+    Returns:
+        (string): S3 key of the zip file
+    """
+    with open(file, 'rb') as fh:
+        digest = hashlib.sha256(fh.read()).hexdigest()
+    return "{}.{}.zip".format(name, digest[:16])
+
+def upload_lambda_file(session, file, bucket, key):
+    """Zip a single file Lambda and upload it to S3.
+
+    Used for Lambdas whose code is too large to be included directly in the
+    CloudFormation template. The file is stored in the zip as index.py, so the
+    Lambda handler is the same as when using CloudFormationConfiguration.add_lambda(file=...)
+
+    Args:
+        session (Session): Boto3 session used to upload the zip file
+        file (string): File path to file containing lambda source code
+        bucket (string): S3 bucket to upload the zip file to
+        key (string): S3 key of the zip file
+    """
+    fh = io.BytesIO()
+    with zipfile.ZipFile(fh, 'w', zipfile.ZIP_DEFLATED) as zip_:
+        zip_.write(file, 'index.py')
+
+    client = get_client(session, 's3')
+    client.put_object(Bucket=bucket, Key=key, Body=fh.getvalue())
+
 
+@cached_lookup
 def lambda_arn_lookup(session, lambda_name):
     """
     Returns the arn for a lambda given a lambda function name.
@@ -1221,7 +1944,7 @@ def lambda_arn_lookup(session, lambda_name):
     if session is None:
         return None
 
-    client = session.client("lambda")
+    client = get_client(session, "lambda")
     response = client.get_function(FunctionName=lambda_name)
     if response is None:
         return None
@@ -464,7 +464,7 @@ class CloudFormationConfiguration:
             if argument["ParameterValue"] is None:
                 raise Exception("Could not determine argument '{}'".format(argument["ParameterKey"]))
 
-        client = session.client('cloudformation')
+        client = aws.get_client(session, 'cloudformation')
         response = client.create_stack(
             StackName = self.stack_name,
             TemplateBody = self._create_template(),
@@ -486,6 +486,9 @@ class CloudFormationConfiguration:
             else:
                 print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                 rtn = False
+
+        # The stack created, changed, or removed resources that may have been looked up
+        aws.invalidate_lookups(session)
         return rtn
 
     def update(self, session, wait = True):
@@ -504,7 +507,7 @@ class CloudFormationConfiguration:
             if argument["ParameterValue"] is None:
                 raise Exception("Could not determine argument '{}'".format(argument["ParameterKey"]))
 
-        client = session.client('cloudformation')
+        client = aws.get_client(session, 'cloudformation')
 
         disable_preview = str(os.environ.get("DISABLE_PREVIEW"))
         disable_preview = disable_preview.lower() in ('yes', 'true', 'y', 't')
@@ -597,6 +600,9 @@ class CloudFormationConfiguration:
             else:
                 print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                 rtn = False
+
+        # The stack created, changed, or removed resources that may have been looked up
+        aws.invalidate_lookups(session)
         return rtn
 
     def delete(self, session, wait = True):
@@ -616,7 +622,7 @@ class CloudFormationConfiguration:
                           else None
         """
 
-        client = session.client("cloudformation")
+        client = aws.get_client(session, "cloudformation")
         client.delete_stack(StackName = self.stack_name)
 
         rtn = None
@@ -636,6 +642,9 @@ class CloudFormationConfiguration:
                 # Stack doesn't exist anymore
                 print(" done")
                 rtn = True
+
+        # The stack created, changed, or removed resources that may have been looked up
+        aws.invalidate_lookups(session)
         return rtn
 
     def add_arg(self, arg):
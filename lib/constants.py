@@ -57,6 +57,12 @@ CONSUL_LAMBDA = LAMBDA_DIR + '/monitors/chk_consul.py'
 INGEST_LAMBDA = LAMBDA_DIR + '/ingest_populate/ingest_queue_upload.py'
 
 
+########################
+# AMI Catalog
+# Directory for the local copies of the AMI listings, one per account / region
+AMI_CATALOG_DIR = os.path.expanduser("~/.cache/boss-manage")
+
+
 ########################
 # DynamoDB Table Schemas
 SALT_DIR = repo_path('salt_stack', 'salt')
@@ -94,6 +100,23 @@ TIMEOUT_VAULT = 120
 TIMEOUT_KEYCLOAK = 150
 
 
+########################
+# Health Monitor Metrics
+MONITOR_METRIC_NAMESPACE = "BOSS/Monitors"
+
+VAULT_LATENCY_ALARM = { # Health check latency (ms) to alarm on, None to disable
+    "development": None,
+    "production": 2000,
+    "ha-development": None,
+}
+
+CONSUL_LATENCY_ALARM = { # Health check latency (ms) to alarm on, None to disable
+    "development": None,
+    "production": 2000,
+    "ha-development": None,
+}
+
+
 ########################
 # Machine Instance Types
 ENDPOINT_TYPE = {
@@ -147,6 +170,14 @@ CONSUL_CLUSTER_SIZE = { # Consul Cluster is a fixed size
     "ha-development": 3,  # can tolerate 1 failures
 }
 
+# Number of Consul servers replaced at a time during an update, must not be more
+# than the number of failures the cluster can tolerate
+CONSUL_RESTART_BATCH_SIZE = 1
+
+# Number of batches that can fail to become healthy before an update stops
+# replacing Consul servers
+CONSUL_RESTART_MAX_FAILURES = 0
+
 VAULT_CLUSTER_SIZE = { # Vault Cluster is a fixed size
     "development" : 1,
     "production": 3, # should be an odd number
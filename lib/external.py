@@ -13,7 +13,8 @@
 # limitations under the License.
 
 import time
-from urllib.request import urlopen, HTTPError
+import json
+from urllib.request import urlopen, build_opener, ProxyHandler, HTTPError, URLError
 from contextlib import contextmanager
 
 from . import exceptions
@@ -60,9 +61,14 @@ class ExternalCalls:
         self.keypair_file = keypair_to_file(keypair)
         self.domain = domain
 
+        # Read all of the VPC's machines at once, instead of one lookup per hostname
+        aws.prefetch_vpc_inventory(session, domain)
+
         self.bastion_hostname = "bastion." + domain
         self.bastion_ip = aws.machine_lookup(session, self.bastion_hostname)
 
+        self.consul_hostname = "consul." + domain
+
         self.vault_hostname = "vault." + domain
         ips = aws.machine_lookup_all(session, self.vault_hostname, public_ip=False)
         self.vaults = [Vault(self.vault_hostname, ip) for ip in ips]
@@ -157,6 +163,45 @@ class ExternalCalls:
             else:
                 return False
 
+    def consul_quorum(self, size):
+        """Consul status check to see if the cluster has a leader and all of the
+        running Consul servers are raft peers
+
+        Args:
+            size (int) : Number of servers the Consul cluster should have
+
+        Returns:
+            (bool) : If the Consul cluster is healthy
+        """
+        ips = aws.machine_lookup_all(self.session, self.consul_hostname, public_ip=False)
+        if len(ips) < size:
+            return False
+
+        # Vault's tunnel is a proxy that can reach any machine in the VPC
+        opener = build_opener(ProxyHandler({"http": "http://localhost:3128"}))
+        with vault_tunnel(self.keypair_file, self.bastion_ip):
+            try:
+                url = "http://{}:8500/v1/status/".format(ips[0])
+                leader = json.loads(opener.open(url + "leader", timeout=10).read().decode('utf-8'))
+                peers = json.loads(opener.open(url + "peers", timeout=10).read().decode('utf-8'))
+            except (HTTPError, URLError, OSError, ValueError):
+                return False
+
+        peers = [peer.split(':')[0] for peer in peers]
+        return len(leader) > 0 and all(ip in peers for ip in ips)
+
+    def vault_unsealed(self):
+        """Vault status check to see if all of the Vault servers are unsealed
+
+        Returns:
+            (bool) : If all of the Vault servers are unsealed
+        """
+        with vault_tunnel(self.keypair_file, self.bastion_ip):
+            try:
+                return all(not vault.connect().is_sealed() for vault in self.vaults)
+            except Exception:
+                return False
+
     def check_keycloak(self, timeout, exception=True):
         """Keycloak status check to see if Keycloak is accessible
         """
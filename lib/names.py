@@ -54,6 +54,7 @@ class AWSNames(object):
         "proofreader": "proofreader-web",
         "proofreader_db": "proofreader-db",
         "dns": "dns", # lambda, sns topic display name, sns topic name
+        "dns_reconcile": "dnsReconcile",
         "internal": "internal", # subnet, security group, route table
         "ssh": "ssh",
         "https": "https",
@@ -105,7 +106,7 @@ class AWSNames(object):
         fq_hostname = hostname + self.base_dot
 
         if name in ['multi_lambda', 'write_lock', 'vault_monitor', 'consul_monitor', 'vault_consul_check',
-                    'delete_lambda', 'ingest_lambda']:
+                    'delete_lambda', 'ingest_lambda', 'dns_reconcile']:
             fq_hostname = fq_hostname.replace('.','-')
 
         if name in ['s3flush_queue', 'deadletter_queue', 'delete_cuboid', 'query_deletes',
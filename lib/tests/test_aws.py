@@ -0,0 +1,530 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+import os, sys
+import time
+import tempfile
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import aws
+
+
+def vpc_session(vpc_id='vpc-1234'):
+    """Create a mock session whose EC2 client returns the given VPC"""
+    session = mock.MagicMock()
+    vpcs = [] if vpc_id is None else [{'VpcId': vpc_id}]
+    session.client.return_value.describe_vpcs.return_value = {'Vpcs': vpcs}
+    return session
+
+
+class TestLookupCache(unittest.TestCase):
+    def setUp(self):
+        aws.invalidate_lookups()
+
+    def test_cached(self):
+        session = vpc_session()
+        stats = aws.lookup_cache_stats()
+
+        self.assertEqual(aws.vpc_id_lookup(session, 'test.boss'), 'vpc-1234')
+        self.assertEqual(aws.vpc_id_lookup(session, 'test.boss'), 'vpc-1234')
+
+        describe_vpcs = session.client.return_value.describe_vpcs
+        self.assertEqual(describe_vpcs.call_count, 1)
+
+        actual = aws.lookup_cache_stats()
+        self.assertEqual(actual['hits'] - stats['hits'], 1)
+        self.assertEqual(actual['misses'] - stats['misses'], 1)
+
+    def test_keyed_on_arguments(self):
+        session = vpc_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.vpc_id_lookup(session, 'other.boss')
+
+        describe_vpcs = session.client.return_value.describe_vpcs
+        self.assertEqual(describe_vpcs.call_count, 2)
+
+    def test_keyed_on_session(self):
+        session1 = vpc_session('vpc-1')
+        session2 = vpc_session('vpc-2')
+
+        self.assertEqual(aws.vpc_id_lookup(session1, 'test.boss'), 'vpc-1')
+        self.assertEqual(aws.vpc_id_lookup(session2, 'test.boss'), 'vpc-2')
+
+    def test_none_not_cached(self):
+        session = vpc_session(None)
+
+        self.assertIsNone(aws.vpc_id_lookup(session, 'test.boss'))
+        self.assertIsNone(aws.vpc_id_lookup(session, 'test.boss'))
+
+        describe_vpcs = session.client.return_value.describe_vpcs
+        self.assertEqual(describe_vpcs.call_count, 2)
+
+    def test_expired(self):
+        session = vpc_session()
+
+        with mock.patch.object(aws.time, 'time', return_value=1000):
+            aws.vpc_id_lookup(session, 'test.boss')
+
+        with mock.patch.object(aws.time, 'time', return_value=1000 + aws.LOOKUP_CACHE_TTL):
+            aws.vpc_id_lookup(session, 'test.boss')
+
+        describe_vpcs = session.client.return_value.describe_vpcs
+        self.assertEqual(describe_vpcs.call_count, 2)
+
+    def test_invalidate_lookup(self):
+        session = vpc_session()
+        session.client.return_value.describe_subnets.return_value = {'Subnets': [{'SubnetId': 'subnet-1'}]}
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.subnet_id_lookup(session, 'a-internal.test.boss')
+        aws.invalidate_lookups(session, 'vpc_id_lookup')
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.subnet_id_lookup(session, 'a-internal.test.boss')
+
+        client = session.client.return_value
+        self.assertEqual(client.describe_vpcs.call_count, 2)
+        self.assertEqual(client.describe_subnets.call_count, 1)
+
+    def test_copied(self):
+        session = mock.MagicMock()
+
+        @aws.cached_lookup
+        def lookup(session):
+            return aws.NoneDict({'internal': 'sg-1'})
+
+        sgs = lookup(session)
+        sgs['https'] = 'Ref'
+        self.assertIsInstance(lookup(session), aws.NoneDict)
+        self.assertEqual(lookup(session), {'internal': 'sg-1'})
+
+    def test_no_session(self):
+        self.assertIsNone(aws.vpc_id_lookup(None, 'test.boss'))
+
+
+class TestVpcInventory(unittest.TestCase):
+    def setUp(self):
+        aws.invalidate_lookups()
+
+        def instance(id, name, state='running'):
+            return {'InstanceId': id,
+                    'State': {'Name': state},
+                    'PrivateIpAddress': '10.0.0.' + id[-1],
+                    'Tags': [{'Key': 'Name', 'Value': name}]}
+
+        pages = {
+            'describe_instances': [
+                {'Reservations': [{'Instances': [instance('i-2', 'auth.test.boss'),
+                                                 instance('i-3', 'vault.test.boss', 'terminated')]}]},
+                {'Reservations': [{'Instances': [instance('i-1', 'auth.test.boss')]}]},
+            ],
+            'describe_subnets': [
+                {'Subnets': [{'SubnetId': 'subnet-1', 'Tags': [{'Key': 'Name', 'Value': 'a-internal.test.boss'}]}]},
+            ],
+            'describe_security_groups': [
+                {'SecurityGroups': [{'GroupId': 'sg-1', 'Tags': [{'Key': 'Name', 'Value': 'internal.test.boss'}]}]},
+            ],
+            'describe_route_tables': [
+                {'RouteTables': [{'RouteTableId': 'rtb-1', 'Tags': [{'Key': 'Name', 'Value': 'internal.test.boss'}]}]},
+            ],
+        }
+
+        self.session = vpc_session()
+        self.client = self.session.client.return_value
+        self.client.get_paginator.side_effect = lambda op: mock.Mock(**{'paginate.return_value': pages[op]})
+
+        aws.prefetch_vpc_inventory(self.session, 'test.boss')
+
+    def no_instances(self):
+        """Make any describe calls made after the prefetch return no instances"""
+        self.client.get_paginator.reset_mock(side_effect=True)
+        self.client.get_paginator.return_value.paginate.return_value = [{'Reservations': []}]
+
+    def test_machine_lookup(self):
+        self.assertEqual(aws.machine_lookup(self.session, 'auth.test.boss', public_ip=False), '10.0.0.1')
+        self.assertEqual(aws.machine_lookup(self.session, '1.auth.test.boss', public_ip=False), '10.0.0.2')
+        self.assertEqual(sorted(aws.machine_lookup_all(self.session, 'auth.test.boss', public_ip=False)),
+                         ['10.0.0.1', '10.0.0.2'])
+        self.assertIsNone(aws.machine_lookup(self.session, 'vault.test.boss', public_ip=False))
+        self.assertEqual(aws.instanceid_lookup(self.session, 'vault.test.boss'), 'i-3')
+
+        self.client.describe_instances.assert_not_called()
+
+    def test_vpc_lookups(self):
+        self.assertEqual(aws.subnet_id_lookup(self.session, 'a-internal.test.boss'), 'subnet-1')
+        self.assertEqual(aws.sg_lookup_all(self.session, 'vpc-1234')['internal.test.boss'], 'sg-1')
+        self.assertEqual(aws.sg_lookup(self.session, 'vpc-1234', 'internal.test.boss'), 'sg-1')
+        self.assertEqual(aws.rt_lookup(self.session, 'vpc-1234', 'internal.test.boss'), 'rtb-1')
+
+        self.client.describe_subnets.assert_not_called()
+        self.client.describe_security_groups.assert_not_called()
+        self.client.describe_route_tables.assert_not_called()
+
+    def test_sg_lookup_all_copied(self):
+        sgs = aws.sg_lookup_all(self.session, 'vpc-1234')
+        sgs['https.test.boss'] = 'Ref'
+
+        self.assertIsNone(aws.sg_lookup_all(self.session, 'vpc-1234')['https.test.boss'])
+        aws.invalidate_lookups(self.session, 'sg_lookup_all')
+        self.assertIsNone(aws.sg_lookup_all(self.session, 'vpc-1234')['https.test.boss'])
+
+    def test_other_domain(self):
+        self.no_instances()
+
+        self.assertIsNone(aws.machine_lookup(self.session, 'auth.other.boss'))
+        self.client.get_paginator.assert_called_once_with('describe_instances')
+
+    def test_missing_from_inventory(self):
+        self.no_instances()
+
+        self.assertIsNone(aws.machine_lookup(self.session, 'endpoint.test.boss'))
+        self.client.get_paginator.assert_called_once_with('describe_instances')
+
+        self.client.describe_subnets.return_value = {'Subnets': [{'SubnetId': 'subnet-2'}]}
+        self.client.describe_security_groups.return_value = {'SecurityGroups': [{'GroupId': 'sg-2'}]}
+        self.client.describe_route_tables.return_value = {'RouteTables': [{'RouteTableId': 'rtb-2'}]}
+        self.assertEqual(aws.subnet_id_lookup(self.session, 'b-internal.test.boss'), 'subnet-2')
+        self.assertEqual(aws.sg_lookup(self.session, 'vpc-1234', 'external.test.boss'), 'sg-2')
+        self.assertEqual(aws.rt_lookup(self.session, 'vpc-1234', 'external.test.boss'), 'rtb-2')
+
+    def test_invalidated(self):
+        aws.invalidate_lookups(self.session)
+        self.no_instances()
+
+        self.assertIsNone(aws.machine_lookup(self.session, 'auth.test.boss'))
+        self.client.get_paginator.assert_called_once_with('describe_instances')
+
+
+class TestPaginate(unittest.TestCase):
+    def test_all_pages(self):
+        client = mock.Mock()
+        client.get_paginator.return_value.paginate.return_value = [
+            {'Items': [1, 2]},
+            {},
+            {'Items': [3]},
+        ]
+
+        self.assertEqual(list(aws.paginate(client, 'list_items', 'Items', Prefix='a')), [1, 2, 3])
+        client.get_paginator.assert_called_once_with('list_items')
+        client.get_paginator.return_value.paginate.assert_called_once_with(Prefix='a')
+
+    def test_nested_key(self):
+        client = mock.Mock()
+        client.get_paginator.return_value.paginate.return_value = [
+            {'List': {'Items': [1]}},
+            {'List': {'Quantity': 0}},
+        ]
+
+        self.assertEqual(list(aws.paginate(client, 'list_items', 'List.Items')), [1])
+
+    def test_asg_name_lookup(self):
+        aws.invalidate_lookups()
+        session = mock.MagicMock()
+        client = session.client.return_value
+        client.get_paginator.return_value.paginate.return_value = [
+            {'Tags': []},
+            {'Tags': [{'ResourceId': 'asg-2', 'ResourceType': 'auto-scaling-group',
+                       'Key': 'Name', 'Value': 'vault.test.boss'}]},
+        ]
+
+        self.assertEqual(aws.asg_name_lookup(session, 'vault.test.boss'), 'asg-2')
+        client.get_paginator.assert_called_once_with('describe_tags')
+        client.get_paginator.return_value.paginate.assert_called_once_with(
+            Filters=[{'Name': 'key', 'Values': ['Name']},
+                     {'Name': 'value', 'Values': ['vault.test.boss']}])
+
+
+class TestAsgRestart(unittest.TestCase):
+    def setUp(self):
+        aws.invalidate_lookups()
+
+        self.session = mock.MagicMock()
+        self.client = self.session.client.return_value
+        self.client.get_paginator.return_value.paginate.return_value = [
+            {'Tags': [{'ResourceId': 'asg-1', 'ResourceType': 'auto-scaling-group',
+                       'Key': 'Name', 'Value': 'consul.test.boss'}]},
+        ]
+
+        # The ASG replaces each terminated instance on the next describe call
+        self.instances = ['i-1', 'i-2', 'i-3']
+        self.next_id = 4
+        def describe(AutoScalingGroupNames):
+            for id in self.client.terminate_instance_in_auto_scaling_group.call_args_list:
+                id = id[1]['InstanceId']
+                if id in self.instances:
+                    self.instances.remove(id)
+                    self.instances.append('i-{}'.format(self.next_id))
+                    self.next_id += 1
+
+            return {'AutoScalingGroups': [{
+                'DesiredCapacity': 3,
+                'Instances': [{'InstanceId': id,
+                               'LifecycleState': 'InService',
+                               'HealthStatus': 'Healthy'} for id in self.instances],
+            }]}
+        self.client.describe_auto_scaling_groups.side_effect = describe
+
+        patcher = mock.patch.object(aws.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def terminated(self):
+        calls = self.client.terminate_instance_in_auto_scaling_group.call_args_list
+        return [c[1]['InstanceId'] for c in calls]
+
+    def test_waits_for_health(self):
+        healthy = mock.Mock(side_effect=[True, False, True, True, True])
+
+        aws.asg_restart(self.session, 'consul.test.boss', 600, healthy=healthy)
+
+        self.assertEqual(self.terminated(), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(self.sleep.call_count, 4)
+
+    def test_batches(self):
+        callback = mock.Mock()
+
+        aws.asg_restart(self.session, 'consul.test.boss', 600, callback=callback, batch_size=2)
+
+        self.assertEqual(self.terminated(), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(callback.call_count, 2)
+
+    def test_not_healthy_before(self):
+        with self.assertRaises(aws.exceptions.StatusCheckError):
+            aws.asg_restart(self.session, 'consul.test.boss', 600, healthy=lambda: False)
+
+        self.assertEqual(self.terminated(), [])
+
+    def test_abort(self):
+        healthy = mock.Mock(side_effect=[True] + [False] * 10)
+
+        with mock.patch.object(aws.time, 'time', side_effect=[0, 0, 1000]):
+            with self.assertRaises(aws.exceptions.StatusCheckError):
+                aws.asg_restart(self.session, 'consul.test.boss', 600, healthy=healthy)
+
+        self.assertEqual(self.terminated(), ['i-1'])
+
+
+class TestLookupAll(unittest.TestCase):
+    def setUp(self):
+        aws.invalidate_lookups()
+
+    def test_results(self):
+        session = vpc_session()
+        session.client.return_value.get_paginator.return_value.paginate.return_value = [
+            {'Topics': [{'TopicArn': 'arn:aws:sns:us-east-1:123456789012:dns-test-boss'}]},
+        ]
+
+        results = aws.lookup_all(session, {
+            'vpc': (aws.vpc_id_lookup, 'test.boss'),
+            'topic': (aws.sns_topic_lookup, 'dns-test-boss'),
+        })
+
+        self.assertEqual(results, {'vpc': 'vpc-1234',
+                                   'topic': 'arn:aws:sns:us-east-1:123456789012:dns-test-boss'})
+
+    def test_client_reused(self):
+        session = vpc_session()
+
+        aws.lookup_all(session, {'vpc{}'.format(i): (aws.vpc_id_lookup, 'test{}.boss'.format(i))
+                                 for i in range(5)})
+
+        session.client.assert_called_once_with('ec2')
+
+    def test_exception(self):
+        def lookup(session):
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            aws.lookup_all(None, {'error': (lookup,)})
+
+    def test_empty(self):
+        self.assertEqual(aws.lookup_all(None, {}), {})
+
+
+class TestClientPool(unittest.TestCase):
+    def test_client(self):
+        session = mock.MagicMock()
+
+        self.assertIs(aws.get_client(session, 'ec2'), aws.get_client(session, 'ec2'))
+        aws.get_client(session, 's3')
+
+        self.assertEqual(session.client.call_args_list, [mock.call('ec2'), mock.call('s3')])
+
+    def test_resource_per_thread(self):
+        session = mock.MagicMock()
+        session.resource.side_effect = lambda service: object()
+
+        resource = aws.get_resource(session, 's3')
+        self.assertIs(aws.get_resource(session, 's3'), resource)
+
+        with aws.ThreadPoolExecutor(max_workers=1) as tpe:
+            other = tpe.submit(aws.get_resource, session, 's3').result()
+        self.assertIsNot(other, resource)
+
+
+class TestAmiCatalog(unittest.TestCase):
+    def setUp(self):
+        aws.invalidate_lookups()
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(aws.const, 'AMI_CATALOG_DIR', tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.images = [
+            {'ImageId': 'ami-1', 'Name': 'vault.boss-h1234', 'CreationDate': '2017-01-01T00:00:00.000Z',
+             'Tags': [{'Key': 'Commit', 'Value': '1234'}]},
+            {'ImageId': 'ami-2', 'Name': 'vault.boss-h5678', 'CreationDate': '2017-02-01T00:00:00.000Z',
+             'Tags': [{'Key': 'Commit', 'Value': '5678'}]},
+            {'ImageId': 'ami-3', 'Name': 'vault.boss-test', 'CreationDate': '2017-03-01T00:00:00.000Z'},
+        ]
+
+    def session(self, images=None):
+        """Mock session where reading the catalog returns images (default:
+        self.images) and any AMI in self.images or images exists"""
+        if images is None:
+            images = self.images
+        registered = {i['ImageId'] for i in self.images + images}
+
+        def describe_images(ImageIds=None, **kwargs):
+            if ImageIds is None:
+                return {'Images': images}
+            return {'Images': [{'ImageId': i, 'State': 'available'} for i in ImageIds if i in registered]}
+
+        session = mock.MagicMock()
+        session.region_name = 'us-east-1'
+        client = session.client.return_value
+        client.list_users.return_value = {'Users': [{'Arn': 'arn:aws:iam::123456789012:user/test'}]}
+        client.describe_images.side_effect = describe_images
+        return session
+
+    def catalog_calls(self, session):
+        """The describe_images calls that read the catalog, not the ones
+        checking that a single AMI still exists"""
+        describe_images = session.client.return_value.describe_images
+        return [c for c in describe_images.call_args_list if 'ImageIds' not in c[1]]
+
+    def test_versions(self):
+        session = self.session()
+
+        self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'latest'), ('ami-2', '5678'))
+        self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'test'), ('ami-3', None))
+        self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'h1234'), ('ami-1', '1234'))
+
+        # Same scope as looking up each AMI by name, not just the account's own AMIs
+        self.assertEqual(self.catalog_calls(session),
+                         [mock.call(Filters=[{'Name': 'name', 'Values': ['*.boss-*']}])])
+
+    def test_owners(self):
+        session = self.session()
+        catalog = aws.AmiCatalog(session, 'test', ['self'])
+        catalog.refresh()
+
+        self.assertEqual(self.catalog_calls(session), [mock.call(Owners=['self'], Filters=[])])
+
+    def test_deregistered(self):
+        session = self.session()
+        self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'latest'), ('ami-2', '5678'))
+        aws.invalidate_lookups()
+
+        # ami-2 is deregistered after being cataloged, which an incremental
+        # refresh never notices
+        session = self.session(images=[])
+        describe_images = session.client.return_value.describe_images
+        exists = describe_images.side_effect
+        def deregistered(ImageIds=None, **kwargs):
+            if ImageIds == ['ami-2']:
+                raise aws.ClientError({'Error': {'Code': 'InvalidAMIID.NotFound'}}, 'DescribeImages')
+            return exists(ImageIds=ImageIds, **kwargs)
+        describe_images.side_effect = deregistered
+
+        with mock.patch.object(aws.time, 'time', return_value=time.time() + aws.LOOKUP_CACHE_TTL):
+            self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'latest'), ('ami-1', '1234'))
+        describe_images.assert_any_call(ImageIds=['ami-2'])
+
+        catalog = aws.AmiCatalog(session, 'boss', None)
+        self.assertEqual(sorted(catalog.images), ['ami-1', 'ami-3'])
+
+    def test_available_error(self):
+        session = self.session()
+        error = aws.ClientError({'Error': {'Code': 'RequestLimitExceeded'}}, 'DescribeImages')
+        session.client.return_value.describe_images.side_effect = error
+
+        catalog = aws.AmiCatalog(session, 'test', None)
+        catalog.images = {'ami-1': {}}
+        with self.assertRaises(aws.ClientError):
+            catalog.available('ami-1')
+        self.assertIn('ami-1', catalog.images)
+
+    def test_missing_version(self):
+        session = self.session()
+
+        self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'missing'), ('ami-2', '5678'))
+        self.assertIsNone(aws.ami_lookup(session, 'auth.boss', 'latest'))
+
+    def test_incremental(self):
+        aws.ami_lookup(self.session(), 'vault.boss', 'latest')
+        aws.invalidate_lookups()
+
+        session = self.session(images=[
+            {'ImageId': 'ami-4', 'Name': 'vault.boss-h9999', 'CreationDate': '2017-04-01T00:00:00.000Z'},
+        ])
+
+        # Read from disk and only the new AMIs are read from AWS
+        with mock.patch.object(aws.time, 'time', return_value=time.time() + aws.LOOKUP_CACHE_TTL):
+            self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'latest'), ('ami-4', None))
+            self.assertEqual(aws.ami_lookup(session, 'vault.boss', 'h1234'), ('ami-1', '1234'))
+
+        calls = self.catalog_calls(session)
+        self.assertEqual(len(calls), 1)
+        filters = calls[0][1]['Filters']
+        self.assertEqual(filters[-1]['Name'], 'creation-date')
+
+    @mock.patch.dict(os.environ, {'TZ': 'America/New_York'})
+    def test_incremental_utc(self):
+        time.tzset()
+        self.addCleanup(time.tzset)
+
+        session = self.session()
+        catalog = aws.AmiCatalog(session, 'test', ['self'])
+        catalog.full_updated = catalog.updated = 1488410000 # 2017-03-01T23:13:20Z
+        with mock.patch.object(aws.time, 'time', return_value=1488414000): # 2017-03-02T00:20:00Z
+            catalog.refresh()
+
+        filters = session.client.return_value.describe_images.call_args[1]['Filters']
+        self.assertEqual(filters[-1]['Values'], ['2017-02-28*', '2017-03-01*', '2017-03-02*'])
+
+
+class TestLambdaFileKey(unittest.TestCase):
+    def test_changes_with_contents(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = os.path.join(tmp, 'lambda.py')
+            with open(file, 'w') as fh:
+                fh.write('def handler(event, context): pass\n')
+            key = aws.lambda_file_key('lambda.test.boss', file)
+
+            self.assertTrue(key.startswith('lambda.test.boss.'))
+            self.assertTrue(key.endswith('.zip'))
+            self.assertEqual(aws.lambda_file_key('lambda.test.boss', file), key)
+
+            with open(file, 'w') as fh:
+                fh.write('def handler(event, context): return 1\n')
+            self.assertNotEqual(aws.lambda_file_key('lambda.test.boss', file), key)